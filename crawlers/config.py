@@ -6,20 +6,69 @@ load_dotenv()
 # --- Configuration ---
 
 YEAR = 2024
-DATAFRAME_PATH = f"data/parliament_data_{YEAR}.csv"
+DATAFRAME_PATH = f"data/parliament_data_{YEAR}.parquet"  # Working checkpoint; a CSV copy is exported for inspection
 SESSION_PDF_DIR = "data/session_pdfs"
 PROPOSAL_DOC_DIR = "data/proposal_docs"
 DOWNLOAD_TIMEOUT = 60  # seconds for requests timeout
 LLM_RETRY_ATTEMPTS = 3
 LLM_RETRY_DELAY = 5  # seconds
+LLM_RETRY_MAX_DELAY = 120  # Maximum delay between Gemini retries
+LLM_MAX_TOTAL_TIME = 900  # Maximum total time for one Gemini call including retries
 LLM_TIMEOUT = 180  # seconds for Gemini API timeout
+GEMINI_STREAMING = False  # Stream Gemini responses, dropping JSON answers that start malformed without waiting for the rest
+MIN_PROMPT_LENGTH = 20  # Shorter prompts are rejected without calling Gemini
+GEMINI_MAX_OUTPUT_TOKENS_SESSION = 32768  # Output token cap per session PDF partition; thinking tokens count towards it
+GEMINI_MAX_OUTPUT_TOKENS_PROPOSAL = 8192  # Output token cap per proposal document summary; thinking tokens count towards it
+GEMINI_MAX_OUTPUT_TOKENS_LIMIT = 65536  # Largest output token cap the model accepts
 HTTP_RETRY_ATTEMPTS = 10  # Maximum retry attempts for HTTP requests
 HTTP_RETRY_BASE_DELAY = 2  # Base delay in seconds for exponential backoff
 HTTP_RETRY_MAX_DELAY = 300  # Maximum delay between retries (5 minutes)
 HTTP_RETRY_MAX_TOTAL_TIME = 3600  # Maximum total time for all retries (1 hour)
+HTTP_STATUS_RETRIES = 3  # Retries of 429/5xx responses inside one HTTP request attempt
+HTTP_POOL_MAXSIZE = 32  # Keep-alive connections kept open per host by the shared HTTP session
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # bytes copied per read when saving a download
+RANGE_DOWNLOAD_MIN_SIZE = 16 * 1024 * 1024  # Downloads at least this large are fetched as parallel byte ranges when the server allows it
+RANGE_DOWNLOAD_PARTS = 5  # Byte ranges fetched in parallel for one large download
+RANGE_DOWNLOAD_MAX_ACTIVE = 2  # Large downloads fetched as ranges at once; the others are streamed whole
 PDF_PAGE_PARTITION_SIZE = 13  # Process PDFs in chunks of this many pages
+TABLE_EXTRACTOR = "tabula"  # Vote table detection: "tabula" (Java; falls back to pymupdf when not installed) or "pymupdf" (in-process, not yet compared on real session PDFs)
+SESSION_PROMPT_BATCH_SIZE = 4  # Session PDF partitions sent per Gemini call (1 disables batching)
+DEDUP_TABLES = True  # Write vote tables repeated within a session prompt once and refer back to them
+PROPOSAL_BATCH_SIZE = 4  # Proposal documents attached to one Gemini summary call (1 disables batching)
 NUM_THREADS = 15
+GEMINI_CONCURRENCY = 8  # Gemini requests kept in flight at once by process_pdfs
+UPLOAD_PREFETCH_WORKERS = 4  # Concurrent document uploads started ahead of the Gemini calls that need them
+GEMINI_RATE_LIMIT_PER_MIN = int(os.getenv("GEMINI_RATE_LIMIT_PER_MIN", 500))  # Gemini requests started per minute across all threads (0 disables)
+GEMINI_UPLOAD_RATE_LIMIT_PER_MIN = int(os.getenv("GEMINI_UPLOAD_RATE_LIMIT_PER_MIN", 100))  # File API uploads started per minute across all threads (0 disables)
+GEMINI_MAX_CONCURRENCY = 32  # Gemini requests and uploads open at once across all threads
+THROTTLE_POLL_INTERVAL = 0.05  # seconds between checks for a free Gemini concurrency slot
+# Concurrent proposal detail fetches for the whole run, in one pool shared by every session. With the NUM_THREADS
+# session downloads and the ranged downloads this keeps the connections to the site within HTTP_POOL_MAXSIZE
+PROPOSAL_FETCH_THREADS = 8
+PDF_EXTRACT_PROCESSES = os.cpu_count() or 1  # Worker processes that parse PDFs in parallel (pipeline partitions, extract_hyperlink_tables_many)
+PDF_EXTRACT_IN_PROCESSES = True  # Parse session PDF partitions in a shared pool of PDF_EXTRACT_PROCESSES worker processes
+SAVE_MIN_INTERVAL = 10  # Minimum seconds between throttled DataFrame checkpoints
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")  # Level of the Gemini client log messages (DEBUG shows every call)
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_MODEL = "gemini-2.5-flash-preview-05-20"  # Model used for every Gemini call
+BATCH_MODE = False  # Send Stage 4 proposal summaries through the cheaper, slower Gemini batch endpoint
+BATCH_JOBS_DIR = "data/batch_jobs"  # Where submitted batch handles are saved
+BATCH_POLL_INTERVAL = 60  # seconds between batch status checks
+BATCH_MAX_WAIT = 25 * 60 * 60  # seconds to wait for a batch (the endpoint targets 24h) before leaving it for the next run
+CACHE_DIR = "data/cache"  # Local caches of Gemini-side state and results
+UPLOAD_CACHE_PATH = os.path.join(CACHE_DIR, "gemini_uploads.json")  # Uploaded File API handles by document SHA-256
+UPLOAD_CACHE_EXPIRY_MARGIN = 3600  # seconds; cached uploads this close to expiring are uploaded again
+CONTEXT_CACHING = True  # Keep static system instructions in Gemini context caches instead of resending them
+CONTEXT_CACHE_TTL = 3600  # seconds a context cache lives before it is recreated
+CONTEXT_CACHE_REFRESH_MARGIN = 60  # seconds; caches this close to expiring are recreated
+SESSION_RESULT_CACHE = True  # Reuse earlier Gemini extractions of identical session PDF inputs
+SESSION_RESULT_CACHE_DIR = os.path.join(CACHE_DIR, "session_results")  # One JSON file per extracted session input
+RESPONSE_CACHE = True  # Answer repeated Gemini calls (same prompt, document, schema and model) from disk
+RESPONSE_CACHE_PATH = os.path.join(CACHE_DIR, "gemini_responses.sqlite")  # SQLite store of parsed Gemini responses
+RESPONSE_CACHE_TTL = 7 * 24 * 3600  # seconds a cached Gemini response stays valid
+PDF_TEXT_CACHE = True  # Reuse text extracted from a PDF whose content is unchanged
+PDF_TEXT_CACHE_DIR = os.path.join(CACHE_DIR, "pdf_text")  # One text file per extracted PDF, named by content hash
+PROMPT_VERSION = "v1"  # Part of every response cache key; bump to invalidate cached responses after prompt changes
 
 legislature_data = {
     date(2022, 3, 30): {
@@ -0,0 +1,67 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+class SQLiteResponseCache:
+    """
+    Persistent key -> JSON value store with per-entry expiry, used to skip Gemini calls whose
+    prompt, document and settings were already answered. One connection is shared by all
+    threads and guarded by a lock; every read or write is a single short statement.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def _connect(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response_json TEXT NOT NULL, "
+                "created_at REAL NOT NULL, expires_at REAL)")
+            self._connection.commit()
+        return self._connection
+
+    def get(self, key):
+        """Returns the stored value for key, or None if there is none or it has expired."""
+        try:
+            with self._lock:
+                row = self._connect().execute(
+                    "SELECT response_json, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            log.warning("Could not read response cache %s: %s", self.path, e)
+            return None
+        if row is None:
+            return None
+        response_json, expires_at = row
+        if expires_at is not None and expires_at <= time.time():
+            return None
+        return json.loads(response_json)
+
+    def set(self, key, value, ttl=None):
+        """Stores a JSON-serializable value under key, expiring after ttl seconds (never if None)."""
+        try:
+            response_json = json.dumps(value, ensure_ascii=False)
+        except (TypeError, ValueError) as e:
+            log.warning("Not caching a response that is not JSON-serializable: %s", e)
+            return
+        now = time.time()
+        try:
+            with self._lock:
+                connection = self._connect()
+                connection.execute(
+                    "INSERT OR REPLACE INTO responses (key, response_json, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                    (key, response_json, now, now + ttl if ttl is not None else None))
+                connection.commit()
+        except sqlite3.Error as e:
+            log.warning("Could not write response cache %s: %s", self.path, e)
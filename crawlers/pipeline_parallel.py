@@ -2,20 +2,245 @@ import argparse
 import os
 import re
 import json
+import logging
+import time
 import fitz # PyMuPDF
+import multiprocessing
 import pandas as pd
 from datetime import datetime
 from threading import Lock
 from urllib.parse import urlparse, parse_qs
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 from utils import (download_file, generate_session_pdf_filename, init_directories, load_or_initialize_dataframe,
-                   save_dataframe, extract_hyperlink_table_data, get_dataframe_columns)
-from config import (GEMINI_API_KEY, PDF_PAGE_PARTITION_SIZE, SESSION_PDF_DIR,
-                    PROPOSAL_DOC_DIR, YEAR, NUM_THREADS)
-from prompts import create_prompt_for_session_pdf, create_prompt_for_proposal_pdf, call_gemini_api, validate_llm_proposals_response
+                   save_dataframe, extract_hyperlink_table_data, get_dataframe_columns,
+                   append_update_log, read_update_log, clear_update_log, export_dataframe_csv, coerce_integer_columns)
+from config import (GEMINI_API_KEY, PDF_PAGE_PARTITION_SIZE, SESSION_PROMPT_BATCH_SIZE, SESSION_PDF_DIR,
+                    PROPOSAL_DOC_DIR, YEAR, NUM_THREADS, SAVE_MIN_INTERVAL, PROPOSAL_FETCH_THREADS, BATCH_MODE,
+                    LOG_LEVEL, GEMINI_MAX_OUTPUT_TOKENS_PROPOSAL, PDF_EXTRACT_IN_PROCESSES, PDF_EXTRACT_PROCESSES)
+from prompts import (create_prompt_for_proposal_pdf, call_gemini_api_for_session_pdfs, call_gemini_api_for_proposal_pdfs,
+                     validate_llm_proposals_response, run_batch)
 from parliament_scraper import ParliamentPDFScraper, fetch_proposal_details_and_download_doc
 
+# Low-cardinality status columns, stored as pandas categoricals in checkpoints
+STATUS_COLUMNS = ['session_pdf_download_status', 'session_parse_status', 'proposal_details_scrape_status',
+                  'proposal_doc_download_status', 'proposal_summarize_status', 'overall_status']
+
+# Values the pipeline is known to write to each status column. Failure statuses
+# embed free-form error text, so observed values are added to these categories.
+KNOWN_STATUS_VALUES = {
+    'session_pdf_download_status': ['Not Attempted', 'Success', 'Download Failed'],
+    'session_parse_status': ['Not Attempted', 'Success', 'LLM Parsed - No Propostas Encontradas',
+                             'Unknown (Reconstructed)'],
+    'proposal_details_scrape_status': ['Success', 'Success (No Doc Link)', 'No Gov Link', 'Fetch Failed'],
+    'proposal_doc_download_status': ['Not Attempted', 'Success', 'Download Failed', 'Not PDF - Not Downloaded'],
+    'proposal_summarize_status': ['Success'],
+    'overall_status': ['Pending Further Stages', 'Pending Stage 4', 'Success', 'Completed (No Propostas)',
+                       'Completed (No Proposal Doc to Summarize)', 'Completed (No Gov Link for Details)',
+                       'Failed Stage 1 (Session PDF Download)', 'Failed Stage 2 (LLM Session Parse)',
+                       'Failed Stage 3 (Proposal Details Scrape)', 'Failed Stage 4 (LLM Summary)',
+                       'Failed Stage 4 (Data Assignment)'],
+}
+
+# Stage 3 scrape statuses that need no further fetch, and the subset that counts as success
+TERMINAL_STAGE3 = frozenset({'Success', 'Success (No Doc Link)', 'No Gov Link', 'Fetch Failed'})
+STAGE3_SUCCESS = frozenset({'Success', 'Success (No Doc Link)'})
+
+# Template for newly inserted rows, built once instead of per insert
+COLUMNS = tuple(get_dataframe_columns())
+EMPTY_ROW = {col: None for col in COLUMNS}
+
+# Shared across worker threads to throttle DataFrame checkpoints. The throttle
+# state is guarded by the DataFrame lock; save_lock keeps checkpoint writes in
+# the order their changes were collected.
+save_lock = Lock()
+_last_save_ts = 0.0
+
+# Worker processes shared by all session threads for PDF parsing, which holds the GIL
+_pdf_process_pool = None
+_pdf_process_pool_lock = Lock()
+
+
+def get_pdf_process_pool():
+    """
+    Returns the shared PDF parsing process pool, creating it on first use. Workers are
+    spawned rather than forked, since forking a process with running threads can copy held locks.
+    """
+    global _pdf_process_pool
+    with _pdf_process_pool_lock:
+        if _pdf_process_pool is None:
+            _pdf_process_pool = ProcessPoolExecutor(max_workers=PDF_EXTRACT_PROCESSES,
+                                                    mp_context=multiprocessing.get_context("spawn"))
+        return _pdf_process_pool
+
+
+def proposal_row_key(session_pdf_url, proposal_name, proposal_gov_link):
+    """Builds the row_index_map key for a proposal row."""
+    return (session_pdf_url, proposal_name, proposal_gov_link)
+
+
+def records_to_dataframe(records):
+    """
+    Materializes a list of row dicts as a DataFrame with the pipeline's columns, status
+    categoricals and Int64 integer columns (session_year, proposal_approval_status).
+    """
+    df = coerce_integer_columns(pd.DataFrame.from_records(records, columns=COLUMNS))
+    for col in STATUS_COLUMNS:
+        known_values = KNOWN_STATUS_VALUES.get(col, [])
+        known_set = set(known_values)
+        categories = known_values + [value for value in df[col].dropna().unique() if value not in known_set]
+        df[col] = df[col].astype(pd.CategoricalDtype(categories=categories))
+    return df
+
+
+def coerce_approval_status(value):
+    """
+    A proposal_approval_status from the model as an int, or None if it is not a number.
+    Answers without a response schema may give the flag as "1" or 1.0 instead of 1.
+    """
+    try:
+        status = pd.to_numeric(value, errors='coerce')
+        return None if pd.isna(status) else int(status)
+    except (TypeError, ValueError):
+        return None
+
+
+class PipelineState:
+    """
+    Authoritative in-memory catalog for a pipeline run. Each row is a plain dict
+    keyed by a stable row id, so updates are dict writes instead of DataFrame
+    .loc assignments; pandas is only used to load the catalog and to write it out.
+    Rows changed since the last checkpoint are tracked so checkpoints can append
+    just those rows to the update log. All mutations must happen under the DataFrame lock.
+    """
+
+    def __init__(self, df):
+        self.rows = {}  # row id -> {column: value}, in file/insertion order
+        self.session_row_ids = {}  # session_pdf_url -> [row id, ...]
+        self.row_index_map = {}  # proposal_row_key(...) -> row id of the first matching proposal row
+        self.summary_index_map = {}  # session_pdf_url -> row id of the session summary row
+        self._next_row_id = 0
+        self._changed_row_ids = set()
+        self._deleted_row_ids = set()
+        # Missing values are stored as None so row checks are plain `is None` tests
+        for record in df.astype(object).where(df.notna(), None).to_dict('records'):
+            self.insert_row(record)
+        self._changed_row_ids.clear()  # Rows read from the DataFrame file are not changes
+
+    def insert_row(self, row, row_id=None):
+        """Appends a row dict and registers it in the lookup maps. Returns its row id."""
+        if row_id is None:
+            row_id = self._next_row_id
+        self._next_row_id = max(self._next_row_id, row_id + 1)
+        self.rows[row_id] = row
+        self._changed_row_ids.add(row_id)
+        session_pdf_url = row['session_pdf_url']
+        self.session_row_ids.setdefault(session_pdf_url, []).append(row_id)
+        proposal_name = row['proposal_name_from_session']
+        if proposal_name is None:
+            self.summary_index_map.setdefault(session_pdf_url, row_id)
+        else:
+            self.row_index_map.setdefault(
+                proposal_row_key(session_pdf_url, proposal_name, row['proposal_gov_link']), row_id)
+        return row_id
+
+    def update_row(self, row_id, updates):
+        self.rows[row_id].update(updates)
+        self._changed_row_ids.add(row_id)
+
+    def delete_row(self, row_id):
+        """Removes a row and its lookup map entries."""
+        row = self.rows.pop(row_id)
+        session_pdf_url = row['session_pdf_url']
+        self.session_row_ids[session_pdf_url].remove(row_id)
+        proposal_name = row['proposal_name_from_session']
+        if proposal_name is None:
+            if self.summary_index_map.get(session_pdf_url) == row_id:
+                del self.summary_index_map[session_pdf_url]
+        else:
+            key = proposal_row_key(session_pdf_url, proposal_name, row['proposal_gov_link'])
+            if self.row_index_map.get(key) == row_id:
+                del self.row_index_map[key]
+        self._changed_row_ids.discard(row_id)
+        self._deleted_row_ids.add(row_id)
+
+    def session_rows(self, session_pdf_url):
+        """Returns the row dicts belonging to a session PDF."""
+        return [self.rows[row_id] for row_id in self.session_row_ids.get(session_pdf_url, ())]
+
+    def proposal_row_ids(self, session_pdf_url):
+        """Returns the ids of a session's proposal rows (every row except the summary row)."""
+        return [row_id for row_id in self.session_row_ids.get(session_pdf_url, ())
+                if self.rows[row_id]['proposal_name_from_session'] is not None]
+
+    def drop_session_proposals(self, session_pdf_url):
+        """Removes a session's proposal rows, keeping its summary row. Returns the number of rows dropped."""
+        dropped_ids = self.proposal_row_ids(session_pdf_url)
+        for row_id in dropped_ids:
+            self.delete_row(row_id)
+        return len(dropped_ids)
+
+    def snapshot(self):
+        """Copies every row so the snapshot can be serialized without holding the lock."""
+        return [row.copy() for row in self.rows.values()]
+
+    def to_dataframe(self):
+        return records_to_dataframe(self.snapshot())
+
+    def pop_changes(self):
+        """
+        Returns update log records for the rows changed or deleted since the last
+        call and resets the tracking: {'row_idx': id, **row} for changed rows and
+        {'row_idx': id, '_deleted': True} for deleted ones.
+        """
+        records = [{'row_idx': row_id, **self.rows[row_id]} for row_id in sorted(self._changed_row_ids)]
+        records.extend({'row_idx': row_id, '_deleted': True} for row_id in sorted(self._deleted_row_ids))
+        self._changed_row_ids.clear()
+        self._deleted_row_ids.clear()
+        return records
+
+    def replay_changes(self, records):
+        """Applies update log records written by pop_changes, in order."""
+        for record in records:
+            record = dict(record)
+            row_id = record.pop('row_idx')
+            if record.pop('_deleted', False):
+                if row_id in self.rows:
+                    self.delete_row(row_id)
+            elif row_id in self.rows:
+                self.update_row(row_id, record)
+            else:
+                self.insert_row({**EMPTY_ROW, **record}, row_id=row_id)
+
+
+def checkpoint_dataframe(state, dataframe_path, lock_obj, force=False):
+    """
+    Checkpoints the pipeline state at most once every SAVE_MIN_INTERVAL seconds
+    across all worker threads. A regular checkpoint appends only the rows changed
+    since the previous one to the update log; force=True rewrites the whole
+    DataFrame file and clears the log. Changes are collected under lock_obj (the
+    DataFrame lock) and written outside it, with save_lock keeping log appends in
+    collection order. Callers must not hold lock_obj. Returns True if anything was written.
+    """
+    global _last_save_ts
+    with lock_obj:
+        now = time.monotonic()
+        if not force and now - _last_save_ts < SAVE_MIN_INTERVAL:
+            return False
+        _last_save_ts = now
+
+    with save_lock:
+        with lock_obj:
+            changes = state.pop_changes()
+            records = state.snapshot() if force else None
+
+        if force and save_dataframe(records_to_dataframe(records), dataframe_path):
+            clear_update_log(dataframe_path)
+            return True
+        # Regular checkpoint, or a full rewrite that failed: keep the changes in the log
+        return bool(changes) and append_update_log(changes, dataframe_path)
+
+
 # --- Step 1: Extract the Votes and Proposals from the Session PDF ---
 
 
@@ -56,6 +281,18 @@ def extract_votes_from_session_pdf(session_pdf_path, session_date):
     all_proposals_collected = []
     accumulated_errors = []
 
+    # Extract the structured data of every partition first, so the LLM calls can be batched.
+    # With PDF_EXTRACT_IN_PROCESSES the partitions are parsed in parallel by the process pool.
+    pdf_process_pool = get_pdf_process_pool() if PDF_EXTRACT_IN_PROCESSES else None
+    extraction_futures = []
+    if pdf_process_pool is not None:
+        extraction_futures = [
+            pdf_process_pool.submit(extract_hyperlink_table_data, session_pdf_path,
+                                    None if process_as_single_unit else part_info['start_page'],
+                                    None if process_as_single_unit else part_info['end_page'])
+            for part_info in partitions_info]
+    partition_inputs = []
+    skipped_partitions = 0
     for i, part_info in enumerate(partitions_info):
         start_page = part_info['start_page']
         end_page = part_info['end_page']
@@ -68,7 +305,9 @@ def extract_votes_from_session_pdf(session_pdf_path, session_date):
             # Original short PDF path: extract_hyperlink_table_data(session_pdf_path)
             # Original chunked path: extract_hyperlink_table_data(session_pdf_path, start_page, end_page)
             # This assumes extract_hyperlink_table_data can be called in these two ways.
-            if process_as_single_unit:
+            if extraction_futures:
+                hyperlink_table_pairs, unpaired_links = extraction_futures[i].result()
+            elif process_as_single_unit:
                 hyperlink_table_pairs, unpaired_links = extract_hyperlink_table_data(
                     session_pdf_path)
             else:
@@ -81,13 +320,28 @@ def extract_votes_from_session_pdf(session_pdf_path, session_date):
             if not hyperlink_table_pairs and not unpaired_links:
                 print(
                     f"{partition_label}: No data extracted from PDF content, skipping LLM call.")
+                skipped_partitions += 1
                 continue
 
-            prompt = create_prompt_for_session_pdf(
-                hyperlink_table_pairs, unpaired_links, session_date)
-            extracted_data, llm_error = call_gemini_api(
-                prompt, expect_json=True, responseSchema=None)
+            partition_inputs.append((partition_label, start_page, end_page, hyperlink_table_pairs, unpaired_links))
 
+        except Exception as e:
+            error_message = f"General error processing {partition_label} (pages {start_page}-{end_page}): {e}"
+            print(error_message)
+            if process_as_single_unit:
+                # Mimic original "Critical failure in manual PDF parsing" for short PDFs
+                return None, f"Critical failure in manual PDF parsing for {partition_label}: {e}"
+            accumulated_errors.append(error_message)
+
+    if skipped_partitions:
+        print(f"Skipped the LLM call for {skipped_partitions} of {len(partitions_info)} partitions with no extracted data.")
+
+    llm_results = call_gemini_api_for_session_pdfs(
+        [(pairs, unpaired, session_date) for _, _, _, pairs, unpaired in partition_inputs],
+        batch_size=SESSION_PROMPT_BATCH_SIZE)
+
+    for (partition_label, start_page, end_page, _, _), (extracted_data, llm_error) in zip(partition_inputs, llm_results):
+        try:
             if llm_error:
                 error_message = f"LLM API call failed: {llm_error}"
                 print(f"{partition_label}: {error_message}")
@@ -169,11 +423,33 @@ def extract_votes_from_session_pdf(session_pdf_path, session_date):
 # --- Step 2: Proposal Summary (Summarize Proposal Document with LLM) ---
 
 
-def summarize_proposal_text(proposal_document_path):
-    prompt = create_prompt_for_proposal_pdf()
+def summarize_proposal_texts(proposal_document_paths):
+    """
+    Summarizes several proposal documents, returning one (summary_data, error) tuple per path.
+    With BATCH_MODE the documents go through a single Gemini batch job, which is cheaper
+    but can take a long time to finish; otherwise they are summarized concurrently, several
+    documents per call (see PROPOSAL_BATCH_SIZE).
+    """
+    if not proposal_document_paths:
+        return []
+    if not BATCH_MODE:
+        for proposal_document_path in proposal_document_paths:
+            print(
+                f"  Summarizing proposal document: {proposal_document_path}")
+        responses = call_gemini_api_for_proposal_pdfs(proposal_document_paths)
+        return [normalize_proposal_summary(summary_data, error) for summary_data, error in responses]
+
+    prompt_text, response_schema = create_prompt_for_proposal_pdf()
+    print(f"  Summarizing {len(proposal_document_paths)} proposal documents in batch mode")
+    responses = run_batch([
+        {'prompt_text': prompt_text, 'document_path': path, 'expect_json': True, 'response_schema': response_schema,
+         'max_output_tokens': GEMINI_MAX_OUTPUT_TOKENS_PROPOSAL}
+        for path in proposal_document_paths])
+    return [normalize_proposal_summary(summary_data, error) for summary_data, error in responses]
+
 
-    summary_data, error = call_gemini_api(
-        prompt, document_path=proposal_document_path, expect_json=True)
+def normalize_proposal_summary(summary_data, error):
+    """Validates a proposal summary response and coerces its fields to the types stored in the DataFrame."""
     if error:
         return None, f"LLM API call failed for summary: {error}"
 
@@ -233,6 +509,18 @@ def run_pipeline(start_year=None, end_year=None, max_sessions_to_process=None, d
 
     init_directories()
     df = load_or_initialize_dataframe(dataframe_path)
+    # Workers update the dict-backed state; the DataFrame is only used for the analysis below
+    state = PipelineState(df)
+    logged_changes = read_update_log(dataframe_path)
+    if logged_changes:
+        # A previous run stopped before its final save: replay its checkpoints and
+        # fold them into the DataFrame file so row ids in new log entries line up again
+        print(f"Replaying {len(logged_changes)} row changes from the update log of an interrupted run.")
+        state.replay_changes(logged_changes)
+        df = state.to_dataframe()
+        if save_dataframe(df, dataframe_path):
+            clear_update_log(dataframe_path)
+            state = PipelineState(df)
     df_lock = Lock()
 
     processed_dates_in_df = set()
@@ -333,10 +621,11 @@ def run_pipeline(start_year=None, end_year=None, max_sessions_to_process=None, d
         print("Processing all sessions found from web (CSV empty or no relevant dates).")
 
     # Sort sessions: prioritize reprocessing dates from dates_to_reprocess, then by date.
-    if dates_to_reprocess:
-        sessions_to_process_infos.sort(key=lambda x: (str(x.get('date', '1900-01-01')) not in dates_to_reprocess, str(x.get('date', '1900-01-01')), x['url']))
-    else:
-        sessions_to_process_infos.sort(key=lambda x: (str(x.get('date', '1900-01-01')), x['url']))
+    def _session_sort_key(info):
+        session_date_str = str(info.get('date', '1900-01-01'))
+        return (session_date_str not in dates_to_reprocess, session_date_str, info['url'])
+
+    sessions_to_process_infos.sort(key=_session_sort_key)
 
     print(
         f"Total sessions to iterate through after filtering and sorting: {len(sessions_to_process_infos)}")
@@ -347,10 +636,101 @@ def run_pipeline(start_year=None, end_year=None, max_sessions_to_process=None, d
             f"Limiting processing to {max_sessions_to_process} sessions due to max_sessions_to_process limit.")
         sessions_to_actually_process = sessions_to_process_infos[:max_sessions_to_process]
 
+    # Start the heaviest sessions first so a large session does not become the straggler
+    # at the end of the run. Work is estimated from the proposal rows already known for
+    # the session, falling back to the size of its downloaded PDF (0 when unknown).
+    known_proposal_counts = df.loc[df['proposal_name_from_session'].notna(), 'session_pdf_url'].value_counts().to_dict()
+    known_pdf_paths = df.dropna(subset=['session_pdf_text_path']).drop_duplicates('session_pdf_url').set_index(
+        'session_pdf_url')['session_pdf_text_path'].to_dict()
+
+    def _estimated_session_work(info):
+        pdf_path = known_pdf_paths.get(info['url']) or os.path.join(
+            SESSION_PDF_DIR, generate_session_pdf_filename(info['url'], info.get('year')))
+        pdf_size = os.path.getsize(pdf_path) if os.path.exists(pdf_path) else 0
+        return (known_proposal_counts.get(info['url'], 0), pdf_size)
+
+    # sorted() is stable, so sessions with equal estimates keep their date order
+    sessions_to_actually_process = sorted(sessions_to_actually_process, key=_estimated_session_work, reverse=True)
+
+    # Stage 4 jobs of every session, as (proposal progress, document path), when BATCH_MODE defers them
+    deferred_stage4_jobs = []
+
+    def _apply_summary_result(progress, summary_data, summary_err):
+        """Records a Stage 4 outcome in a proposal's progress entry [row_idx, row, overall_status, summarize_status, final_updates]."""
+        final_updates = progress[4]
+        if summary_err:
+            final_updates.update({
+                'proposal_summarize_status': f'LLM Summary Failed: {summary_err}',
+                'last_error_message': summary_err,
+                'overall_status': 'Failed Stage 4 (LLM Summary)',
+            })
+        else:
+            try:
+                final_updates.update({
+                    'proposal_summary_general': summary_data['general_summary'],
+                    'proposal_summary_analysis': summary_data['critical_analysis'],
+                    'proposal_summary_fiscal_impact': summary_data['fiscal_impact'],
+                    'proposal_summary_colloquial': summary_data['colloquial_summary'],
+                    'proposal_category': summary_data['categories'],
+                    'proposal_short_title': summary_data['short_title'],
+                    'proposal_proposing_party': summary_data['proposing_party'],
+                    'proposal_summarize_status': 'Success',
+                    'overall_status': 'Success',
+                })
+            except (KeyError, TypeError) as e:
+                error_msg = f"Summary assignment error: {e}. Summary data types: {[(k, type(v)) for k, v in summary_data.items()]}"
+                print(f"Error in summary data assignment: {error_msg}")
+                final_updates.update({
+                    'proposal_summarize_status': f'Assignment Error: {str(e)}',
+                    'last_error_message': error_msg,
+                    'overall_status': 'Failed Stage 4 (Data Assignment)',
+                })
+        progress[2] = final_updates['overall_status']
+        progress[3] = final_updates['proposal_summarize_status']
+
+    def _finish_proposal(progress):
+        """Decides a proposal's final overall status and writes its collected updates to the state."""
+        row_idx, row, overall_status, summarize_status, final_updates = progress
+        is_pending_for_final_update = False
+        if overall_status is not None:
+            if overall_status in ['Pending Further Stages', 'Pending Stage 4']:
+                is_pending_for_final_update = True
+        elif overall_status is None:
+            is_pending_for_final_update = True
+
+        if is_pending_for_final_update:
+            is_summarize_success = summarize_status is not None and summarize_status == 'Success'
+
+            doc_dl_status_final = row['proposal_doc_download_status']
+            details_scrape_status_final = row['proposal_details_scrape_status']
+
+            if is_summarize_success:
+                final_updates['overall_status'] = 'Success'
+            else:
+                doc_not_success_final = True
+                if doc_dl_status_final is not None and doc_dl_status_final == 'Success':
+                    doc_not_success_final = False
+
+                details_scrape_is_success_variant_final = False
+                if details_scrape_status_final is not None and details_scrape_status_final in STAGE3_SUCCESS:
+                    details_scrape_is_success_variant_final = True
+
+                details_scrape_is_no_gov_link_final = False
+                if details_scrape_status_final is not None and details_scrape_status_final == 'No Gov Link':
+                    details_scrape_is_no_gov_link_final = True
+
+                if doc_not_success_final and details_scrape_is_success_variant_final:
+                    final_updates['overall_status'] = 'Completed (No Proposal Doc to Summarize)'
+                elif details_scrape_is_no_gov_link_final:
+                    final_updates['overall_status'] = 'Completed (No Gov Link for Details)'
+
+        with df_lock:
+            state.update_row(row_idx, final_updates)
+
     # Nested function to process a single session
-    def _process_single_session(session_info, df_obj, lock_obj, session_pdf_dir, proposal_doc_dir,
-                                pipeline_start_year, dates_to_reprocess_set,
-                                terminal_statuses, columns_func, dataframe_path):
+    # Everything besides session_info (state, df_lock, directories, dates to reprocess,
+    # terminal statuses, dataframe_path) is read from the enclosing run_pipeline scope
+    def _process_single_session(session_info):
 
         current_session_pdf_url = session_info['url']
         session_year = session_info.get('year')
@@ -369,9 +749,13 @@ def run_pipeline(start_year=None, end_year=None, max_sessions_to_process=None, d
                     if match:
                         session_year = int(match.group(1))
             except:
-                session_year = pipeline_start_year
+                session_year = _start_year
         if not session_date:
-            session_date = f"{session_year}-01-01" if session_year else f"{pipeline_start_year}-01-01"
+            session_date = f"{session_year}-01-01" if session_year else f"{_start_year}-01-01"
+
+        # Normalized once per session; reused by the Stage 3 and Stage 4 reprocess checks
+        session_date_key = str(session_date)
+        reprocess_this = session_date_key in dates_to_reprocess
 
         print(
             f"\n>>> Processing Session PDF URL: {current_session_pdf_url} (Year: {session_year}, Date: {session_date})")
@@ -379,25 +763,23 @@ def run_pipeline(start_year=None, end_year=None, max_sessions_to_process=None, d
         session_pdf_filename = generate_session_pdf_filename(
             current_session_pdf_url, session_year)
         session_pdf_local_path_for_download = os.path.join(
-            session_pdf_dir, session_pdf_filename)
+            SESSION_PDF_DIR, session_pdf_filename)
 
-        with lock_obj:
-            existing_rows_for_session_pdf = df_obj[df_obj['session_pdf_url']
-                                                   == current_session_pdf_url]
+        with df_lock:
+            existing_rows_for_session_pdf = state.session_rows(current_session_pdf_url)
 
         actual_session_pdf_disk_path = None
         session_pdf_download_status_for_df = 'Not Attempted'
         session_pdf_download_error_for_df = None
 
-        if not existing_rows_for_session_pdf.empty:
-            summary_rows = existing_rows_for_session_pdf[pd.isna(
-                existing_rows_for_session_pdf['proposal_name_from_session'])]
-            ref_row_candidates = summary_rows if not summary_rows.empty else existing_rows_for_session_pdf
+        if existing_rows_for_session_pdf:
+            summary_rows = [row for row in existing_rows_for_session_pdf
+                            if row['proposal_name_from_session'] is None]
+            ref_row_candidates = summary_rows if summary_rows else existing_rows_for_session_pdf
 
-            for _, ref_row in ref_row_candidates.iterrows():
-                is_download_success = pd.notna(
-                    ref_row['session_pdf_download_status']) and ref_row['session_pdf_download_status'] == 'Success'
-                path_exists = pd.notna(ref_row['session_pdf_text_path']) and os.path.exists(
+            for ref_row in ref_row_candidates:
+                is_download_success = ref_row['session_pdf_download_status'] is not None and ref_row['session_pdf_download_status'] == 'Success'
+                path_exists = ref_row['session_pdf_text_path'] is not None and os.path.exists(
                     ref_row['session_pdf_text_path'])
 
                 if is_download_success and path_exists:
@@ -407,8 +789,9 @@ def run_pipeline(start_year=None, end_year=None, max_sessions_to_process=None, d
                     session_pdf_download_status_for_df = 'Success'
                     break
 
-            if actual_session_pdf_disk_path is None and not ref_row_candidates.empty:
-                if any(pd.notna(status) and status == 'Success' for status in ref_row_candidates['session_pdf_download_status']):
+            if actual_session_pdf_disk_path is None:
+                if any(row['session_pdf_download_status'] is not None and row['session_pdf_download_status'] == 'Success'
+                       for row in ref_row_candidates):
                     print(
                         f"Session PDF {current_session_pdf_url} marked downloaded in CSV but file missing or path invalid. Re-downloading.")
 
@@ -422,42 +805,29 @@ def run_pipeline(start_year=None, end_year=None, max_sessions_to_process=None, d
                 session_pdf_download_status_for_df = 'Download Failed'
                 session_pdf_download_error_for_df = str(msg_or_path)
 
-                with lock_obj:
-                    placeholder_indices = df_obj[(df_obj['session_pdf_url'] == current_session_pdf_url) &
-                                                 (df_obj['proposal_name_from_session'].isna())].index
-
-                    if placeholder_indices.empty:
-                        new_idx = len(df_obj)
-                        df_obj.loc[new_idx,
-                                   'session_pdf_url'] = current_session_pdf_url
-                        df_obj.loc[new_idx, 'session_year'] = session_year
-                        df_obj.loc[new_idx, 'session_date'] = session_date
-                        for col in columns_func():
-                            if col not in ['session_pdf_url', 'session_year', 'session_date']:
-                                df_obj.loc[new_idx, col] = pd.NA
+                with df_lock:
+                    summary_idx = state.summary_index_map.get(current_session_pdf_url)
+
+                    failure_updates = {
+                        'session_pdf_download_status': session_pdf_download_status_for_df,
+                        'last_error_message': session_pdf_download_error_for_df,
+                        'overall_status': 'Failed Stage 1 (Session PDF Download)',
+                        'last_processed_timestamp': datetime.now().isoformat(),
+                    }
+
+                    if summary_idx is None:
+                        state.insert_row({
+                            **EMPTY_ROW,
+                            'session_pdf_url': current_session_pdf_url,
+                            'session_year': session_year,
+                            'session_date': session_date,
+                            **failure_updates,
+                        })
                     else:
-                        new_idx = placeholder_indices[0]
-
-                    df_obj.loc[new_idx,
-                               'session_pdf_download_status'] = session_pdf_download_status_for_df
-                    df_obj.loc[new_idx,
-                               'last_error_message'] = session_pdf_download_error_for_df
-                    df_obj.loc[new_idx,
-                               'overall_status'] = 'Failed Stage 1 (Session PDF Download)'
-                    df_obj.loc[new_idx, 'last_processed_timestamp'] = datetime.now(
-                    ).isoformat()
-
-                    other_indices = df_obj[(df_obj['session_pdf_url'] == current_session_pdf_url) &
-                                           (df_obj['proposal_name_from_session'].notna())].index
-                    for idx_other in other_indices:
-                        df_obj.loc[idx_other,
-                                   'session_pdf_download_status'] = session_pdf_download_status_for_df
-                        df_obj.loc[idx_other,
-                                   'last_error_message'] = session_pdf_download_error_for_df
-                        df_obj.loc[idx_other,
-                                   'overall_status'] = 'Failed Stage 1 (Session PDF Download)'
-                        df_obj.loc[idx_other, 'last_processed_timestamp'] = datetime.now(
-                        ).isoformat()
+                        state.update_row(summary_idx, failure_updates)
+
+                    for idx_other in state.proposal_row_ids(current_session_pdf_url):
+                        state.update_row(idx_other, failure_updates)
                 return  # End processing for this session
 
         proposals_from_llm = None
@@ -465,74 +835,62 @@ def run_pipeline(start_year=None, end_year=None, max_sessions_to_process=None, d
         session_parse_error_for_df = None
         run_stage2_llm_parse = True
 
-        with lock_obj:  # Protect read access to existing_rows_for_session_pdf for consistency
-            # Re-fetch or ensure existing_rows_for_session_pdf is consistent if df_obj could change between locks
-            existing_rows_for_session_pdf = df_obj[df_obj['session_pdf_url']
-                                                   == current_session_pdf_url]
-            if not existing_rows_for_session_pdf.empty:
-                summary_row_no_propostas_status = existing_rows_for_session_pdf[
-                    (pd.notna(existing_rows_for_session_pdf['session_parse_status'])) &
-                    (existing_rows_for_session_pdf['session_parse_status'] == 'LLM Parsed - No Propostas Encontradas') &
-                    (pd.isna(
-                        existing_rows_for_session_pdf['proposal_name_from_session']))
-                ]
-
-                proposal_rows = existing_rows_for_session_pdf[pd.notna(
-                    existing_rows_for_session_pdf['proposal_name_from_session'])]
-                all_proposal_rows_parsed_successfully = True
-                if not proposal_rows.empty:
-                    all_proposal_rows_parsed_successfully = all(
-                        pd.notna(status) and status == 'Success' for status in proposal_rows['session_parse_status'].dropna()
-                    )
-                else:
-                    all_proposal_rows_parsed_successfully = True
+        with df_lock:  # Protect read access to existing_rows_for_session_pdf for consistency
+            # Re-fetch the session's rows in case another stage changed them since the first read
+            existing_rows_for_session_pdf = state.session_rows(current_session_pdf_url)
+            if existing_rows_for_session_pdf:
+                has_no_propostas_summary_row = any(
+                    row['proposal_name_from_session'] is None and
+                    row['session_parse_status'] is not None and
+                    row['session_parse_status'] == 'LLM Parsed - No Propostas Encontradas'
+                    for row in existing_rows_for_session_pdf)
+
+                proposal_rows = [row for row in existing_rows_for_session_pdf
+                                 if row['proposal_name_from_session'] is not None]
+                all_proposal_rows_parsed_successfully = all(
+                    row['session_parse_status'] == 'Success' for row in proposal_rows
+                    if row['session_parse_status'] is not None)
 
                 any_row_parsed_successfully = any(
-                    pd.notna(status) and status == 'Success' for status in existing_rows_for_session_pdf['session_parse_status']
-                )
+                    row['session_parse_status'] is not None and row['session_parse_status'] == 'Success'
+                    for row in existing_rows_for_session_pdf)
 
-                if not summary_row_no_propostas_status.empty or \
-                   (not proposal_rows.empty and all_proposal_rows_parsed_successfully) or \
-                   (proposal_rows.empty and any_row_parsed_successfully):
+                if has_no_propostas_summary_row or \
+                   (proposal_rows and all_proposal_rows_parsed_successfully) or \
+                   (not proposal_rows and any_row_parsed_successfully):
 
                     print(
                         f"Session PDF {current_session_pdf_url} appears to be parsed previously. Reconstructing proposals from CSV if any.")
                     run_stage2_llm_parse = False
                     proposals_from_llm = []
-                    for _, row in existing_rows_for_session_pdf.iterrows():
-                        if pd.notna(row['proposal_name_from_session']):
-                            try:
-                                voting_summary_obj = json.loads(row['voting_details_json']) if pd.notna(
-                                    row['voting_details_json']) else None
-                            except json.JSONDecodeError:
-                                voting_summary_obj = None
-                            proposals_from_llm.append({
-                                'proposal_name': row['proposal_name_from_session'],
-                                'proposal_link': row['proposal_gov_link'],
-                                'voting_summary': voting_summary_obj,
-                                'proposal_approval_status': row['proposal_approval_status']
-                            })
-                    if not proposals_from_llm and not summary_row_no_propostas_status.empty:
+                    for row in proposal_rows:
+                        try:
+                            voting_summary_obj = json.loads(row['voting_details_json']) if row['voting_details_json'] is not None else None
+                        except json.JSONDecodeError:
+                            voting_summary_obj = None
+                        proposals_from_llm.append({
+                            'proposal_name': row['proposal_name_from_session'],
+                            'proposal_link': row['proposal_gov_link'],
+                            'voting_summary': voting_summary_obj,
+                            'proposal_approval_status': row['proposal_approval_status']
+                        })
+                    if not proposals_from_llm and has_no_propostas_summary_row:
                         session_parse_status_for_df = 'LLM Parsed - No Propostas Encontradas'
                     elif proposals_from_llm:
                         session_parse_status_for_df = 'Success'
-                    elif existing_rows_for_session_pdf['session_parse_status'].notna().any():
-                        session_parse_status_for_df = existing_rows_for_session_pdf['session_parse_status'].dropna().iloc[0] \
-                            if not existing_rows_for_session_pdf['session_parse_status'].dropna().empty else 'Unknown (Reconstructed)'
                     else:
-                        session_parse_status_for_df = 'Unknown (Reconstructed)'
+                        session_parse_status_for_df = next(
+                            (row['session_parse_status'] for row in existing_rows_for_session_pdf
+                             if row['session_parse_status'] is not None), 'Unknown (Reconstructed)')
 
         if run_stage2_llm_parse:
             print(
                 f"Running LLM parse for session PDF: {actual_session_pdf_disk_path}")
-            with lock_obj:
-                indices_to_drop = df_obj[(df_obj['session_pdf_url'] == current_session_pdf_url) &
-                                         (df_obj['proposal_name_from_session'].notna())].index
-                if not indices_to_drop.empty:
-                    print(
-                        f"Dropping {len(indices_to_drop)} old proposal entries for this session before re-parsing.")
-                    df_obj.drop(indices_to_drop, inplace=True)
-                    df_obj.reset_index(drop=True, inplace=True)
+            with df_lock:
+                dropped_count = state.drop_session_proposals(current_session_pdf_url)
+            if dropped_count:
+                print(
+                    f"Dropping {dropped_count} old proposal entries for this session before re-parsing.")
 
             print("This is the LLM Call for session PDF parsing.")
             proposals_from_llm, llm_error = extract_votes_from_session_pdf(
@@ -547,81 +905,54 @@ def run_pipeline(start_year=None, end_year=None, max_sessions_to_process=None, d
                 session_parse_status_for_df = 'Success'
 
         if session_parse_error_for_df or (session_parse_status_for_df == 'LLM Parsed - No Propostas Encontradas' and not proposals_from_llm):
-            with lock_obj:
-                summary_row_indices = df_obj[(df_obj['session_pdf_url'] == current_session_pdf_url) &
-                                             (df_obj['proposal_name_from_session'].isna())].index
-
-                summary_idx_to_update = -1
-                if not summary_row_indices.empty:
-                    summary_idx_to_update = summary_row_indices[0]
+            with df_lock:
+                summary_idx_to_update = state.summary_index_map.get(current_session_pdf_url)
+
+                summary_updates = {
+                    'session_year': session_year,
+                    'session_date': session_date,
+                    'session_pdf_text_path': actual_session_pdf_disk_path,
+                    'session_pdf_download_status': 'Success',
+                    'session_parse_status': session_parse_status_for_df,
+                    'last_error_message': session_parse_error_for_df,
+                    'overall_status': 'Failed Stage 2 (LLM Session Parse)' if session_parse_error_for_df else 'Completed (No Propostas)',
+                    'last_processed_timestamp': datetime.now().isoformat(),
+                }
+                if summary_idx_to_update is None:
+                    state.insert_row({**EMPTY_ROW, 'session_pdf_url': current_session_pdf_url, **summary_updates})
                 else:
-                    summary_idx_to_update = len(df_obj)
-                    df_obj.loc[summary_idx_to_update,
-                               'session_pdf_url'] = current_session_pdf_url
-                    for col in columns_func():
-                        if col not in ['session_pdf_url']:
-                            df_obj.loc[summary_idx_to_update, col] = pd.NA
-
-                df_obj.loc[summary_idx_to_update,
-                           'session_year'] = session_year
-                df_obj.loc[summary_idx_to_update,
-                           'session_date'] = session_date
-                df_obj.loc[summary_idx_to_update,
-                           'session_pdf_text_path'] = actual_session_pdf_disk_path
-                df_obj.loc[summary_idx_to_update,
-                           'session_pdf_download_status'] = 'Success'
-                df_obj.loc[summary_idx_to_update,
-                           'session_parse_status'] = session_parse_status_for_df
-                df_obj.loc[summary_idx_to_update,
-                           'last_error_message'] = session_parse_error_for_df
-                df_obj.loc[summary_idx_to_update,
-                           'overall_status'] = 'Failed Stage 2 (LLM Session Parse)' if session_parse_error_for_df else 'Completed (No Propostas)'
-                df_obj.loc[summary_idx_to_update,
-                           'last_processed_timestamp'] = datetime.now().isoformat()
+                    state.update_row(summary_idx_to_update, summary_updates)
 
                 if run_stage2_llm_parse:
-                    indices_to_drop = df_obj[(df_obj['session_pdf_url'] == current_session_pdf_url) &
-                                             (df_obj['proposal_name_from_session'].notna())].index
-                    if not indices_to_drop.empty:
-                        df_obj.drop(indices_to_drop, inplace=True)
-                        df_obj.reset_index(drop=True, inplace=True)
-                save_dataframe(df_obj, dataframe_path)
+                    state.drop_session_proposals(current_session_pdf_url)
+            checkpoint_dataframe(state, dataframe_path, df_lock)
             return  # End processing for this session
 
         if proposals_from_llm is None or (not proposals_from_llm and not run_stage2_llm_parse):
-            with lock_obj:
-                summary_row_indices = df_obj[(df_obj['session_pdf_url'] == current_session_pdf_url) &
-                                             (df_obj['proposal_name_from_session'].isna())].index
-                if not summary_row_indices.empty:
-                    summary_idx = summary_row_indices[0]
-                    current_overall_status_val = df_obj.loc[summary_idx,
-                                                            'overall_status']
-                    is_terminal = pd.notna(
-                        current_overall_status_val) and current_overall_status_val in terminal_statuses
-                    if pd.isna(current_overall_status_val) or not is_terminal:
-                        df_obj.loc[summary_idx,
-                                   'overall_status'] = 'Completed (No Propostas)'
-                        df_obj.loc[summary_idx,
-                                   'session_parse_status'] = session_parse_status_for_df
-                        df_obj.loc[summary_idx, 'last_processed_timestamp'] = datetime.now(
-                        ).isoformat()
+            with df_lock:
+                summary_idx = state.summary_index_map.get(current_session_pdf_url)
+                if summary_idx is not None:
+                    current_overall_status_val = state.rows[summary_idx]['overall_status']
+                    is_terminal = current_overall_status_val is not None and current_overall_status_val in TERMINAL_SUCCESS_STATUSES
+                    if current_overall_status_val is None or not is_terminal:
+                        state.update_row(summary_idx, {
+                            'overall_status': 'Completed (No Propostas)',
+                            'session_parse_status': session_parse_status_for_df,
+                            'last_processed_timestamp': datetime.now().isoformat(),
+                        })
                 else:
-                    summary_idx = len(df_obj)
-                    df_obj.loc[summary_idx,
-                               'session_pdf_url'] = current_session_pdf_url
-                    df_obj.loc[summary_idx, 'session_year'] = session_year
-                    df_obj.loc[summary_idx, 'session_date'] = session_date
-                    df_obj.loc[summary_idx,
-                               'session_pdf_text_path'] = actual_session_pdf_disk_path
-                    df_obj.loc[summary_idx,
-                               'session_pdf_download_status'] = 'Success'
-                    df_obj.loc[summary_idx,
-                               'session_parse_status'] = session_parse_status_for_df
-                    df_obj.loc[summary_idx,
-                               'overall_status'] = 'Completed (No Propostas)'
-                    df_obj.loc[summary_idx, 'last_processed_timestamp'] = datetime.now(
-                    ).isoformat()
-                save_dataframe(df_obj, dataframe_path)
+                    state.insert_row({
+                        **EMPTY_ROW,
+                        'session_pdf_url': current_session_pdf_url,
+                        'session_year': session_year,
+                        'session_date': session_date,
+                        'session_pdf_text_path': actual_session_pdf_disk_path,
+                        'session_pdf_download_status': 'Success',
+                        'session_parse_status': session_parse_status_for_df,
+                        'overall_status': 'Completed (No Propostas)',
+                        'last_processed_timestamp': datetime.now().isoformat(),
+                    })
+            checkpoint_dataframe(state, dataframe_path, df_lock)
             print(
                 f"No proposals found or reconstructed for {current_session_pdf_url}.")
             return  # End processing for this session
@@ -629,82 +960,75 @@ def run_pipeline(start_year=None, end_year=None, max_sessions_to_process=None, d
         print(
             f"Found/Reconstructed {len(proposals_from_llm)} proposals for {current_session_pdf_url}.")
 
+        # Upsert every proposal row first and decide which ones need a Stage 3 fetch
+        pending_proposals = []
         for proposal_data_from_llm in proposals_from_llm:
-            proposal_name = proposal_data_from_llm.get('proposal_name')
-            proposal_gov_link = proposal_data_from_llm.get('proposal_link')
-            voting_summary = proposal_data_from_llm.get('voting_summary')
-            approval_status_from_llm = proposal_data_from_llm.get(
-                'proposal_approval_status')
+            proposal_name, proposal_gov_link, voting_summary, approval_status_from_llm = (
+                proposal_data_from_llm.get(key) for key in
+                ('proposal_name', 'proposal_link', 'voting_summary', 'proposal_approval_status'))
+            processed_ts = datetime.now().isoformat()
 
             if not proposal_name:
                 print(
                     f"Skipping proposal with no name from LLM for session {current_session_pdf_url}")
                 continue
 
-            with lock_obj:
-                proposal_row_match_indices = df_obj[
-                    (df_obj['session_pdf_url'] == current_session_pdf_url) &
-                    (df_obj['proposal_name_from_session'] == proposal_name) &
-                    ((df_obj['proposal_gov_link'] == proposal_gov_link) if pd.notna(
-                        proposal_gov_link) else df_obj['proposal_gov_link'].isna())
-                ].index
-
-                row_idx = -1
-                if proposal_row_match_indices.empty:
-                    row_idx = len(df_obj)
-                    df_obj.loc[row_idx,
-                               'session_pdf_url'] = current_session_pdf_url
-                    df_obj.loc[row_idx, 'session_year'] = session_year
-                    df_obj.loc[row_idx,
-                               'proposal_name_from_session'] = proposal_name
-                    for col in columns_func():
-                        if col not in ['session_pdf_url', 'session_year', 'proposal_name_from_session']:
-                            df_obj.loc[row_idx, col] = pd.NA
-                else:
-                    row_idx = proposal_row_match_indices[0]
-
-                df_obj.loc[row_idx, 'session_date'] = session_date
-                df_obj.loc[row_idx,
-                           'session_pdf_text_path'] = actual_session_pdf_disk_path
-                df_obj.loc[row_idx, 'session_pdf_download_status'] = 'Success'
-                df_obj.loc[row_idx, 'proposal_gov_link'] = proposal_gov_link
-                df_obj.loc[row_idx, 'voting_details_json'] = json.dumps(
-                    voting_summary) if voting_summary else None
-                df_obj.loc[row_idx,
-                           'session_parse_status'] = session_parse_status_for_df
-                df_obj.loc[row_idx,
-                           'proposal_approval_status'] = approval_status_from_llm
-
-                current_overall_status = df_obj.loc[row_idx, 'overall_status']
-                is_current_overall_status_terminal = pd.notna(
-                    current_overall_status) and current_overall_status in terminal_statuses
-
-                if pd.isna(current_overall_status) or not is_current_overall_status_terminal:
-                    df_obj.loc[row_idx,
-                               'overall_status'] = 'Pending Further Stages'
-                    df_obj.loc[row_idx, 'last_error_message'] = pd.NA
-                    df_obj.loc[row_idx,
-                               'proposal_details_scrape_status'] = pd.NA
-                    df_obj.loc[row_idx, 'proposal_doc_download_status'] = pd.NA
-                    df_obj.loc[row_idx, 'proposal_summarize_status'] = pd.NA
-
-            # --- Stage 3: Get Proposal Details & Document ---
+            row_key = proposal_row_key(current_session_pdf_url, proposal_name, proposal_gov_link)
+            # Serialize before taking the lock so peers are not blocked on JSON encoding. The accented
+            # vote keys ("Abstenção", "Não Votaram") are written as UTF-8 instead of \u escapes
+            voting_json = (json.dumps(voting_summary, ensure_ascii=False, separators=(",", ":"))
+                           if voting_summary else None)
+            with df_lock:
+                row_idx = state.row_index_map.get(row_key)
+
+                row_updates = {
+                    'session_date': session_date,
+                    'session_pdf_text_path': actual_session_pdf_disk_path,
+                    'session_pdf_download_status': 'Success',
+                    'proposal_gov_link': proposal_gov_link,
+                    'voting_details_json': voting_json,
+                    'session_parse_status': session_parse_status_for_df,
+                    'proposal_approval_status': coerce_approval_status(approval_status_from_llm),
+                }
+
+                if row_idx is None:
+                    row_idx = state.insert_row({
+                        **EMPTY_ROW,
+                        'session_pdf_url': current_session_pdf_url,
+                        'session_year': session_year,
+                        'proposal_name_from_session': proposal_name,
+                    })
+                row = state.rows[row_idx]
+                current_overall_status = row['overall_status']
+
+                is_current_overall_status_terminal = current_overall_status is not None and current_overall_status in TERMINAL_SUCCESS_STATUSES
+
+                if current_overall_status is None or not is_current_overall_status_terminal:
+                    row_updates.update({
+                        'overall_status': 'Pending Further Stages',
+                        'last_error_message': None,
+                        'proposal_details_scrape_status': None,
+                        'proposal_doc_download_status': None,
+                        'proposal_summarize_status': None,
+                    })
+
+                state.update_row(row_idx, row_updates)
+
+            stage3_updates = {}
             needs_stage3_run = False
-            if pd.notna(proposal_gov_link) and isinstance(proposal_gov_link, str) and proposal_gov_link.startswith("http"):
-                current_scrape_status = df_obj.loc[row_idx,
-                                                   'proposal_details_scrape_status']
-                scrape_status_is_na = pd.isna(current_scrape_status)
+            if proposal_gov_link is not None and isinstance(proposal_gov_link, str) and proposal_gov_link.startswith("http"):
+                current_scrape_status = row['proposal_details_scrape_status']
+                scrape_status_is_na = current_scrape_status is None
 
                 is_terminal_status_for_stage3 = False
                 if not scrape_status_is_na:
-                    is_terminal_status_for_stage3 = current_scrape_status in [
-                        'Success', 'Success (No Doc Link)', 'No Gov Link', 'Fetch Failed']
+                    is_terminal_status_for_stage3 = current_scrape_status in TERMINAL_STAGE3
 
                 rerun_if_part_of_reprocessed_dates = False
                 # Check if current session's date is in dates being reprocessed
-                if str(session_date) in dates_to_reprocess_set:
+                if reprocess_this:
                     is_perfect_stage3_success = False
-                    if not scrape_status_is_na and current_scrape_status in ['Success', 'Success (No Doc Link)']:
+                    if not scrape_status_is_na and current_scrape_status in STAGE3_SUCCESS:
                         is_perfect_stage3_success = True
                     if not is_perfect_stage3_success:
                         rerun_if_part_of_reprocessed_dates = True
@@ -712,184 +1036,165 @@ def run_pipeline(start_year=None, end_year=None, max_sessions_to_process=None, d
                 if scrape_status_is_na or not is_terminal_status_for_stage3 or rerun_if_part_of_reprocessed_dates:
                     needs_stage3_run = True
             else:
-                current_overall_status_for_else = df_obj.loc[row_idx,
-                                                             'overall_status']
+                current_overall_status_for_else = row_updates.get('overall_status', current_overall_status)
                 update_overall_status_to_no_gov_link = False
-                if pd.notna(current_overall_status_for_else):
+                if current_overall_status_for_else is not None:
                     if current_overall_status_for_else == 'Pending Further Stages':
                         update_overall_status_to_no_gov_link = True
-                elif pd.isna(current_overall_status_for_else):
+                elif current_overall_status_for_else is None:
                     update_overall_status_to_no_gov_link = True
 
                 if update_overall_status_to_no_gov_link:
-                    df_obj.loc[row_idx,
-                               'overall_status'] = 'Completed (No Gov Link for Details)'
-                df_obj.loc[row_idx,
-                           'proposal_details_scrape_status'] = 'No Gov Link'
-
-            if needs_stage3_run:
+                    stage3_updates['overall_status'] = 'Completed (No Gov Link for Details)'
+                stage3_updates['proposal_details_scrape_status'] = 'No Gov Link'
+
+            pending_proposals.append(
+                (proposal_name, proposal_gov_link, processed_ts, row_idx, row, needs_stage3_run, stage3_updates))
+
+        # --- Stage 3: Get Proposal Details & Document ---
+        # The fetches are network-bound and independent, so they run concurrently on the run-wide
+        # fetch_executor, which caps the requests to the site across all sessions;
+        # rows are only updated from the collected results below.
+        fetch_futures = {}
+        for proposal_name, proposal_gov_link, _, row_idx, _, needs_stage3_run, _ in pending_proposals:
+            if needs_stage3_run and row_idx not in fetch_futures:
                 print(
                     f"  Fetching details for proposal: {proposal_name} from {proposal_gov_link}")
-                details_result = fetch_proposal_details_and_download_doc(
-                    proposal_gov_link, proposal_doc_dir)
-                df_obj.loc[row_idx,
-                           'proposal_authors_json'] = details_result['authors_json']
-                df_obj.loc[row_idx,
-                           'proposal_document_url'] = details_result['document_info']['link']
-                df_obj.loc[row_idx,
-                           'proposal_document_type'] = details_result['document_info']['type']
-                df_obj.loc[row_idx, 'proposal_document_local_path'] = details_result['document_info']['local_path']
-                df_obj.loc[row_idx, 'proposal_doc_download_status'] = details_result['document_info']['download_status']
-                df_obj.loc[row_idx,
-                           'proposal_details_scrape_status'] = details_result['scrape_status']
+                fetch_futures[row_idx] = fetch_executor.submit(
+                    fetch_proposal_details_and_download_doc, proposal_gov_link, PROPOSAL_DOC_DIR)
+
+        # Stage 4 summaries for the whole session are collected first so that they can be
+        # sent together (with BATCH_MODE, together with those of every other session, after
+        # all sessions are processed).
+        proposal_progress = []
+        stage4_jobs = []
+        progressed_row_ids = set()
+        for proposal_name, proposal_gov_link, processed_ts, row_idx, row, needs_stage3_run, stage3_updates in pending_proposals:
+            if row_idx in progressed_row_ids:
+                continue  # Same row listed twice in the session; its stages only run once
+            progressed_row_ids.add(row_idx)
+
+            # Read once and kept in step with every status this proposal is given below
+            overall_status = row['overall_status']
+            if needs_stage3_run:
+                details_result = fetch_futures[row_idx].result()
+                stage3_updates.update({
+                    'proposal_authors_json': details_result['authors_json'],
+                    'proposal_document_url': details_result['document_info']['link'],
+                    'proposal_document_type': details_result['document_info']['type'],
+                    'proposal_document_local_path': details_result['document_info']['local_path'],
+                    'proposal_doc_download_status': details_result['document_info']['download_status'],
+                    'proposal_details_scrape_status': details_result['scrape_status'],
+                })
 
                 if details_result['error'] and \
-                   (pd.isna(details_result['scrape_status']) or details_result['scrape_status'] != 'Success (No Doc Link)'):
-                    df_obj.loc[row_idx, 'last_error_message'] = str(
+                   (details_result['scrape_status'] is None or details_result['scrape_status'] != 'Success (No Doc Link)'):
+                    stage3_updates['last_error_message'] = str(
                         details_result['error'])
-                    df_obj.loc[row_idx,
-                               'overall_status'] = 'Failed Stage 3 (Proposal Details Scrape)'
-                elif pd.notna(df_obj.loc[row_idx, 'overall_status']) and df_obj.loc[row_idx, 'overall_status'] == 'Pending Further Stages':
-                    df_obj.loc[row_idx, 'overall_status'] = 'Pending Stage 4'
+                    stage3_updates['overall_status'] = 'Failed Stage 3 (Proposal Details Scrape)'
+                elif overall_status == 'Pending Further Stages':
+                    stage3_updates['overall_status'] = 'Pending Stage 4'
+
+            if stage3_updates:
+                overall_status = stage3_updates.get('overall_status', overall_status)
+                # Flushed before Stage 4 so a slow summary call does not hold back Stage 3 progress
+                with df_lock:
+                    state.update_row(row_idx, stage3_updates)
+
+            # Stage 4 and the final status are decided locally and written back together
+            final_updates = {'last_processed_timestamp': processed_ts}
+            summarize_status = row['proposal_summarize_status']
 
             # --- Stage 4: Summarize Proposal Document ---
             needs_stage4_run = False
-            doc_dl_status_s4 = df_obj.loc[row_idx,
-                                          'proposal_doc_download_status']
-            doc_is_successful_s4 = pd.notna(
-                doc_dl_status_s4) and doc_dl_status_s4 == 'Success'
+            doc_dl_status_s4 = row['proposal_doc_download_status']
+            doc_is_successful_s4 = doc_dl_status_s4 is not None and doc_dl_status_s4 == 'Success'
 
-            overall_status_s4_val = df_obj.loc[row_idx, 'overall_status']
             overall_status_s4_str = str(
-                overall_status_s4_val)  # Safe for startswith
+                overall_status)  # Safe for startswith
 
             if doc_is_successful_s4 and \
-               pd.notna(df_obj.loc[row_idx, 'proposal_document_local_path']) and \
+               row['proposal_document_local_path'] is not None and \
                not overall_status_s4_str.startswith('Failed Stage 3'):
 
-                current_summary_status_s4 = df_obj.loc[row_idx,
-                                                       'proposal_summarize_status']
-
                 force_rerun_summary_for_reprocessed_dates = False
                 # Check if current session's date is in dates being reprocessed
-                if str(session_date) in dates_to_reprocess_set:
-                    if pd.isna(current_summary_status_s4) or (pd.notna(current_summary_status_s4) and current_summary_status_s4 != 'Success'):
+                if reprocess_this:
+                    if summarize_status != 'Success':
                         force_rerun_summary_for_reprocessed_dates = True
 
-                if pd.isna(current_summary_status_s4) or \
-                   (pd.notna(current_summary_status_s4) and current_summary_status_s4 != 'Success') or \
+                if summarize_status != 'Success' or \
                    force_rerun_summary_for_reprocessed_dates:
                     needs_stage4_run = True
 
             if needs_stage4_run:
-                proposal_doc_disk_path_for_summary = df_obj.loc[row_idx,
-                                                                'proposal_document_local_path']
-                print(
-                    f"  Summarizing proposal document: {proposal_doc_disk_path_for_summary}")
-                summary_data, summary_err = summarize_proposal_text(
-                    proposal_doc_disk_path_for_summary)
-                if summary_err:
-                    df_obj.loc[row_idx,
-                               'proposal_summarize_status'] = f'LLM Summary Failed: {summary_err}'
-                    df_obj.loc[row_idx, 'last_error_message'] = summary_err
-                    df_obj.loc[row_idx,
-                               'overall_status'] = 'Failed Stage 4 (LLM Summary)'
-                else:
-                    try:
-                        df_obj.loc[row_idx,
-                                   'proposal_summary_general'] = summary_data['general_summary']
-                        df_obj.loc[row_idx,
-                                   'proposal_summary_analysis'] = summary_data['critical_analysis']
-                        df_obj.loc[row_idx,
-                                   'proposal_summary_fiscal_impact'] = summary_data['fiscal_impact']
-                        df_obj.loc[row_idx,
-                                   'proposal_summary_colloquial'] = summary_data['colloquial_summary']
-                        df_obj.loc[row_idx,
-                                   'proposal_category'] = summary_data['categories']
-                        df_obj.loc[row_idx,
-                                   'proposal_short_title'] = summary_data['short_title']
-                        df_obj.loc[row_idx,
-                                   'proposal_proposing_party'] = summary_data['proposing_party']
-                        df_obj.loc[row_idx,
-                                   'proposal_summarize_status'] = 'Success'
-                        df_obj.loc[row_idx, 'overall_status'] = 'Success'
-                    except ValueError as e:
-                        error_msg = f"DataFrame assignment error: {e}. Summary data types: {[(k, type(v)) for k, v in summary_data.items()]}"
-                        print(f"Error in summary data assignment: {error_msg}")
-                        df_obj.loc[row_idx, 'proposal_summarize_status'] = f'Assignment Error: {str(e)}'
-                        df_obj.loc[row_idx, 'last_error_message'] = error_msg
-                        df_obj.loc[row_idx, 'overall_status'] = 'Failed Stage 4 (Data Assignment)'
-
-            current_os_final = df_obj.loc[row_idx, 'overall_status']
-            is_pending_for_final_update = False
-            if pd.notna(current_os_final):
-                if current_os_final in ['Pending Further Stages', 'Pending Stage 4']:
-                    is_pending_for_final_update = True
-            elif pd.isna(current_os_final):
-                is_pending_for_final_update = True
-
-            if is_pending_for_final_update:
-                summarize_status_val = df_obj.loc[row_idx,
-                                                  'proposal_summarize_status']
-                is_summarize_success = pd.notna(
-                    summarize_status_val) and summarize_status_val == 'Success'
-
-                doc_dl_status_final = df_obj.loc[row_idx,
-                                                 'proposal_doc_download_status']
-                details_scrape_status_final = df_obj.loc[row_idx,
-                                                         'proposal_details_scrape_status']
-
-                if is_summarize_success:
-                    df_obj.loc[row_idx, 'overall_status'] = 'Success'
-                else:
-                    doc_not_success_final = True
-                    if pd.notna(doc_dl_status_final) and doc_dl_status_final == 'Success':
-                        doc_not_success_final = False
-
-                    details_scrape_is_success_variant_final = False
-                    if pd.notna(details_scrape_status_final) and details_scrape_status_final in ['Success', 'Success (No Doc Link)']:
-                        details_scrape_is_success_variant_final = True
-
-                    details_scrape_is_no_gov_link_final = False
-                    if pd.notna(details_scrape_status_final) and details_scrape_status_final == 'No Gov Link':
-                        details_scrape_is_no_gov_link_final = True
-
-                    if doc_not_success_final and details_scrape_is_success_variant_final:
-                        df_obj.loc[row_idx,
-                                   'overall_status'] = 'Completed (No Proposal Doc to Summarize)'
-                    elif details_scrape_is_no_gov_link_final:
-                        df_obj.loc[row_idx,
-                                   'overall_status'] = 'Completed (No Gov Link for Details)'
-
-            df_obj.loc[row_idx,
-                       'last_processed_timestamp'] = datetime.now().isoformat()
-            save_dataframe(df_obj, dataframe_path)
-        # End of for proposal_data_from_llm in proposals_from_llm
+                stage4_jobs.append(
+                    (len(proposal_progress), row['proposal_document_local_path']))
+            proposal_progress.append(
+                [row_idx, row, overall_status, summarize_status, final_updates])
+
+        if BATCH_MODE:
+            # The summaries of every session go out as one batch job once all sessions are done
+            with df_lock:
+                deferred_stage4_jobs.extend(
+                    (proposal_progress[progress_index], doc_path) for progress_index, doc_path in stage4_jobs)
+            deferred_progress_indices = {progress_index for progress_index, _ in stage4_jobs}
+        else:
+            summary_results = summarize_proposal_texts(
+                [doc_path for _, doc_path in stage4_jobs])
+            for (progress_index, _), (summary_data, summary_err) in zip(stage4_jobs, summary_results):
+                _apply_summary_result(proposal_progress[progress_index], summary_data, summary_err)
+            deferred_progress_indices = set()
+
+        for progress_index, progress in enumerate(proposal_progress):
+            if progress_index not in deferred_progress_indices:
+                _finish_proposal(progress)
+        # End of for pending proposal in pending_proposals
+
+        checkpoint_dataframe(state, dataframe_path, df_lock)
     # End of _process_single_session function
 
-    # Prepare arguments for starmap
-    starmap_args = []
-    for s_info in sessions_to_actually_process:
-        starmap_args.append((
-            s_info, df, df_lock,
-            SESSION_PDF_DIR, PROPOSAL_DOC_DIR, _start_year,
-            dates_to_reprocess, TERMINAL_SUCCESS_STATUSES,
-            get_dataframe_columns,  # Pass the function itself
-            dataframe_path  # Pass the dataframe path
-        ))
-
-    with ThreadPoolExecutor(max_workers=NUM_THREADS) as executor:
-        # Use executor.map with a lambda to unpack arguments for _process_single_session
-        results = list(executor.map(
-            lambda p: _process_single_session(*p), starmap_args))
-        # results will contain None for each call as _process_single_session doesn't explicitly return a value other than early exits.
-        # Error handling within _process_single_session updates the DataFrame.
-        # If _process_single_session could raise exceptions that aren't caught, they would surface here.
+    # Cap queued work so only a bounded number of sessions is in flight at once
+    max_in_flight = NUM_THREADS * 2
+    session_count = len(sessions_to_actually_process)
+    completed_count = 0
+    try:
+        with ThreadPoolExecutor(max_workers=PROPOSAL_FETCH_THREADS) as fetch_executor, \
+                ThreadPoolExecutor(max_workers=NUM_THREADS) as executor:
+            # Error handling within _process_single_session updates the state; anything it does
+            # not catch is re-raised by future.result() as soon as that session is collected,
+            # which happens while later sessions are still being submitted.
+            in_flight = set()
+            for s_info in sessions_to_actually_process:
+                if len(in_flight) >= max_in_flight:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                        completed_count += 1
+                        print(f"--- Completed {completed_count}/{session_count} sessions ---")
+                in_flight.add(executor.submit(_process_single_session, s_info))
+
+            for future in as_completed(in_flight):
+                future.result()
+                completed_count += 1
+                print(f"--- Completed {completed_count}/{session_count} sessions ---")
+
+        if deferred_stage4_jobs:
+            summary_results = summarize_proposal_texts([doc_path for _, doc_path in deferred_stage4_jobs])
+            for (progress, _), (summary_data, summary_err) in zip(deferred_stage4_jobs, summary_results):
+                _apply_summary_result(progress, summary_data, summary_err)
+                _finish_proposal(progress)
+    finally:
+        # Throttled checkpoints may have skipped the latest updates; always flush them
+        checkpoint_dataframe(state, dataframe_path, df_lock, force=True)
 
     print("\n--- Pipeline Run Finished ---")
+    df = state.to_dataframe()
+    export_dataframe_csv(df, dataframe_path)  # Parquet is the working checkpoint; keep a CSV copy
     if not df.empty:
         print("Overall Status Counts:")
-        print(df['overall_status'].value_counts(dropna=False))
+        status_counts = df['overall_status'].value_counts(dropna=False)
+        print(status_counts[status_counts > 0])  # Known categories that never occur are counted as 0
     else:
         print("DataFrame is empty.")
 
@@ -906,11 +1211,18 @@ if __name__ == "__main__":
     parser.add_argument(
         '--session-start-date', '-s', type=str, help="Only process sessions on or after this date (YYYY-MM-DD format). Filters both web sessions and reprocessing dates from CSV.", default=None
     )
+    parser.add_argument(
+        '--batch', action='store_true', help="Summarize proposals through the Gemini batch endpoint (about half the cost, but can take hours; for backfills)"
+    )
 
     args = parser.parse_args()
+    # Gemini client messages go through logging; plain format so they read like the pipeline's prints
+    logging.basicConfig(level=LOG_LEVEL, format="%(message)s")
     year_to_use = args.year
     year_to_end = args.year_end
     session_start_date = args.session_start_date
-    dataframe_path_to_use = f"data/parliament_data_{year_to_use}.csv"
+    if args.batch:
+        BATCH_MODE = True
+    dataframe_path_to_use = f"data/parliament_data_{year_to_use}.parquet"
 
     run_pipeline(start_year=year_to_use, end_year=year_to_end, max_sessions_to_process=None, dataframe_path=dataframe_path_to_use, session_start_date=session_start_date)
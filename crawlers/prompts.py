@@ -1,45 +1,159 @@
 import os
 import json
+import logging
+import mmap
+import random
+import re
 import time
 import asyncio
+import bisect
+import collections
+import functools
+import hashlib
+import textwrap
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
-from google import genai
+from types import SimpleNamespace
 
 
 from config import *
+from llm_cache import SQLiteResponseCache
 
+try:
+    import orjson  # Faster decoding of large Gemini responses; optional
+except ImportError:
+    orjson = None
 
-genai_client = genai.Client(api_key=GEMINI_API_KEY) if GEMINI_API_KEY else None
 
+log = logging.getLogger(__name__)
 
-def create_prompt_for_session_pdf(hyperlink_table_pairs, unpaired_links, session_date):
-    session_date = date.fromisoformat(session_date)
-    response_schema = build_response_schema()
-    pre_2020 = session_date is None or session_date < date(2020, 1, 1)
+@functools.cache
+def _client():
+    """The Gemini client, created on first use so that importing this module does not load the SDK."""
+    if not GEMINI_API_KEY:
+        return None
+    from google import genai
+    return genai.Client(api_key=GEMINI_API_KEY)
+
+
+@functools.cache
+def _types():
+    """The google.genai.types module, imported on first use."""
+    from google.genai import types
+    return types
+
+
+# Codes carried by the errors call_gemini_api returns, so callers can tell transient failures apart
+GEMINI_ERROR_RATE_LIMITED = 'rate_limited'
+GEMINI_ERROR_UNAVAILABLE = 'unavailable'
+GEMINI_ERROR_TIMEOUT = 'timeout'
+GEMINI_ERROR_INVALID_REQUEST = 'invalid_request'
+GEMINI_ERROR_BAD_RESPONSE = 'bad_response'
+
+
+class GeminiError(str):
+    """
+    Error message returned by call_gemini_api. It is a plain string for every existing use
+    (logging, f-strings, the DataFrame) and additionally carries one of the GEMINI_ERROR_* codes.
+    """
+
+    def __new__(cls, message, code):
+        error = super().__new__(cls, message)
+        error.code = code
+        return error
+
+
+def create_prompt_parts_for_session_pdf(hyperlink_table_pairs, unpaired_links, session_date):
+    """
+    Splits the session prompt into a system instruction, holding all of the static template
+    text, and the message contents, holding only the session's structured data and MP counts
+    as Gemini Parts. Returns (system_instruction, parts). The system instruction and the MP
+    counts Part repeat across sessions and are reused.
+    """
+    template_key, structured_data_text, mp_counts_text = _session_prompt_inputs(
+        hyperlink_table_pairs, unpaired_links, session_date)
+    parts = [_types().Part.from_text(text=structured_data_text), _static_prompt_part(mp_counts_text)]
+    return _SESSION_SYSTEM_INSTRUCTIONS[template_key], parts
+
+
+@functools.lru_cache(maxsize=64)
+def _static_prompt_part(text):
+    return _types().Part.from_text(text=text)
+
+
+def _session_prompt_inputs(hyperlink_table_pairs, unpaired_links, session_date):
+    """Returns (template key, structured data text, MP counts text) for a session prompt."""
+    template_key, pre_2020, mp_counts_text = _session_context(session_date)
     structured_data_text = format_structured_data_for_llm(
         hyperlink_table_pairs, unpaired_links, pre_2020)
-    mp_counts_text = build_mp_counts_text(session_date)
+    return template_key, structured_data_text, mp_counts_text
 
+
+@functools.lru_cache(maxsize=256)
+def _session_context(session_date):
+    """
+    Everything in a session prompt that depends only on the date, as (template key, pre_2020
+    data layout, MP counts text). A run covers many PDFs from a few hundred dates at most.
+    """
+    session_date = _to_date(session_date)
+    pre_2020 = session_date is None or session_date < date(2020, 1, 1)
     if session_date is None or session_date >= date(2020, 4, 25):
-        return create_prompt_for_session_pdf_post_2020(structured_data_text, mp_counts_text)#, response_schema
+        template_key = 'post_2020'
     else:
-        return create_prompt_for_session_pdf_pre_2020(structured_data_text, mp_counts_text)#, response_schema
+        template_key = 'pre_2020'
+    return template_key, pre_2020, build_mp_counts_text(session_date)
 
 
-def create_prompt_for_session_pdf_pre_2020(structured_data_text, mp_counts_text):
-    """
-    Creates a prompt for the LLM to extract proposal voting data from pre-2020 session PDFs.
-    These PDFs list parties that voted For/Against/Abstained, without detailed tables.
-    MP counts are provided based on the session_date.
-    """
+def _to_date(value):
+    """Returns value as a date: dates pass through, ISO strings are parsed, anything else is None."""
+    if isinstance(value, date):
+        return value
+    try:
+        return date.fromisoformat(value)
+    except (ValueError, TypeError):
+        return None
+
+
+# Few-shot example shared by both session prompts, one compact JSON object per line; what each
+# object illustrates is explained in the prompt text below it
+_SESSION_EXAMPLE_VOTES = {
+    "PS": {"Favor": 100, "Contra": 0, "Abstenção": 5, "Não Votaram": 2, "TotalDeputados": 107},
+    "PSD": {"Favor": 0, "Contra": 65, "Abstenção": 0, "Não Votaram": 1, "TotalDeputados": 66},
+}
+_SESSION_EXAMPLE = [
+    {
+        "proposal_name": "Projeto de Lei 123/XV/2",
+        "proposal_link": "https://www.parlamento.pt/ActividadeParlamentar/Paginas/DetalheIniciativa.aspx?BID=XXXXX",
+        "voting_summary": _SESSION_EXAMPLE_VOTES,
+        "proposal_approval_status": 1,
+    },
+    {
+        "proposal_name": "Alteração ao Projeto de Lei 123/XV/2",
+        "proposal_link": "https://www.parlamento.pt/ActividadeParlamentar/Paginas/DetalheIniciativa.aspx?BID=YYYYY",
+        "voting_summary": _SESSION_EXAMPLE_VOTES,
+        "proposal_approval_status": 1,
+    },
+    {
+        "proposal_name": "Voto de Pesar XYZ",
+        "proposal_link": "https://www.parlamento.pt/ActividadeParlamentar/Paginas/DetalheIniciativa.aspx?BID=ZZZZZ",
+        "voting_summary": None,
+        "proposal_approval_status": 1,
+    },
+]
+_SESSION_EXAMPLE_JSON = "[\n" + ",\n".join(
+    json.dumps(item, ensure_ascii=False, separators=(",", ":")) for item in _SESSION_EXAMPLE) + "\n]"
+
 
-    prompt = f"""Você está analisando um registro de votações parlamentares portuguesas de um período anterior a 2020. Os dados de votação neste formato não usam tabelas, mas sim listas textuais de partidos que votaram a favor, contra ou se abstiveram. Ocasionalmente, um 'APPROVAL TEXT' é fornecido, indicando o resultado da votação (ex: "Aprovado", "Rejeitado").
+# Static text of the pre-2020 session prompt, around the structured data and the MP counts
+_PRE2020_HEAD = """Você está analisando um registro de votações parlamentares portuguesas de um período anterior a 2020. Os dados de votação neste formato não usam tabelas, mas sim listas textuais de partidos que votaram a favor, contra ou se abstiveram. Ocasionalmente, um 'APPROVAL TEXT' é fornecido, indicando o resultado da votação (ex: "Aprovado", "Rejeitado").
 
 Os dados estruturados fornecidos (`structured_data_text`) contêm excertos de texto do PDF, cada um descrevendo uma ou mais propostas e como os partidos votaram. Um exemplo de como uma proposta pode ser descrita no texto:
 "Projeto de Resolução n.º 958/XIII/2.ª (PCP) – Pela reabertura do Serviço de Urgência Básica no Hospital de Espinho; Favor – BE, PCP, PEV e PAN; Contra – Aprovado; Abstenção – PSD, PS e CDS-PP"
 Note que "Contra – Aprovado" significa que a proposta foi aprovada, e a lista de partidos que votaram contra pode não estar explícita ou ser inferida. O 'APPROVAL TEXT' quando disponível, pode clarificar o resultado.
 
-{structured_data_text}
+"""
+_PRE2020_MID = """
 
 Com base nestes dados estruturados, crie um array JSON onde cada elemento representa UMA proposta que foi votada.
 
@@ -49,13 +163,14 @@ Para cada proposta, extraia:
     2. 'proposal_link': O URI/hiperlink para esta proposta. Isso vem do 'URI' do hiperlink.
     3.  'voting_summary': O detalhamento da votação por partido.
         -   Analise as menções "Favor –", "Contra –", "Abstenção –" para identificar os partidos.
-        -   Use o formato: {{"NomeDoPartido": {{"Favor": X, "Contra": Y, "Abstenção": Z, "Não Votaram": W, "TotalDeputados": Total}}}}
+        -   Use o formato: {"NomeDoPartido": {"Favor": X, "Contra": Y, "Abstenção": Z, "Não Votaram": W, "TotalDeputados": Total}}
         -   Utilize a contagem de deputados fornecida abaixo para o período da sessão para determinar X, Y, Z, W e Total.
         -   Se um partido está listado em "Favor", todos os seus deputados são contados como "Favor". O mesmo para "Contra" e "Abstenção".
         -   Se um partido não é mencionado em nenhuma lista de votação para uma proposta, ele não deve ser incluído no 'voting_summary' dessa proposta.
     4. 'proposal_approval_status': Um inteiro, 1 se a proposta foi aprovada, 0 se foi rejeitada. Utilize o campo 'APPROVAL TEXT' (se fornecido nos dados estruturados) como principal indicador para este status. Se 'APPROVAL TEXT' indicar "Aprovado" (ou variações), defina como 1. Se indicar "Rejeitado" ou "Prejudicado" (ou variações), defina como 0. Se não estiver claro ou 'APPROVAL TEXT' estiver ausente, infira do 'voting_summary' se possível, caso contrário defina como nulo.
 
-{mp_counts_text}
+"""
+_PRE2020_TAIL = """
 
 
     Notas importantes:
@@ -71,46 +186,20 @@ Para cada proposta, extraia:
     Se você não conseguir determinar as informações de votação para uma proposta, ainda a inclua com seu 'proposal_name' e 'proposal_link', mas defina 'voting_summary' como nulo e 'proposal_approval_status' como nulo (a menos que 'APPROVAL TEXT' indique claramente o status).
 
 Formato de exemplo de um objeto no array JSON (assumindo dados da XIII Legislatura para o exemplo de contagem):
-    [
-    {{ // Do grupo, primeiro hiperlink
-        "proposal_name": "Projeto de Lei 123/XV/2",
-        "proposal_link": "https://www.parlamento.pt/ActividadeParlamentar/Paginas/DetalheIniciativa.aspx?BID=XXXXX",
-        "voting_summary": {{ 
-        "PS": {{"Favor": 100, "Contra": 0, "Abstenção": 5, "Não Votaram": 2, "TotalDeputados": 107}},
-        "PSD": {{"Favor": 0, "Contra": 65, "Abstenção": 0, "Não Votaram": 1, "TotalDeputados": 66}}
-        }},
-        "proposal_approval_status": 1 // Inferido do voting_summary ou do APPROVAL TEXT
-    }},
-    {{ // Do mesmo grupo, segundo hiperlink (assumindo que é outra proposta válida relacionada à mesma conclusão)
-        "proposal_name": "Alteração ao Projeto de Lei 123/XV/2",
-        "proposal_link": "https://www.parlamento.pt/ActividadeParlamentar/Paginas/DetalheIniciativa.aspx?BID=YYYYY",
-        "voting_summary": {{
-        "PS": {{"Favor": 100, "Contra": 0, "Abstenção": 5, "Não Votaram": 2, "TotalDeputados": 107}},
-        "PSD": {{"Favor": 0, "Contra": 65, "Abstenção": 0, "Não Votaram": 1, "TotalDeputados": 66}}
-        }},
-        "proposal_approval_status": 1 // Inferido do voting_summary ou do APPROVAL TEXT
-    }},
-    {{ // Uma proposta não pareada, com APPROVAL TEXT
-        "proposal_name": "Voto de Pesar XYZ",
-        "proposal_link": "https://www.parlamento.pt/ActividadeParlamentar/Paginas/DetalheIniciativa.aspx?BID=ZZZZZ",
-        "voting_summary": null, // Pode ser inferido se APPROVAL TEXT for "Aprovado por Unanimidade"
-        "proposal_approval_status": 1 // Derivado do APPROVAL TEXT: "Aprovado por unanimidade"
-    }}
-    ]
+    """ + _SESSION_EXAMPLE_JSON + """
+    Notas sobre o exemplo:
+    - Objetos 1 e 2: hiperlinks do mesmo grupo (o segundo assumido como outra proposta válida relacionada à mesma conclusão); 'proposal_approval_status' inferido do voting_summary ou do APPROVAL TEXT.
+    - Objeto 3: proposta não pareada com APPROVAL TEXT "Aprovado por unanimidade", do qual deriva 'proposal_approval_status'; o 'voting_summary' pode ser inferido nesse caso.
 """
-    return prompt
-
 
-def create_prompt_for_session_pdf_post_2020(structured_data_text, mp_counts_text):
 
-    # print("---------------------The structured data text is:")
-    # print(structured_data_text)
-
-    prompt = f"""Você está analisando um registro de votações parlamentares portuguesas. Eu já extraí dados estruturados de propostas do PDF. Estes dados consistem em:
+# Static text of the post-2020 session prompt, around the structured data and the MP counts
+_POST2020_HEAD = """Você está analisando um registro de votações parlamentares portuguesas. Eu já extraí dados estruturados de propostas do PDF. Estes dados consistem em:
     1. Grupos de propostas: Cada grupo contém um ou mais hiperlinks (propostas) que *aparentam estar* associados a uma única tabela de votação encontrada após eles na mesma página. Cada grupo também pode ter um 'APPROVAL TEXT' associado, que é uma linha de texto como "Aprovado" ou "Rejeitado" encontrada perto da tabela.
     2. Propostas não pareadas: Estes são hiperlinks que não tinham uma tabela imediatamente a seguir. Eles também podem ter um 'APPROVAL TEXT' associado.
 
-    {structured_data_text}
+    """
+_POST2020_MID = """
 
     Com base nestes dados estruturados, crie um array JSON onde cada elemento representa UMA proposta (hiperlink) que foi votada.
     **A associação de hiperlinks a tabelas é uma tentativa baseada na proximidade no documento. Nem todos os hiperlinks listados acima de uma tabela pertencem necessariamente a essa votação; alguns podem ser de outros contextos. O modelo deve analisar criticamente para determinar a relevância.**
@@ -130,12 +219,13 @@ def create_prompt_for_session_pdf_post_2020(structured_data_text, mp_counts_text
     4. 'proposal_approval_status': Um inteiro, 1 se a proposta foi aprovada, 0 se foi rejeitada. Utilize o campo 'APPROVAL TEXT' (se fornecido nos dados estruturados para o grupo ou para a proposta individual) como principal indicador para este status. Se 'APPROVAL TEXT' indicar "Aprovado" (ou variações), defina como 1. Se indicar "Rejeitado" ou "Prejudicado" (ou variações), defina como 0. Se não estiver claro ou 'APPROVAL TEXT' estiver ausente, infira do 'voting_summary' (se disponível e conclusivo), caso contrário defina como nulo.
 
 
-{mp_counts_text}
+"""
+_POST2020_TAIL = """
 
 
     Para o formato de voting_summary:
     - Se houver uma tabela de votação: Analise a tabela para extrair as contagens de votos para cada partido.
-    - Use o formato: {{"NomeDoPartido": {{"Favor": X, "Contra": Y, "Abstenção": Z, "Não Votaram": W, "TotalDeputados": Total}}}}
+    - Use o formato: {"NomeDoPartido": {"Favor": X, "Contra": Y, "Abstenção": Z, "Não Votaram": W, "TotalDeputados": Total}}
     - Se a tabela usar marcas 'X': A marca 'X' indica que todos os MPs daquele partido votaram daquela maneira. Use o número total mostrado para aquele partido, se disponível, caso contrário, infira com base nos tamanhos típicos dos partidos, se necessário (menos ideal).
     - Se não houver tabela individual, mas o 'APPROVAL TEXT' indicar aprovação unânime (ex: "Aprovado por unanimidade"): Indique a votação unânime com as distribuições de partido apropriadas, se puder inferi-las, ou marque como unânime. Se o 'APPROVAL TEXT' apenas disser "Aprovado", e não houver tabela, o 'voting_summary' pode permanecer nulo, mas 'proposal_approval_status' será 1.
 
@@ -151,370 +241,1445 @@ def create_prompt_for_session_pdf_post_2020(structured_data_text, mp_counts_text
     Se você não conseguir determinar as informações de votação para uma proposta, ainda a inclua com seu 'proposal_name' e 'proposal_link', mas defina 'voting_summary' como nulo. O 'proposal_approval_status' deve ser definido com base no 'APPROVAL TEXT' se disponível, caso contrário, nulo.
 
     Formato de exemplo (ilustrando um grupo de duas propostas compartilhando uma tabela e APPROVAL TEXT, e uma proposta não pareada com APPROVAL TEXT):
-    [
-    {{ // Do grupo, primeiro hiperlink (assumindo que é uma proposta válida relacionada à tabela)
-        "proposal_name": "Projeto de Lei 123/XV/2",
-        "proposal_link": "https://www.parlamento.pt/ActividadeParlamentar/Paginas/DetalheIniciativa.aspx?BID=XXXXX",
-        "voting_summary": {{ // Derivado da tabela compartilhada
-        "PS": {{"Favor": 100, "Contra": 0, "Abstenção": 5, "Não Votaram": 2, "TotalDeputados": 107}},
-        "PSD": {{"Favor": 0, "Contra": 65, "Abstenção": 0, "Não Votaram": 1, "TotalDeputados": 66}}
-        }},
-        "proposal_approval_status": 1 // Derivado do APPROVAL TEXT do grupo ou da tabela
-    }},
-    {{ // Do mesmo grupo, segundo hiperlink (assumindo que é outra proposta válida relacionada à mesma tabela)
-        "proposal_name": "Alteração ao Projeto de Lei 123/XV/2",
-        "proposal_link": "https://www.parlamento.pt/ActividadeParlamentar/Paginas/DetalheIniciativa.aspx?BID=YYYYY",
-        "voting_summary": {{ // Derivado DA MESMA tabela compartilhada que acima
-        "PS": {{"Favor": 100, "Contra": 0, "Abstenção": 5, "Não Votaram": 2, "TotalDeputados": 107}},
-        "PSD": {{"Favor": 0, "Contra": 65, "Abstenção": 0, "Não Votaram": 1, "TotalDeputados": 66}}
-        }},
-        "proposal_approval_status": 1 // Derivado do APPROVAL TEXT do grupo ou da tabela
-    }},
-    {{ // Uma proposta não pareada com APPROVAL TEXT
-        "proposal_name": "Voto de Pesar XYZ",
-        "proposal_link": "https://www.parlamento.pt/ActividadeParlamentar/Paginas/DetalheIniciativa.aspx?BID=ZZZZZ",
-        "voting_summary": null, // Ou inferido se APPROVAL TEXT for "Aprovado por Unanimidade"
-        "proposal_approval_status": 1 // Derivado do APPROVAL TEXT: "Aprovado"
-    }}
-    ]
+    """ + _SESSION_EXAMPLE_JSON + """
+    Notas sobre o exemplo:
+    - Objetos 1 e 2: hiperlinks do mesmo grupo, assumidos como propostas válidas relacionadas à tabela; ambos têm o voting_summary derivado DA MESMA tabela compartilhada e o status derivado do APPROVAL TEXT do grupo ou da tabela.
+    - Objeto 3: proposta não pareada com APPROVAL TEXT "Aprovado", do qual deriva 'proposal_approval_status'; o 'voting_summary' é nulo, ou inferido se o APPROVAL TEXT for "Aprovado por Unanimidade".
     """
-    return prompt
 
 
-def create_prompt_for_proposal_pdf():
-    prompt = """Analise este documento, que é uma proposta governamental votada no Parlamento português e, portanto, repleta de linguagem jurídica. Forneça uma resposta JSON estruturada. O idioma de todas as strings de texto na resposta JSON deve ser o português de Portugal."""
+# Session prompt templates as (head, mid, tail) around the structured data and the MP counts
+_SESSION_PROMPT_TEMPLATES = {
+    'pre_2020': (_PRE2020_HEAD, _PRE2020_MID, _PRE2020_TAIL),
+    'post_2020': (_POST2020_HEAD, _POST2020_MID, _POST2020_TAIL),
+}
+
+# The same templates as system instructions, for calls that send the per-session data on its own
+_SESSION_DATA_NOTE = "Os dados estruturados e a composição parlamentar desta sessão são enviados na mensagem do utilizador."
+_SESSION_SYSTEM_INSTRUCTIONS = {
+    template_key: "\n\n".join(text.strip() for text in (head, _SESSION_DATA_NOTE, mid, tail))
+    for template_key, (head, mid, tail) in _SESSION_PROMPT_TEMPLATES.items()
+}
+
+
+def _output_token_cap(tokens_per_item, item_count):
+    """Output token budget for a call answering item_count items, within the model's own limit."""
+    return min(tokens_per_item * item_count, GEMINI_MAX_OUTPUT_TOKENS_LIMIT)
+
+
+# Instructions for a batched session call, added to the template's own system instruction
+_SESSION_BATCH_NOTE = """A mensagem do utilizador contém vários registos de votação independentes, cada um delimitado por "=== ROW i BEGIN ===" e "=== ROW i END ===" e com os seus próprios dados estruturados e composição parlamentar. Aplique as instruções acima a cada ROW separadamente, sem misturar dados entre ROWs.
 
-    response_schema = {
+Retorne um array JSON com um objeto por ROW, no formato [{"row_index": 0, "proposals": [...]}, {"row_index": 1, "proposals": [...]}], onde "proposals" é o array de propostas pedido acima para esse ROW (um array vazio se o ROW não tiver propostas)."""
+_SESSION_BATCH_SYSTEM_INSTRUCTIONS = {
+    template_key: f"{system_instruction}\n\n{_SESSION_BATCH_NOTE}"
+    for template_key, system_instruction in _SESSION_SYSTEM_INSTRUCTIONS.items()
+}
+
+
+# Vote counts of one party in a batched session answer
+_SESSION_VOTE_COUNTS_SCHEMA = {
+    "type": "OBJECT",
+    "nullable": True,
+    "properties": {field: {"type": "INTEGER"} for field in ("Favor", "Contra", "Abstenção", "Não Votaram", "TotalDeputados")},
+    "required": ["Favor", "Contra", "Abstenção", "Não Votaram", "TotalDeputados"],
+}
+
+# Every party that sat in a known legislature; a party key outside the schema could not be answered
+_SESSION_SCHEMA_PARTIES = list(dict.fromkeys(
+    [party for legislature in legislature_data.values() for party in legislature["parties"]] + list(party_name_map)))
+
+# Response schema of a batched session call: the proposals of each row, tagged with its index
+_SESSION_BATCH_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
         "type": "OBJECT",
         "properties": {
-            "general_summary": {
-                "type": "STRING",
-                "description": "Um resumo geral da proposta, evitando jargão jurídico e usando vocabulário normal."
-            },
-            "critical_analysis": {
-                "type": "STRING",
-                "description": "Pense criticamente sobre o documento e aponte inconsistências, se houver, e se não, mostre como os detalhes da implementação se alinham com o objetivo."
-            },
-            "fiscal_impact": {
-                "type": "STRING",
-                "description": "Uma estimativa educada se a proposta aumentará ou diminuirá os gastos do governo e aumentará ou diminuirá a receita do governo também, e qual pode ser o efeito líquido."
-            },
-            "colloquial_summary": {
-                "type": "STRING",
-                "description": "Outro resumo, mas em linguagem mais coloquial."
-            },
-            "categories": {
+            "row_index": {"type": "INTEGER", "description": "O índice i do ROW a que estas propostas se referem."},
+            "proposals": {
                 "type": "ARRAY",
-                "description": "Uma matriz de um ou mais índices de categorias em que esta proposta se enquadra. Escolha entre os seguintes índices de categorias, apenas produza o índice num formato de matriz, não produza o nome da categoria em si:\n   0 - \"Saude e Cuidados Sociais\"\n   1 - \"Educacao e Competências\"\n   2 - \"Defesa e Segurança Nacional\"\n   3 - \"Justica, Lei e Ordem\"\n   4 - \"Economia e Financas\"\n   5 - \"Bem-Estar e Seguranca Social\"\n   6 - \"Ambiente, Agricultura e Pescas\"\n   7 - \"Energia e Clima\"\n   8 - \"Transportes e Infraestruturas\"\n   9 - \"Habitacao, Comunidades e Administracao Local\"\n   10 - \"Negocios Estrangeiros e Cooperacao Internacional\"\n   11 - \"Ciencia, Tecnologia e Digital\"",
                 "items": {
-                    "type": "INTEGER"
-                }
-            },
-            "short_title": {
-                "type": "STRING",
-                "description": "Um título conciso para a proposta, máximo de 10 palavras."
-            },
-            "proposing_party": {
-                "type": "ARRAY",
-                "description": "Uma lista dos partidos políticos ou entidades que propuseram esta iniciativa (por exemplo, [\"PCP\"], [\"PS\", \"PSD\"], [\"Governo\"]). Extraia isso do texto do documento, geralmente encontrado perto do título ou número da proposta. Se nenhum for claramente identificável, a lista pode ser nula ou vazia.",
-                "items": {
-                    "type": "STRING"
+                    "type": "OBJECT",
+                    "properties": {
+                        "proposal_name": {"type": "STRING"},
+                        "proposal_link": {"type": "STRING"},
+                        "voting_summary": {
+                            "type": "OBJECT",
+                            "nullable": True,
+                            "properties": {party: _SESSION_VOTE_COUNTS_SCHEMA for party in _SESSION_SCHEMA_PARTIES},
+                        },
+                        "proposal_approval_status": {"type": "INTEGER", "nullable": True},
+                    },
+                    "required": ["proposal_name", "proposal_link", "voting_summary", "proposal_approval_status"],
                 },
-                "nullable": True
+            },
+        },
+        "required": ["row_index", "proposals"],
+    },
+}
+
+
+def create_batched_prompt_parts_for_session_pdfs(batch_inputs):
+    """
+    Combines several session PDF inputs, each a (hyperlink_table_pairs, unpaired_links, session_date)
+    tuple sharing one prompt template, into a single call. Returns (system_instruction, prompt):
+    the template's instructions go once in the system instruction, and each row keeps only its
+    structured data and MP counts between ROW i BEGIN/END sentinels. The model answers with one
+    entry per row index (see _SESSION_BATCH_SCHEMA).
+    """
+    template_keys = set()
+    row_blocks = []
+    for row_index, (hyperlink_table_pairs, unpaired_links, session_date) in enumerate(batch_inputs):
+        template_key, structured_data_text, mp_counts_text = _session_prompt_inputs(
+            hyperlink_table_pairs, unpaired_links, session_date)
+        template_keys.add(template_key)
+        row_blocks.append(f"=== ROW {row_index} BEGIN ===\n{structured_data_text}\n\n{mp_counts_text}\n=== ROW {row_index} END ===")
+    if len(template_keys) != 1:
+        raise ValueError(f"Batched session inputs must share one prompt template, got: {sorted(template_keys)}")
+
+    prompt = "\n\n".join(row_blocks) + f"\n\nRetorne exatamente {len(batch_inputs)} objetos, um por ROW."
+    return _SESSION_BATCH_SYSTEM_INSTRUCTIONS[template_keys.pop()], prompt
+
+
+def split_batched_session_response(batch_data, batch_error, row_count):
+    """Splits a batched session response back into one (proposals, error) tuple per row index."""
+    if batch_error:
+        return [(None, batch_error)] * row_count
+    if not isinstance(batch_data, list):
+        return [(None, f"Batched response was not a list, got: {type(batch_data)}")] * row_count
+
+    proposals_by_row = {}
+    for entry in batch_data:
+        if isinstance(entry, dict) and isinstance(entry.get('row_index'), int):
+            proposals_by_row.setdefault(entry['row_index'], entry.get('proposals'))
+
+    results = []
+    for row_index in range(row_count):
+        if row_index in proposals_by_row:
+            results.append((proposals_by_row[row_index], None))
+        else:
+            results.append((None, f"Batched response has no entry for ROW {row_index}"))
+    return results
+
+
+def call_gemini_api_for_session_pdfs(batch_inputs, batch_size=SESSION_PROMPT_BATCH_SIZE):
+    """
+    Extracts proposals for several session PDF inputs, sending up to batch_size of them per
+    Gemini call. Returns one (extracted_data, error) tuple per input, in input order.
+    A batch of one uses the regular single-session prompt. The calls for the different
+    batches are in flight concurrently. Inputs already extracted by an earlier call (see
+    SESSION_RESULT_CACHE) are answered from disk without building a prompt, and inputs with no
+    extracted data get an empty result without a call.
+    """
+    results = [None] * len(batch_inputs)
+    cache_keys = [None] * len(batch_inputs)
+    pending_indices = []
+    for index, (hyperlink_table_pairs, unpaired_links, session_date) in enumerate(batch_inputs):
+        if not hyperlink_table_pairs and not unpaired_links:
+            # Nothing for the model to read; the prompt would only say "NO DATA EXTRACTED FROM PDF"
+            results[index] = ([], None)
+            continue
+        if SESSION_RESULT_CACHE:
+            cache_keys[index] = _session_result_key(hyperlink_table_pairs, unpaired_links, session_date)
+            cached_result = _load_session_result(cache_keys[index])
+            if cached_result is not None:
+                log.debug("Using cached extraction for session input %s", cache_keys[index])
+                results[index] = (cached_result, None)
+                continue
+        pending_indices.append(index)
+
+    # A batch shares one system instruction, so inputs are batched only with others of the same template
+    pending_by_template = {}
+    for index in pending_indices:
+        template_key = _session_context(batch_inputs[index][2])[0]
+        pending_by_template.setdefault(template_key, []).append(index)
+
+    chunks = []
+    jobs = []
+    for template_indices in pending_by_template.values():
+        for start in range(0, len(template_indices), max(1, batch_size)):
+            chunk_indices = template_indices[start:start + max(1, batch_size)]
+            chunk = [batch_inputs[index] for index in chunk_indices]
+            try:
+                if len(chunk) == 1:
+                    hyperlink_table_pairs, unpaired_links, session_date = chunk[0]
+                    system_instruction, prompt = create_prompt_parts_for_session_pdf(
+                        hyperlink_table_pairs, unpaired_links, session_date)
+                    response_schema = None
+                else:
+                    system_instruction, prompt = create_batched_prompt_parts_for_session_pdfs(chunk)
+                    response_schema = _SESSION_BATCH_SCHEMA
+            except Exception as e:
+                for index in chunk_indices:
+                    results[index] = (None, f"Error building or sending session prompt batch: {e}")
+                continue
+            chunks.append(chunk_indices)
+            jobs.append({'prompt_text': prompt, 'expect_json': True, 'responseSchema': response_schema,
+                         'max_output_tokens': _output_token_cap(GEMINI_MAX_OUTPUT_TOKENS_SESSION, len(chunk_indices)),
+                         'system_instruction': system_instruction})
+
+    for chunk_indices, (batch_data, batch_error) in zip(chunks, call_gemini_api_many(jobs)):
+        if len(chunk_indices) == 1:
+            chunk_results = [(batch_data, batch_error)]
+        else:
+            chunk_results = split_batched_session_response(batch_data, batch_error, len(chunk_indices))
+        for index, (extracted_data, error) in zip(chunk_indices, chunk_results):
+            results[index] = (extracted_data, error)
+            if cache_keys[index] is not None and error is None and extracted_data is not None:
+                _store_session_result(cache_keys[index], extracted_data)
+    return results
+
+
+@functools.cache
+def _session_prompt_version():
+    """
+    Hash of everything besides the inputs that shapes a session extraction: PROMPT_VERSION, the
+    model and the templates, so editing a template invalidates the cached results by itself.
+    """
+    version_hash = hashlib.sha256(f"{PROMPT_VERSION}\n{GEMINI_MODEL}".encode('utf-8'))
+    for template_key in sorted(_SESSION_SYSTEM_INSTRUCTIONS):
+        version_hash.update(_SESSION_SYSTEM_INSTRUCTIONS[template_key].encode('utf-8'))
+        version_hash.update(_SESSION_BATCH_SYSTEM_INSTRUCTIONS[template_key].encode('utf-8'))
+    return version_hash.hexdigest()
+
+
+def _session_result_key(hyperlink_table_pairs, unpaired_links, session_date):
+    """
+    Content hash of a session extraction input, covering exactly the fields that
+    format_structured_data_for_llm puts in the prompt, plus the session date and prompt version.
+    Returns None if the input cannot be hashed.
+    """
+    try:
+        canonical_input = {
+            'version': _session_prompt_version(),
+            'date': str(session_date),
+            'pairs': [{
+                'page_num': group['page_num'],
+                'hyperlinks': [[link_info['text'], link_info['uri']] for link_info in group['hyperlinks']],
+                'table': _render_vote_table(group['table_data']),
+                'approval_text': group.get('approval_text'),
+            } for group in hyperlink_table_pairs or []],
+            'links': [[link['hyperlink_text'], link['uri'], link['page_num'], link.get('approval_text')]
+                      for link in unpaired_links or []],
+        }
+        encoded = json.dumps(canonical_input, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')
+    except (KeyError, TypeError, AttributeError) as e:
+        log.warning("Could not compute a cache key for a session input: %s", e)
+        return None
+    return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+
+def _load_session_result(cache_key):
+    if cache_key is None:
+        return None
+    cache_path = os.path.join(SESSION_RESULT_CACHE_DIR, cache_key + '.json')
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        log.warning("Could not read cached session result %s: %s", cache_path, e)
+        return None
+
+
+def _store_session_result(cache_key, extracted_data):
+    cache_path = os.path.join(SESSION_RESULT_CACHE_DIR, cache_key + '.json')
+    try:
+        os.makedirs(SESSION_RESULT_CACHE_DIR, exist_ok=True)
+        temp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(extracted_data, f, ensure_ascii=False)
+        os.replace(temp_path, cache_path)
+    except (OSError, TypeError, ValueError) as e:
+        log.warning("Could not cache session result %s: %s", cache_path, e)
+
+
+# Response schema of the proposal summary call; shared, so treat it as read-only
+_PROPOSAL_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "general_summary": {
+            "type": "STRING",
+            "description": "Um resumo geral da proposta, evitando jargão jurídico e usando vocabulário normal."
+        },
+        "critical_analysis": {
+            "type": "STRING",
+            "description": "Pense criticamente sobre o documento e aponte inconsistências, se houver, e se não, mostre como os detalhes da implementação se alinham com o objetivo."
+        },
+        "fiscal_impact": {
+            "type": "STRING",
+            "description": "Uma estimativa educada se a proposta aumentará ou diminuirá os gastos do governo e aumentará ou diminuirá a receita do governo também, e qual pode ser o efeito líquido."
+        },
+        "colloquial_summary": {
+            "type": "STRING",
+            "description": "Outro resumo, mas em linguagem mais coloquial."
+        },
+        "categories": {
+            "type": "ARRAY",
+            "description": "Uma matriz de um ou mais índices de categorias em que esta proposta se enquadra. Escolha entre os seguintes índices de categorias, apenas produza o índice num formato de matriz, não produza o nome da categoria em si:\n   0 - \"Saude e Cuidados Sociais\"\n   1 - \"Educacao e Competências\"\n   2 - \"Defesa e Segurança Nacional\"\n   3 - \"Justica, Lei e Ordem\"\n   4 - \"Economia e Financas\"\n   5 - \"Bem-Estar e Seguranca Social\"\n   6 - \"Ambiente, Agricultura e Pescas\"\n   7 - \"Energia e Clima\"\n   8 - \"Transportes e Infraestruturas\"\n   9 - \"Habitacao, Comunidades e Administracao Local\"\n   10 - \"Negocios Estrangeiros e Cooperacao Internacional\"\n   11 - \"Ciencia, Tecnologia e Digital\"",
+            "items": {
+                "type": "INTEGER"
             }
         },
-        "required": [
-            "general_summary",
-            "critical_analysis",
-            "fiscal_impact",
-            "colloquial_summary",
-            "categories",
-            "short_title",
-            "proposing_party"
-        ]
+        "short_title": {
+            "type": "STRING",
+            "description": "Um título conciso para a proposta, máximo de 10 palavras."
+        },
+        "proposing_party": {
+            "type": "ARRAY",
+            "description": "Uma lista dos partidos políticos ou entidades que propuseram esta iniciativa (por exemplo, [\"PCP\"], [\"PS\", \"PSD\"], [\"Governo\"]). Extraia isso do texto do documento, geralmente encontrado perto do título ou número da proposta. Se nenhum for claramente identificável, a lista pode ser nula ou vazia.",
+            "items": {
+                "type": "STRING"
+            },
+            "nullable": True
+        }
+    },
+    "required": [
+        "general_summary",
+        "critical_analysis",
+        "fiscal_impact",
+        "colloquial_summary",
+        "categories",
+        "short_title",
+        "proposing_party"
+    ]
+}
+
+
+def create_prompt_for_proposal_pdf():
+    prompt = """Analise este documento, que é uma proposta governamental votada no Parlamento português e, portanto, repleta de linguagem jurídica. Forneça uma resposta JSON estruturada. O idioma de todas as strings de texto na resposta JSON deve ser o português de Portugal."""
+
+    return prompt, _PROPOSAL_SCHEMA
+
+
+# Response schema of a batched proposal call: one summary per attached document, tagged with its position
+_PROPOSAL_BATCH_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "source_index": {
+                "type": "INTEGER",
+                "description": "A posição (começando em 0) do documento anexado a que este resumo se refere."
+            },
+            **_PROPOSAL_SCHEMA["properties"]
+        },
+        "required": ["source_index"] + _PROPOSAL_SCHEMA["required"]
     }
+}
+
+
+def create_prompt_for_proposal_pdfs_batch(document_count):
+    """Prompt and schema for summarizing document_count proposal documents attached to a single call."""
+    prompt = f"""Foram anexados {document_count} documentos, cada um uma proposta governamental votada no Parlamento português e, portanto, repleta de linguagem jurídica. Analise cada documento separadamente, sem misturar informação entre eles, e devolva um array JSON com exatamente {document_count} entradas, uma por documento, na ordem em que foram anexados. Em cada entrada, 'source_index' é a posição do documento (0 para o primeiro). O idioma de todas as strings de texto na resposta JSON deve ser o português de Portugal."""
+
+    return prompt, _PROPOSAL_BATCH_SCHEMA
+
+
+def split_batched_proposal_response(batch_data, batch_error, document_count):
+    """Splits a batched proposal response back into one (summary_data, error) tuple per document."""
+    if batch_error:
+        return [(None, batch_error)] * document_count
+    if not isinstance(batch_data, list):
+        return [(None, f"Batched response was not a list, got: {type(batch_data)}")] * document_count
 
-    return prompt, response_schema
+    summaries_by_index = {}
+    for entry in batch_data:
+        if isinstance(entry, dict) and isinstance(entry.get('source_index'), int):
+            summaries_by_index.setdefault(entry.pop('source_index'), entry)
+
+    results = []
+    for source_index in range(document_count):
+        if source_index in summaries_by_index:
+            results.append((summaries_by_index[source_index], None))
+        else:
+            results.append((None, GeminiError(f"Batched response has no entry for document {source_index}",
+                                              GEMINI_ERROR_BAD_RESPONSE)))
+    return results
+
+
+def call_gemini_api_for_proposal_pdfs(document_paths, batch_size=PROPOSAL_BATCH_SIZE):
+    """
+    Summarizes proposal documents, attaching up to batch_size of them to each Gemini call.
+    Returns one (summary_data, error) tuple per path, in order. Documents whose summary is
+    missing from a batched answer, or whose batch came back unusable, are retried on their own.
+    """
+    prompt = create_prompt_for_proposal_pdf()
+    batch_size = max(1, batch_size)
+    chunks = [list(range(start, min(start + batch_size, len(document_paths))))
+              for start in range(0, len(document_paths), batch_size)]
+    jobs = []
+    for chunk_indices in chunks:
+        if len(chunk_indices) == 1:
+            jobs.append({'prompt_text': prompt, 'document_path': document_paths[chunk_indices[0]],
+                         'expect_json': True, 'max_output_tokens': GEMINI_MAX_OUTPUT_TOKENS_PROPOSAL})
+        else:
+            jobs.append({'prompt_text': create_prompt_for_proposal_pdfs_batch(len(chunk_indices)),
+                         'document_path': [document_paths[index] for index in chunk_indices],
+                         'expect_json': True,
+                         'max_output_tokens': _output_token_cap(GEMINI_MAX_OUTPUT_TOKENS_PROPOSAL, len(chunk_indices))})
+
+    results = [None] * len(document_paths)
+    retry_indices = []
+    for chunk_indices, (batch_data, batch_error) in zip(chunks, call_gemini_api_many(jobs)):
+        if len(chunk_indices) == 1:
+            results[chunk_indices[0]] = (batch_data, batch_error)
+            continue
+        for index, (summary_data, error) in zip(
+                chunk_indices, split_batched_proposal_response(batch_data, batch_error, len(chunk_indices))):
+            results[index] = (summary_data, error)
+            if getattr(error, 'code', None) == GEMINI_ERROR_BAD_RESPONSE:
+                retry_indices.append(index)
+
+    if retry_indices:
+        log.info("Retrying %d proposal documents individually after a batched response.", len(retry_indices))
+        retry_results = call_gemini_api_many([
+            {'prompt_text': prompt, 'document_path': document_paths[index], 'expect_json': True,
+             'max_output_tokens': GEMINI_MAX_OUTPUT_TOKENS_PROPOSAL}
+            for index in retry_indices])
+        for index, result in zip(retry_indices, retry_results):
+            results[index] = result
+    return results
+
+
+_GROUP_SEPARATOR = "  " + "-" * 50 + "\n"
 
 
 def format_structured_data_for_llm(hyperlink_table_pairs, unpaired_links, pre_2020=False):
     """Format the structured data for the LLM, accommodating grouped hyperlinks and approval text."""
-    structured_data_text = "STRUCTURED PROPOSAL DATA EXTRACTED FROM PDF:\n\n"
-    has_data = False
+    if not hyperlink_table_pairs and not unpaired_links:
+        return "NO DATA EXTRACTED FROM PDF"
+
+    # Fragments are collected and joined once at the end
+    parts = ["STRUCTURED PROPOSAL DATA EXTRACTED FROM PDF:\n\n"]
 
     if hyperlink_table_pairs:
-        has_data = True
-        structured_data_text += "PROPOSALS WITH VOTING TABLES (a group of proposals may share one table):\n"
-        for i, group in enumerate(hyperlink_table_pairs, 1):
-            structured_data_text += f"\nGROUP {i} (Page: {group['page_num']}):\n"
-            structured_data_text += f"  HYPERLINKS IN THIS GROUP (sharing the table below):\n"
-            for link_info in group['hyperlinks']:
-                structured_data_text += f"    - TEXT: {link_info['text']}, URI: {link_info['uri']}\n"
-            structured_data_text += f"  SHARED VOTING TABLE FOR THIS GROUP:\n"
-            table_str = group['table_data'].to_string(index=False, header=True)
-            structured_data_text += f"    {table_str.replace(chr(10), chr(10) + '    ')}\n"
+        parts.append("PROPOSALS WITH VOTING TABLES (a group of proposals may share one table):\n")
+        table_texts = [_render_vote_table(group['table_data']) for group in hyperlink_table_pairs]
+        # Tables repeated verbatim across groups are written out once and then referred to by label
+        table_labels = {}
+        if DEDUP_TABLES:
+            repeated_tables = [text for text, count in collections.Counter(table_texts).items() if count > 1]
+            table_labels = {text: f"T{k}" for k, text in enumerate(repeated_tables, 1)}
+        first_group_with_table = {}
+        for i, (group, table_text) in enumerate(zip(hyperlink_table_pairs, table_texts), 1):
+            parts.append(f"\nGROUP {i} (Page: {group['page_num']}):\n")
+            parts.append("  HYPERLINKS IN THIS GROUP (sharing the table below):\n")
+            parts.extend(f"    - TEXT: {link_info['text']}, URI: {link_info['uri']}\n"
+                         for link_info in group['hyperlinks'])
+            table_label = table_labels.get(table_text)
+            if table_label is None:
+                parts.append("  SHARED VOTING TABLE FOR THIS GROUP:\n")
+            elif table_text in first_group_with_table:
+                parts.append(f"  SHARED VOTING TABLE FOR THIS GROUP: identical to TABLE {table_label}, "
+                             f"shown in GROUP {first_group_with_table[table_text]}\n")
+            else:
+                first_group_with_table[table_text] = i
+                parts.append(f"  SHARED VOTING TABLE FOR THIS GROUP (TABLE {table_label}):\n")
+            if table_label is None or first_group_with_table[table_text] == i:
+                parts.append(textwrap.indent(table_text, '    '))
+                parts.append("\n")
             # Check if approval_text exists and is not None/empty/whitespace
             approval_text = group.get('approval_text')
-            print(f"DEBUG: Approval text for group {i}: {approval_text}")
             if approval_text and approval_text.strip():
-                structured_data_text += f"  APPROVAL TEXT: {approval_text}\n"
-            structured_data_text += "  " + "-"*50 + "\n"
+                parts.append(f"  APPROVAL TEXT: {approval_text}\n")
+            parts.append(_GROUP_SEPARATOR)
 
     if unpaired_links:
-        has_data = True
         if pre_2020:
-            structured_data_text += "\nPROPOSALS LINKS (voting information may be in text or indicated by 'APPROVAL TEXT' found nearby; may be approved unanimously or in groups where one result applies to several proposals):\n"
+            parts.append("\nPROPOSALS LINKS (voting information may be in text or indicated by 'APPROVAL TEXT' found nearby; may be approved unanimously or in groups where one result applies to several proposals):\n")
         else:
-            structured_data_text += "\nPROPOSALS WITHOUT INDIVIDUAL VOTING TABLES (may be approved unanimously or in groups; check 'APPROVAL TEXT' if available):\n"
+            parts.append("\nPROPOSALS WITHOUT INDIVIDUAL VOTING TABLES (may be approved unanimously or in groups; check 'APPROVAL TEXT' if available):\n")
         
         for i, link in enumerate(unpaired_links, 1):
-            structured_data_text += f"\n{i}. PROPOSAL TEXT: {link['hyperlink_text']}\n"
-            structured_data_text += f"   LINK: {link['uri']}\n"
-            structured_data_text += f"   PAGE: {link['page_num']}\n"
+            parts.append(f"\n{i}. PROPOSAL TEXT: {link['hyperlink_text']}\n")
+            parts.append(f"   LINK: {link['uri']}\n")
+            parts.append(f"   PAGE: {link['page_num']}\n")
             # Check if approval_text exists and is not None/empty/whitespace
             approval_text = link.get('approval_text')
             if approval_text and approval_text.strip():
-                structured_data_text += f"   APPROVAL TEXT: {approval_text}\n"
+                parts.append(f"   APPROVAL TEXT: {approval_text}\n")
             # No specific formatting for rect_y1 needed for LLM, it was for internal sorting/logic
 
-    if not has_data:
-        return "NO DATA EXTRACTED FROM PDF"
+    return "".join(parts)
 
-    return structured_data_text
+
+def _render_vote_table(table_df):
+    """
+    Renders a voting table as tab-separated lines, header first, missing cells as NaN. The model
+    does not need aligned columns, and the padding spaces only cost input tokens.
+    """
+    lines = ["\t".join(str(column) for column in table_df.columns)]
+    lines.extend("\t".join(_vote_table_cell_text(value) for value in row)
+                 for row in table_df.itertuples(index=False, name=None))
+    return "\n".join(lines)
+
+
+def _vote_table_cell_text(value):
+    if value is None or (isinstance(value, float) and value != value):
+        return "NaN"
+    return str(value)
+
+
+# Legislature start dates in order, for bisecting a session date into its legislature
+_LEGISLATURE_START_DATES = sorted(legislature_data)
+_LEGISLATURE_ORDER = {start_date: position for position, start_date in enumerate(legislature_data)}
+
+
+def _check_legislature_intervals():
+    """
+    The bisect lookup in _find_legislature only looks at two neighbouring legislatures, which is
+    correct as long as each one ends no later than the next one starts (sharing that day is fine).
+    """
+    for start_date, next_start_date in zip(_LEGISLATURE_START_DATES, _LEGISLATURE_START_DATES[1:]):
+        if legislature_data[start_date]["end_date"] > next_start_date:
+            raise ValueError(f"Legislatures starting on {start_date} and {next_start_date} overlap in legislature_data.")
+
+
+_check_legislature_intervals()
 
 
 def build_mp_counts_text(session_date):
-    mp_counts_text = "ERRO: Data da sessão fora dos períodos conhecidos para contagem de deputados."
+    session_date = _to_date(session_date)  # None results in the "ERRO" message
+    return _build_legislature_mp_counts_text(_find_legislature(session_date))
 
-    if not isinstance(session_date, date):
-        try:
-            session_date = date.fromisoformat(session_date)
-        except (ValueError, TypeError):
-            pass  # Will result in the "ERRO" message if session_date remains invalid
 
-    if isinstance(session_date, date):
-        selected_legislature = None
-        for start_date, data in legislature_data.items():
-            if start_date <= session_date <= data["end_date"]:
-                selected_legislature = data
-                break
+@functools.lru_cache(maxsize=256)
+def _find_legislature(session_date):
+    """Start date (the legislature_data key) of the legislature containing session_date, or None."""
+    if session_date is None:
+        return None
+    # Only the last legislature starting before the date and one starting on it can contain it
+    index = bisect.bisect_left(_LEGISLATURE_START_DATES, session_date)
+    matches = [candidate for candidate in _LEGISLATURE_START_DATES[max(index - 1, 0):index + 1]
+               if candidate <= session_date <= legislature_data[candidate]["end_date"]]
+    if not matches:
+        return None
+    # Consecutive legislatures share their boundary day; the one listed first in legislature_data wins
+    return min(matches, key=_LEGISLATURE_ORDER.__getitem__)
+
 
-        if selected_legislature:
-            party_lines = []
-            # Get the first party for example
-            example_party_name = next(iter(selected_legislature["parties"]))
-            example_party_count = selected_legislature["parties"][example_party_name]
+@functools.lru_cache(maxsize=32)
+def _build_legislature_mp_counts_text(legislature_start_date):
+    """MP counts text for the legislature starting on legislature_start_date; sessions share a handful of these."""
+    if legislature_start_date is None:
+        return "ERRO: Data da sessão fora dos períodos conhecidos para contagem de deputados."
 
-            for party, count in selected_legislature["parties"].items():
-                party_lines.append(
-                    f"- {party} ({party_name_map.get(party, party)}): {count}")
+    selected_legislature = legislature_data[legislature_start_date]
+    party_lines = [f"- {party} ({party_name_map.get(party, party)}): {count}"
+                   for party, count in selected_legislature["parties"].items()]
 
-            if selected_legislature.get("notes"):
-                party_lines.append(f"- {selected_legislature['notes']}")
+    if selected_legislature.get("notes"):
+        party_lines.append(f"- {selected_legislature['notes']}")
 
-            party_details_str = "\n".join(party_lines)
+    party_details_str = "\n".join(party_lines)
 
-            mp_counts_text = f"""Composição parlamentar e contagem de deputados para referência ({selected_legislature['name']}):
+    return f"""Composição parlamentar e contagem de deputados para referência ({selected_legislature['name']}):
 {party_details_str}
 Total de deputados: {selected_legislature['total_mps']}. """
-    return mp_counts_text
-
-
-def build_response_schema():
-    response_schema = {
-        "type": "array",
-        "description": "Um array JSON onde cada elemento representa UMA proposta (hiperlink) que foi votada.",
-        "items": {
-            "type": "object",
-            "description": "Representa uma proposta votada.",
-            "properties": {
-                "proposal_name": {
-                    "type": "string",
-                    "description": "O identificador da proposta (ex: 'Projeto de Lei 404/XVI/1', 'Proposta de Lei 39/XVI/1'). Extraído do texto do hiperlink ou perto do hiperlink pois o texto hiperlink pode ser abreviado. Nunca será 'Texto Final' ou similar."
-                },
-                "proposal_link": {
-                    "type": "string",
-                    "description": "O URI/hiperlink para a proposta."
-                },
-                "voting_summary": {
-                    "type": "array",
-                    "nullable": True,
-                    "description": "Detalhe da votação por partido. Um array onde cada elemento representa um partido e seus votos. Definir como nulo se não houver informação.",
-                    "items": {
-                        "type": "object",
-                        "properties": {
-                            "party_name": {"type": "string", "description": "Nome do partido (ex: 'PS', 'PSD')."},
-                            "votes": {
-                                "type": "object",
-                                "properties": {
-                                    "Favor": {"type": "integer"},
-                                    "Contra": {"type": "integer"},
-                                    "Abstenção": {"type": "integer"},
-                                    "Não Votaram": {"type": "integer"},
-                                    "TotalDeputados": {"type": "integer"}
-                                },
-                                "required": ["Favor", "Contra", "Abstenção", "Não Votaram", "TotalDeputados"]
-                            }
-                        },
-                        "required": ["party_name", "votes"]
-                    }
-                },
-                "proposal_approval_status": {
-                    "type": "integer",
-                    "nullable": True,
-                    "description": "Um inteiro, 1 se a proposta foi aprovada, 0 se foi rejeitada. Se não estiver claro, defina como nulo. Isso é derivado do 'voting_summary'."
-                }
-            },
-            "required": ["proposal_name", "proposal_link", "voting_summary", "proposal_approval_status"]
-        }
-    }
-    return response_schema
 
 
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _event_loop():
+    """
+    The event loop every Gemini coroutine runs on, in a daemon thread of its own. The cached
+    client's async connection pool belongs to the loop it was first used on, so the calls must
+    not each start a fresh loop with asyncio.run.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="gemini-event-loop", daemon=True).start()
+        return _loop
+
+
+def _run_coroutine(coroutine):
+    """Runs coroutine on the shared Gemini event loop and blocks the calling thread until it returns."""
+    return asyncio.run_coroutine_threadsafe(coroutine, _event_loop()).result()
+
 
-def call_gemini_api(prompt_text, document_path=None, expect_json=False, responseSchema=None):
+def call_gemini_api(prompt_text, document_path=None, expect_json=False, responseSchema=None, system_instruction=None,
+                    max_output_tokens=None):
     """Calls the Gemini API with the given prompt and optional document file."""
-    if not genai_client:
-        return None, "GEMINI_API_KEY not configured"
+    # Run the async function in a synchronous context
+    try:
+        return _run_coroutine(call_gemini_api_async(prompt_text, document_path, expect_json, responseSchema,
+                                                    system_instruction=system_instruction,
+                                                    max_output_tokens=max_output_tokens))
+    except Exception as e:
+        log.error("Error running Gemini call on the event loop: %s", e)
+        return None, f"Error running async function: {e}"
+
+
+def call_gemini_api_many(jobs, concurrency=GEMINI_CONCURRENCY):
+    """
+    Synchronous entry point for process_pdfs: runs every job (a dict of call_gemini_api keyword
+    arguments) with up to `concurrency` requests in flight, returning one (result, error) tuple
+    per job in job order.
+    """
+    if not jobs:
+        return []
+    try:
+        return _run_coroutine(process_pdfs(jobs, concurrency=concurrency))
+    except Exception as e:
+        log.error("Error running Gemini calls on the event loop: %s", e)
+        return [(None, f"Error running async function: {e}")] * len(jobs)
+
+
+async def process_pdfs(jobs, concurrency=GEMINI_CONCURRENCY):
+    """
+    Awaits call_gemini_api_async for every job, with at most `concurrency` of them in flight.
+    Documents are uploaded ahead of time by a PdfUploadPrefetcher, so the uploads for jobs still
+    waiting on the semaphore overlap with the inference of the running ones. Jobs answered by
+    the response cache are settled first, so their documents are never uploaded.
+    An exception escaping one job becomes that job's error instead of failing the whole batch.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    cached_results = {}
+    if RESPONSE_CACHE:
+        # Hashing the documents blocks, so it runs off the event loop the other calls share
+        cached_results = await asyncio.to_thread(_cached_document_job_results, jobs)
+    prefetcher = PdfUploadPrefetcher()
+    for index, job in enumerate(jobs):
+        if index in cached_results:
+            continue
+        for document_path in _existing_document_paths(job.get('document_path')):
+            prefetcher.prefetch(document_path)
+
+    async def run_job(index, job):
+        if index in cached_results:
+            log.debug("Using cached Gemini response for job %d", index)
+            return cached_results[index], None
+        async with semaphore:
+            return await call_gemini_api_async(**job, prefetcher=prefetcher)
+
+    try:
+        outcomes = await asyncio.gather(*(run_job(index, job) for index, job in enumerate(jobs)), return_exceptions=True)
+    finally:
+        await prefetcher.close()
+    # A job that raises only fails itself; the other results of the batch are kept
+    results = []
+    for outcome in outcomes:
+        if isinstance(outcome, Exception):
+            log.error("Unexpected error in Gemini API call: %s", outcome)
+            results.append((None, f"Unexpected error in Gemini API call: {outcome}"))
+        else:
+            results.append(outcome)
+    return results
+
+
+def _cached_document_job_results(jobs):
+    """Cached responses of the jobs with documents attached, keyed by job index."""
+    cached_results = {}
+    for index, job in enumerate(jobs):
+        if not _existing_document_paths(job.get('document_path')):
+            continue  # Nothing to prefetch; call_gemini_api_async checks the cache itself
+        prompt, response_schema = _prompt_and_schema(job.get('prompt_text'), job.get('responseSchema'))
+        cached_result = _response_cache().get(_response_cache_key(
+            prompt, response_schema, job.get('system_instruction'), job.get('expect_json'), job.get('document_path')))
+        if cached_result is not None:
+            cached_results[index] = cached_result
+    return cached_results
+
+
+class PdfUploadPrefetcher:
+    """
+    Uploads documents to the Gemini File API ahead of the calls that need them. A fixed pool of
+    worker tasks takes (path, future) pairs off a queue; callers await the future via get().
+    Documents are keyed by content hash, so copies of one file under different paths share an upload.
+    """
+
+    def __init__(self, workers=UPLOAD_PREFETCH_WORKERS):
+        self._queue = asyncio.Queue()
+        self._futures = {}
+        self._workers = [asyncio.create_task(self._run()) for _ in range(max(1, workers))]
+
+    def prefetch(self, document_path):
+        """
+        Queues the document for upload unless it, or another file with the same content, is
+        already queued or uploaded.
+        """
+        content_hash = _sha256_file(document_path)
+        if content_hash not in self._futures:
+            future = asyncio.get_running_loop().create_future()
+            self._futures[content_hash] = future
+            self._queue.put_nowait((document_path, future))
+        return content_hash
+
+    async def get(self, document_path):
+        """Returns the uploaded file for the document, queueing it first if needed."""
+        return await self._futures[self.prefetch(document_path)]
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        for future in self._futures.values():
+            if not future.done():
+                future.cancel()
+
+    async def _run(self):
+        while True:
+            document_path, future = await self._queue.get()
+            try:
+                uploaded_file = await _upload_document(document_path)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(uploaded_file)
+
+
+class ConcurrencySlots:
+    """A cap on how many blocks may be open at once, which several Throttlers can draw on together."""
 
-    actual_prompt_text = prompt_text
-    actual_response_schema = responseSchema
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.active = 0
 
+
+class Throttler:
+    """
+    Paces entries into an `async with` block to at most rate_limit per period seconds and, when
+    slots is given, to at most slots.limit blocks open at once across every Throttler sharing
+    those slots. The counts are kept under threading locks because the quota being protected is
+    per process, not per event loop. A falsy limit disables that check.
+    """
+
+    def __init__(self, rate_limit, period=60.0, slots=None):
+        self.rate_limit = rate_limit
+        self.period = period
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._entries = collections.deque()
+
+    async def __aenter__(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._entries and now - self._entries[0] >= self.period:
+                    self._entries.popleft()
+                if self.rate_limit and len(self._entries) >= self.rate_limit:
+                    wait = self.period - (now - self._entries[0])
+                elif self._take_slot():
+                    self._entries.append(now)
+                    return self
+                else:
+                    wait = THROTTLE_POLL_INTERVAL
+            await asyncio.sleep(wait)
+
+    def _take_slot(self):
+        if self.slots is None:
+            return True
+        with self.slots.lock:
+            if self.slots.limit and self.slots.active >= self.slots.limit:
+                return False
+            self.slots.active += 1
+            return True
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.slots is not None:
+            with self.slots.lock:
+                self.slots.active -= 1
+        return False
+
+
+# Requests and uploads have separate Gemini quotas; the socket cap is shared by both
+_gemini_slots = ConcurrencySlots(GEMINI_MAX_CONCURRENCY)
+_gemini_throttle = Throttler(GEMINI_RATE_LIMIT_PER_MIN, 60.0, slots=_gemini_slots)
+_files_throttle = Throttler(GEMINI_UPLOAD_RATE_LIMIT_PER_MIN, 60.0, slots=_gemini_slots)
+
+
+async def _upload_document(document_path):
+    """Uploads a document to the Gemini File API, reusing an earlier upload of the same content."""
+    cache_key, cached_name = _cached_upload_name(document_path)
+    if cached_name:
+        try:
+            uploaded_file = await _client().aio.files.get(name=cached_name)
+            log.debug("Reusing uploaded file %s for %s", uploaded_file.name, document_path)
+            return uploaded_file
+        except Exception as e:
+            log.warning("Cached upload %s is no longer available (%s), uploading again.", cached_name, e)
+    log.debug("Uploading file: %s", document_path)
+    async with _files_throttle:
+        uploaded_file = await _client().aio.files.upload(file=document_path)
+    _remember_upload(cache_key, uploaded_file)
+    log.debug("File uploaded successfully: %s", uploaded_file.name)
+    return uploaded_file
+
+
+def _prompt_and_schema(prompt_text, responseSchema):
+    """The (prompt, response schema) a Gemini call is made with."""
     # Handle cases where prompt_text might be a tuple (prompt_string, schema_dict)
     # This can happen if create_prompt_for_proposal_pdf()'s result is passed directly.
     if isinstance(prompt_text, tuple) and len(prompt_text) == 2:
         potential_prompt_str, potential_schema_dict = prompt_text
         if isinstance(potential_prompt_str, str) and isinstance(potential_schema_dict, dict):
-            actual_prompt_text = potential_prompt_str
-            if responseSchema is None: # Only use schema from tuple if no explicit schema was passed
-                actual_response_schema = potential_schema_dict
             # If responseSchema was explicitly passed, it takes precedence.
-            # actual_prompt_text is now correctly the string part.
+            return potential_prompt_str, responseSchema if responseSchema is not None else potential_schema_dict
+    return prompt_text, responseSchema
 
-    print(f"Calling Gemini API. Prompt length: {len(actual_prompt_text)}")
-
-    # Run the async function in a synchronous context
-    try:
-        return asyncio.run(_call_gemini_api_async(actual_prompt_text, document_path, expect_json, actual_response_schema))
-    except Exception as e:
-        print(f"Error in asyncio.run: {e}")
-        return None, f"Error running async function: {e}"
 
+async def call_gemini_api_async(prompt_text, document_path=None, expect_json=False, responseSchema=None,
+                                system_instruction=None, max_output_tokens=None, prefetcher=None):
+    """
+    Async variant of call_gemini_api, so that several calls can share one event loop.
+    prompt_text may be a string or a list of Parts (see create_prompt_parts_for_session_pdf),
+    and system_instruction is sent in the generation config. document_path may also be a
+    list of paths, attached in order (see call_gemini_api_for_proposal_pdfs). max_output_tokens
+    caps the length of the answer, thinking included.
+    With a PdfUploadPrefetcher the document upload is taken from it instead of started here.
+    """
+    if not _client():
+        return None, "GEMINI_API_KEY not configured"
 
-async def _call_gemini_api_async(prompt_text, document_path=None, expect_json=False, responseSchema=None):
-    """Async implementation of Gemini API call with timeout."""
-    # Prepare contents array
-    contents = [prompt_text]
+    actual_prompt_text, actual_response_schema = _prompt_and_schema(prompt_text, responseSchema)
 
-    # If a document is provided, upload it using the File API
-    if document_path and os.path.exists(document_path):
+    # Prepare contents array; a prompt may also be given as a list of Parts
+    if isinstance(actual_prompt_text, list):
+        contents = list(actual_prompt_text)
+        prompt_length = sum(len(part.text or '') for part in actual_prompt_text)
+    else:
+        contents = [actual_prompt_text]
+        prompt_length = len(actual_prompt_text)
+
+    log.debug("Calling Gemini API. Prompt length: %d", prompt_length)
+    if isinstance(actual_prompt_text, str) and len(actual_prompt_text.strip()) < MIN_PROMPT_LENGTH:
+        return None, GeminiError(f"Prompt too short to send ({prompt_length} characters)", GEMINI_ERROR_INVALID_REQUEST)
+
+    response_cache_key = None
+    if RESPONSE_CACHE:
+        # Hashing the documents and reading the cache block, so they run off the shared event loop
+        response_cache_key = await asyncio.to_thread(
+            _response_cache_key, actual_prompt_text, actual_response_schema, system_instruction, expect_json, document_path)
+        cached_result = await asyncio.to_thread(_response_cache().get, response_cache_key)
+        if cached_result is not None:
+            log.debug("Using cached Gemini response %s", response_cache_key)
+            return cached_result, None
+
+    # If documents are provided, upload them using the File API; they follow the prompt in order
+    for path in _existing_document_paths(document_path):
         try:
-            print(f"Uploading file: {document_path}")
-            uploaded_file = genai_client.files.upload(file=document_path)
+            if prefetcher is not None:
+                uploaded_file = await prefetcher.get(path)
+            else:
+                uploaded_file = await _upload_document(path)
             contents.append(uploaded_file)
-            print(f"File uploaded successfully: {uploaded_file.name}")
         except Exception as e:
             return None, f"File upload failed: {e}"
 
-    # Prepare generation config
-    config = {}
+    # Prepare generation config. Building the typed config validates the field names, which the
+    # SDK would otherwise not enforce for a plain dict.
+    config = None
+    # A single candidate is the default, but say so, so that no call ever pays for several
+    config_fields = {'candidate_count': 1}
+    if max_output_tokens:
+        config_fields['max_output_tokens'] = max_output_tokens
+    cached_content_name = None
+    if system_instruction and CONTEXT_CACHING:
+        # Creating a cache is a blocking call made at most once per TTL, so it runs off the event loop
+        cached_content_name = await asyncio.to_thread(_cached_content_for, system_instruction)
+    if cached_content_name:
+        config_fields['cached_content'] = cached_content_name
+    elif system_instruction:
+        config_fields['system_instruction'] = system_instruction
     if expect_json:
-        config = {
-            "response_mime_type": "application/json",
-            "temperature": 0,
-            "responseSchema": responseSchema # Use the potentially corrected schema
-        }
-
-    for attempt in range(LLM_RETRY_ATTEMPTS):
+        config_fields.update({
+            'response_mime_type': "application/json",
+            'temperature': 0,
+            'response_schema': actual_response_schema # Use the potentially corrected schema
+        })
+    try:
+        config = _types().GenerateContentConfig(**config_fields)
+    except Exception as e:
+        return None, GeminiError(f"Invalid generation config: {e}", GEMINI_ERROR_INVALID_REQUEST)
+
+    start_time = time.time()
+    retried_bad_response = False
+    retried_inline_instruction = False
+    attempt = 0
+    while attempt < LLM_RETRY_ATTEMPTS:
+        retry_after = None
         try:
-            print(f"Gemini API attempt {attempt + 1}/{LLM_RETRY_ATTEMPTS} with {LLM_TIMEOUT}s timeout")
+            log.debug("Gemini API attempt %d/%d with %ss timeout", attempt + 1, LLM_RETRY_ATTEMPTS, LLM_TIMEOUT)
             
             # Create the async task for the API call
-            api_task = asyncio.create_task(_make_gemini_request(contents, config))
+            api_task = asyncio.create_task(_make_gemini_request(contents, config, expect_json))
             
             # Wait for the task with timeout
-            try:
-                response = await asyncio.wait_for(api_task, timeout=LLM_TIMEOUT)
-            except asyncio.TimeoutError:
-                print(f"Gemini API call timed out after {LLM_TIMEOUT} seconds (attempt {attempt + 1}/{LLM_RETRY_ATTEMPTS})")
-                if attempt + 1 == LLM_RETRY_ATTEMPTS:
-                    return None, f"API timeout after {LLM_RETRY_ATTEMPTS} attempts (each {LLM_TIMEOUT}s)"
-                await asyncio.sleep(LLM_RETRY_DELAY)
+            response = await asyncio.wait_for(api_task, timeout=LLM_TIMEOUT)
+        except asyncio.TimeoutError:
+            log.warning("Gemini API call timed out after %s seconds (attempt %d/%d)", LLM_TIMEOUT, attempt + 1, LLM_RETRY_ATTEMPTS)
+            error_code = GEMINI_ERROR_TIMEOUT
+            error_message = f"API timeout after {attempt + 1} attempts (each {LLM_TIMEOUT}s)"
+        except Exception as e:
+            error_code = _classify_gemini_exception(e)
+            retry_after = _retry_after_seconds(e) if error_code == GEMINI_ERROR_RATE_LIMITED else None
+            log.warning("Error communicating with Gemini API (attempt %d/%d, %s): %s",
+                        attempt + 1, LLM_RETRY_ATTEMPTS, error_code, e)
+            if error_code == GEMINI_ERROR_INVALID_REQUEST and cached_content_name and not retried_inline_instruction:
+                # The context cache may have expired or been deleted early; send the instruction inline,
+                # once, straight away and without counting it as an attempt
+                _forget_cached_content(system_instruction)
+                cached_content_name = None
+                retried_inline_instruction = True
+                config = config.model_copy(update={'cached_content': None, 'system_instruction': system_instruction})
                 continue
+            if error_code == GEMINI_ERROR_INVALID_REQUEST:
+                # A rejected request fails the same way on every retry
+                return None, GeminiError(f"API rejected the request: {e}", error_code)
+            error_message = f"API error after {attempt + 1} attempts: {e}"
+        else:
+            result, parse_error = _parse_response(
+                response, expect_json, structured=expect_json and bool(actual_response_schema))
+            if parse_error is None:
+                usage_metadata = getattr(response, 'usage_metadata', None)
+                if usage_metadata is not None and usage_metadata.prompt_token_count is not None:
+                    log.debug("Gemini prompt tokens: %d", usage_metadata.prompt_token_count)
+                if response_cache_key is not None:
+                    _response_cache().set(response_cache_key, result, ttl=RESPONSE_CACHE_TTL)
+                return result, None
+            if retried_bad_response or attempt + 1 == LLM_RETRY_ATTEMPTS:
+                return None, GeminiError(parse_error, GEMINI_ERROR_BAD_RESPONSE)
+            # Retry an unusable response once, straight away, nudging the temperature so the model
+            # does not produce the same output again
+            retried_bad_response = True
+            if config is not None:
+                config = config.model_copy(update={'temperature': 0.1})
+            log.warning("Retrying once after an unusable Gemini response.")
+            attempt += 1
+            continue
+
+        if attempt + 1 == LLM_RETRY_ATTEMPTS:
+            return None, GeminiError(error_message, error_code)
+
+        if retry_after is not None:
+            # The server said how long the rate limit lasts; waiting less would only fail again
+            delay = min(retry_after, LLM_RETRY_MAX_DELAY)
+        else:
+            # Exponential backoff with jitter, so that concurrent callers do not retry in lockstep
+            delay = min(LLM_RETRY_DELAY * (2 ** attempt), LLM_RETRY_MAX_DELAY) * random.uniform(0.5, 1.0)
+        elapsed_time = time.time() - start_time
+        if elapsed_time + delay >= LLM_MAX_TOTAL_TIME:
+            log.error("Maximum total Gemini retry time (%ss) would be exceeded, giving up.", LLM_MAX_TOTAL_TIME)
+            return None, GeminiError(f"{error_message} (gave up after {elapsed_time:.1f}s, max {LLM_MAX_TOTAL_TIME}s)", error_code)
+        log.info("Waiting %.1fs before retry...", delay)
+        await asyncio.sleep(delay)
+        attempt += 1
+    return None, GeminiError(f"Failed after {LLM_RETRY_ATTEMPTS} attempts.", GEMINI_ERROR_UNAVAILABLE)
+
+
+@functools.cache
+def _response_cache():
+    return SQLiteResponseCache(RESPONSE_CACHE_PATH)
+
+
+def _response_cache_key(prompt, response_schema, system_instruction, expect_json, document_path):
+    """SHA-256 of everything that shapes a Gemini response: prompt, document content, schema and model."""
+    file_hashes = [_sha256_file(path) for path in _existing_document_paths(document_path)]
+    key_fields = {
+        'version': PROMPT_VERSION,
+        'model': GEMINI_MODEL,
+        'prompt': [part.text for part in prompt] if isinstance(prompt, list) else prompt,
+        'system_instruction': system_instruction,
+        'schema': response_schema,
+        'expect_json': bool(expect_json),
+        'file_hash': file_hashes[0] if len(file_hashes) == 1 else file_hashes or None,
+    }
+    encoded = json.dumps(key_fields, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
 
-            generated_text = response.text
 
-            if not generated_text.strip():
-                print(f"Gemini API Warning: Empty text response.")
-                return None, "Empty text response from API"
+def _existing_document_paths(document_path):
+    """The document_path argument of a Gemini call (None, a path or a list of paths) as a list of existing files."""
+    if not document_path:
+        return []
+    paths = [document_path] if isinstance(document_path, str) else document_path
+    return [path for path in paths if path and os.path.exists(path)]
 
-            if expect_json:
-                # Clean up JSON response if needed
-                cleaned_text = generated_text.strip()
-                if cleaned_text.startswith("```json"):
-                    cleaned_text = cleaned_text[7:]
-                if cleaned_text.endswith("```"):
-                    cleaned_text = cleaned_text[:-3]
 
-                try:
-                    parsed_json = json.loads(cleaned_text)
-                    print("Successfully parsed JSON response from Gemini API.")
-                    return parsed_json, None
-                except json.JSONDecodeError as e:
-                    print(
-                        f"Error decoding JSON from Gemini API response: {e}. Response text: {generated_text}")
-                    return None, f"JSONDecodeError: {e}. Raw text: {generated_text[:500]}"
+def _sha256_file(path):
+    """SHA-256 of a file's content, computed once per version of the file."""
+    stat = os.stat(path)
+    return _sha256_file_version(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
 
-            print("Successfully received text response from Gemini API.")
-            return generated_text, None
 
-        except Exception as e:
-            print(
-                f"Error communicating with Gemini API (attempt {attempt + 1}/{LLM_RETRY_ATTEMPTS}): {e}")
-            if attempt + 1 == LLM_RETRY_ATTEMPTS:
-                return None, f"API error after {LLM_RETRY_ATTEMPTS} attempts: {e}"
+@functools.lru_cache(maxsize=1024)
+def _sha256_file_version(path, mtime_ns, size):
+    # One update over a read-only mapping lets OpenSSL hash the whole file in a single pass
+    # (with the SHA extensions where the CPU has them) instead of chunk by chunk
+    with open(path, 'rb') as f:
+        if size == 0:
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return hashlib.sha256(mapped).hexdigest()
+
+
+def _classify_gemini_exception(e):
+    """Maps an exception raised by the Gemini client to one of the GEMINI_ERROR_* codes."""
+    status_code = getattr(e, 'code', None)
+    if status_code == 429:
+        return GEMINI_ERROR_RATE_LIMITED
+    if status_code == 408:
+        return GEMINI_ERROR_TIMEOUT
+    if isinstance(status_code, int) and 400 <= status_code < 500:
+        return GEMINI_ERROR_INVALID_REQUEST
+    # 5xx responses and connection-level failures are worth retrying
+    return GEMINI_ERROR_UNAVAILABLE
 
-        await asyncio.sleep(LLM_RETRY_DELAY)
-    return None, f"Failed after {LLM_RETRY_ATTEMPTS} attempts."
+
+def _retry_after_seconds(e):
+    """
+    Seconds the server asked us to wait before retrying, from a Retry-After header or the
+    RetryInfo detail of a 429 error body, or None if it did not say.
+    """
+    response = getattr(e, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if headers:
+        try:
+            return float(headers.get('retry-after'))
+        except (TypeError, ValueError):
+            pass
+    details = getattr(e, 'details', None)
+    error_details = details.get('error', {}).get('details', []) if isinstance(details, dict) else []
+    for detail in error_details:
+        retry_delay = detail.get('retryDelay') if isinstance(detail, dict) else None
+        if isinstance(retry_delay, str) and retry_delay.endswith('s'):
+            try:
+                return float(retry_delay[:-1])
+            except ValueError:
+                pass
+    return None
+
+
+def _parse_response(response, expect_json, structured=False):
+    """
+    Turns a Gemini response into the (result, error) tuple returned by call_gemini_api.
+    When a response schema was sent the SDK has already decoded the JSON into
+    response.parsed, so the text is only decoded if that is missing.
+    """
+    if structured:
+        parsed = getattr(response, 'parsed', None)
+        if parsed is not None:
+            log.debug("Successfully received structured response from Gemini API.")
+            return parsed, None
+    return _parse_response_text(response.text, expect_json, strip_fences=not structured)
 
 
-async def _make_gemini_request(contents, config):
-    """Makes the actual Gemini API request asynchronously."""
-    # Check if the client has an async method
+# A Markdown code fence around the whole response, with or without the json language tag
+_JSON_FENCE_RE = re.compile(r'\A\s*```(?:json)?|```\s*\Z')
+
+
+def _parse_response_text(generated_text, expect_json, strip_fences=True):
+    """Turns the text of a Gemini response into the (result, error) tuple returned by call_gemini_api."""
+    if not generated_text or not generated_text.strip():
+        log.warning("Gemini API returned an empty text response.")
+        return None, "Empty text response from API"
+
+    if expect_json:
+        # Schema-constrained output is plain JSON; free-form output may come wrapped in a code fence
+        if strip_fences:
+            cleaned_text = _JSON_FENCE_RE.sub('', generated_text)
+        else:
+            cleaned_text = generated_text
+
+        try:
+            parsed_json = orjson.loads(cleaned_text) if orjson is not None else json.loads(cleaned_text)
+            log.debug("Successfully parsed JSON response from Gemini API.")
+            return parsed_json, None
+        except json.JSONDecodeError as e:
+            log.warning("Error decoding JSON from Gemini API response: %s. Response text: %s", e, generated_text)
+            return None, f"JSONDecodeError: {e}. Raw text: {generated_text[:500]}"
+
+    log.debug("Successfully received text response from Gemini API.")
+    return generated_text, None
+
+
+async def _make_gemini_request(contents, config, expect_json=False):
+    """Makes the actual Gemini API request asynchronously, paced by _gemini_throttle."""
+    async with _gemini_throttle:
+        if GEMINI_STREAMING and getattr(_client(), 'aio', None) is not None:
+            return await _stream_gemini_request(contents, config, expect_json)
+        return await _send_gemini_request(contents, config)
+
+
+async def _stream_gemini_request(contents, config, expect_json):
+    """
+    Streams the response and returns an object with the text, parsed and usage_metadata
+    attributes _parse_response reads. A JSON answer is expected to open with [ or { (after an
+    optional code fence); if it opens with anything else the stream is dropped straight away,
+    and the partial text fails parsing like any other unusable response.
+    """
+    stream = await _client().aio.models.generate_content_stream(
+        model=GEMINI_MODEL,
+        contents=contents,
+        config=config
+    )
+    text_parts = []
+    usage_metadata = None
+    checked_start = not expect_json
     try:
-        # Try using the async method if available
-        response = await genai_client.amodels.generate_content(
-            model="gemini-2.5-flash-preview-05-20",
+        async for chunk in stream:
+            if chunk.text:
+                text_parts.append(chunk.text)
+            usage_metadata = getattr(chunk, 'usage_metadata', None) or usage_metadata
+            if not checked_start:
+                received = "".join(text_parts).lstrip()
+                # Wait until a possible fence has fully arrived before judging the first character
+                head = "" if "```json".startswith(received) else _JSON_FENCE_RE.sub('', received).lstrip()
+                if head:
+                    checked_start = True
+                    if head[0] not in '[{':
+                        log.warning("Gemini response does not start as JSON, dropping the stream early.")
+                        break
+    finally:
+        aclose = getattr(stream, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+    return SimpleNamespace(text="".join(text_parts), parsed=None, usage_metadata=usage_metadata)
+
+
+async def _send_gemini_request(contents, config):
+    client = _client()
+    if getattr(client, 'aio', None) is not None:
+        return await client.aio.models.generate_content(
+            model=GEMINI_MODEL,
             contents=contents,
-            config=config if config else None
-        )
-        return response
-    except AttributeError:
-        # Fall back to sync method wrapped in run_in_executor
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            lambda: genai_client.models.generate_content(
-                model="gemini-2.5-flash-preview-05-20",
-                contents=contents,
-                config=config if config else None
-            )
+            config=config
         )
-        return response
+    # Clients without the async surface: run the blocking call in a worker thread, so the
+    # other requests on this event loop keep going (the SDK releases the GIL on socket reads)
+    return await asyncio.to_thread(
+        client.models.generate_content, model=GEMINI_MODEL, contents=contents, config=config)
+
+
+# Gemini File API uploads keyed by the SHA-256 of the document, persisted so that a document
+# analyzed more than once (retries, reprocessed dates, later runs) is only uploaded once
+_upload_cache = None
+_upload_cache_lock = threading.Lock()
+
+
+def _load_upload_cache():
+    global _upload_cache
+    if _upload_cache is None:
+        _upload_cache = {}
+        if os.path.exists(UPLOAD_CACHE_PATH):
+            try:
+                with open(UPLOAD_CACHE_PATH, 'r', encoding='utf-8') as f:
+                    _upload_cache = json.load(f)
+            except (OSError, ValueError) as e:
+                log.warning("Could not read upload cache %s: %s", UPLOAD_CACHE_PATH, e)
+    return _upload_cache
+
+
+def _cached_upload_name(document_path):
+    """Returns (cache_key, file_name) where file_name is a still-valid earlier upload of the document, or None."""
+    cache_key = _sha256_file(document_path)
+    with _upload_cache_lock:
+        entry = _load_upload_cache().get(cache_key)
+    if not entry:
+        return cache_key, None
+    # Leave a margin so the file does not expire between the lookup and the request
+    if entry.get('expires_at') is not None and entry['expires_at'] - UPLOAD_CACHE_EXPIRY_MARGIN <= time.time():
+        return cache_key, None
+    return cache_key, entry['name']
+
+
+def _remember_upload(cache_key, uploaded_file):
+    expiration_time = getattr(uploaded_file, 'expiration_time', None)
+    entry = {
+        'name': uploaded_file.name,
+        'expires_at': expiration_time.timestamp() if expiration_time is not None else None,
+    }
+    with _upload_cache_lock:
+        upload_cache = _load_upload_cache()
+        upload_cache[cache_key] = entry
+        try:
+            os.makedirs(os.path.dirname(UPLOAD_CACHE_PATH) or '.', exist_ok=True)
+            temp_path = UPLOAD_CACHE_PATH + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(upload_cache, f)
+            os.replace(temp_path, UPLOAD_CACHE_PATH)
+        except OSError as e:
+            log.warning("Could not write upload cache %s: %s", UPLOAD_CACHE_PATH, e)
+
+
+# Gemini context caches of system instructions, keyed by the SHA-256 of the instruction text.
+# A failed creation is remembered too (with no name) so it is not retried on every call.
+_context_caches = {}
+_context_cache_lock = threading.Lock()
+
+
+def _cached_content_for(system_instruction):
+    """Returns the name of a live context cache holding system_instruction, creating one if needed, or None."""
+    cache_key = hashlib.sha256(system_instruction.encode('utf-8')).hexdigest()
+    with _context_cache_lock:
+        entry = _context_caches.get(cache_key)
+        if entry is not None and entry['expires_at'] - CONTEXT_CACHE_REFRESH_MARGIN > time.time():
+            return entry['name']
+
+        try:
+            cached_content = _client().caches.create(
+                model=GEMINI_MODEL,
+                config=_types().CreateCachedContentConfig(
+                    system_instruction=system_instruction, ttl=f"{CONTEXT_CACHE_TTL}s"))
+            log.info("Created Gemini context cache %s for a %d character system instruction.",
+                     cached_content.name, len(system_instruction))
+            cache_name = cached_content.name
+        except Exception as e:
+            log.warning("Could not create Gemini context cache, sending the system instruction inline: %s", e)
+            cache_name = None
+        _context_caches[cache_key] = {'name': cache_name, 'expires_at': time.time() + CONTEXT_CACHE_TTL}
+        return cache_name
+
+
+def _forget_cached_content(system_instruction):
+    cache_key = hashlib.sha256(system_instruction.encode('utf-8')).hexdigest()
+    with _context_cache_lock:
+        _context_caches.pop(cache_key, None)
+
+
+# Terminal states of a Gemini batch job
+BATCH_DONE_STATES = {'JOB_STATE_SUCCEEDED', 'JOB_STATE_FAILED', 'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED'}
+
+
+def submit_batch(jobs, display_name="vototransparente", job_keys=None):
+    """
+    Submits jobs to the Gemini batch endpoint as inline requests, which is billed at a
+    lower rate than generate_content but may take minutes to hours to complete.
+    Each job is a dict with 'prompt_text' and optional 'document_path', 'expect_json',
+    'response_schema' and 'max_output_tokens' keys. The returned handle is also written to BATCH_JOBS_DIR,
+    together with job_keys (see _batch_job_key), so that a later run can wait for the batch
+    instead of submitting its jobs again (see run_batch). Returns (handle, error).
+    """
+    if not _client():
+        return None, "GEMINI_API_KEY not configured"
+
+    inline_requests = []
+    try:
+        # The SDK upload calls block, so the documents are uploaded from a small thread pool
+        document_paths = list(dict.fromkeys(
+            path for job in jobs for path in _existing_document_paths(job.get('document_path'))))
+        with ThreadPoolExecutor(max_workers=UPLOAD_PREFETCH_WORKERS) as upload_executor:
+            uploaded_files = dict(zip(document_paths, upload_executor.map(_upload_document_sync, document_paths)))
+
+        for job in jobs:
+            parts = [{'text': job['prompt_text']}]
+            for document_path in _existing_document_paths(job.get('document_path')):
+                uploaded_file = uploaded_files[document_path]
+                parts.append({'file_data': {'file_uri': uploaded_file.uri, 'mime_type': uploaded_file.mime_type}})
+
+            request = {'contents': [{'parts': parts, 'role': 'user'}], 'config': {'candidate_count': 1}}
+            if job.get('max_output_tokens'):
+                request['config']['max_output_tokens'] = job['max_output_tokens']
+            if job.get('expect_json'):
+                request['config'].update({'response_mime_type': 'application/json', 'temperature': 0})
+                if job.get('response_schema'):
+                    request['config']['response_schema'] = job['response_schema']
+            inline_requests.append(request)
+
+        batch_job = _client().batches.create(
+            model=GEMINI_MODEL, src=inline_requests, config={'display_name': display_name})
+    except Exception as e:
+        return None, f"Batch submission failed: {e}"
+
+    handle = {
+        'name': batch_job.name,
+        'expect_json': [bool(job.get('expect_json')) for job in jobs],
+        'structured': [bool(job.get('expect_json') and job.get('response_schema')) for job in jobs],
+        'submitted_at': time.time(),
+        'job_keys': job_keys,
+    }
+    log.info("Submitted Gemini batch %s with %d requests.", batch_job.name, len(jobs))
+    try:
+        os.makedirs(BATCH_JOBS_DIR, exist_ok=True)
+        with open(_batch_handle_path(batch_job.name), 'w', encoding='utf-8') as f:
+            json.dump(handle, f)
+    except OSError as e:
+        # The batch is submitted and paid for either way; only resuming it after a restart is lost
+        log.warning("Could not save the handle of batch %s: %s", batch_job.name, e)
+    return handle, None
+
+
+def _batch_handle_path(batch_name):
+    return os.path.join(BATCH_JOBS_DIR, batch_name.replace('/', '_') + '.json')
+
+
+def _saved_batch_handles():
+    """Handles of the batches submitted by earlier runs and not yet collected, from BATCH_JOBS_DIR."""
+    try:
+        file_names = sorted(os.listdir(BATCH_JOBS_DIR))
+    except OSError:
+        return []
+    handles = []
+    for file_name in file_names:
+        if not file_name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(BATCH_JOBS_DIR, file_name), encoding='utf-8') as f:
+                handle = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning("Could not read batch handle %s: %s", file_name, e)
+            continue
+        if handle.get('job_keys'):  # Handles saved without job keys cannot be matched to jobs
+            handles.append(handle)
+    return handles
+
+
+def _forget_batch_handle(handle):
+    try:
+        os.remove(_batch_handle_path(handle['name']))
+    except OSError:
+        pass
+
+
+def _upload_document_sync(document_path):
+    """Blocking counterpart of _upload_document, for the batch submission."""
+    cache_key, cached_name = _cached_upload_name(document_path)
+    if cached_name:
+        try:
+            return _client().files.get(name=cached_name)
+        except Exception as e:
+            log.warning("Cached upload %s is no longer available (%s), uploading again.", cached_name, e)
+    log.debug("Uploading file for batch: %s", document_path)
+    uploaded_file = _client().files.upload(file=document_path)
+    _remember_upload(cache_key, uploaded_file)
+    return uploaded_file
+
+
+def poll_batch(handle):
+    """
+    Checks a batch submitted with submit_batch. Returns None while it is still running (or its
+    status could not be fetched for a transient reason), otherwise one (result, error) tuple
+    per job, in submission order, in the same form call_gemini_api returns.
+    """
+    try:
+        batch_job = _client().batches.get(name=handle['name'])
+    except Exception as e:
+        if _classify_gemini_exception(e) == GEMINI_ERROR_INVALID_REQUEST:
+            return [(None, f"Batch status check failed: {e}")] * len(handle['expect_json'])
+        # A transient failure to check says nothing about the batch itself; check again later
+        log.warning("Could not check batch %s, will retry: %s", handle['name'], e)
+        return None
+
+    state = batch_job.state.name
+    if state not in BATCH_DONE_STATES:
+        return None
+    if state != 'JOB_STATE_SUCCEEDED':
+        return [(None, f"Batch {handle['name']} ended in state {state}")] * len(handle['expect_json'])
+
+    inlined_responses = batch_job.dest.inlined_responses if batch_job.dest else None
+    inlined_responses = inlined_responses or []
+    results = []
+    # Handles saved before 'structured' was recorded are parsed from the response text
+    structured_flags = handle.get('structured') or [False] * len(handle['expect_json'])
+    for index, (expect_json, structured) in enumerate(zip(handle['expect_json'], structured_flags)):
+        if index >= len(inlined_responses):
+            results.append((None, f"Batch {handle['name']} returned no response for request {index}"))
+            continue
+        inlined = inlined_responses[index]
+        if inlined.error:
+            results.append((None, f"Batch request error: {inlined.error}"))
+        else:
+            results.append(_parse_response(inlined.response, expect_json, structured))
+    return results
+
+
+def wait_for_batch(handle, poll_interval=BATCH_POLL_INTERVAL, deadline=None):
+    """
+    Polls a batch until it finishes and returns its per-job (result, error) tuples, or None if
+    it is still running at deadline (a time.monotonic() value, by default BATCH_MAX_WAIT from now).
+    """
+    if deadline is None:
+        deadline = time.monotonic() + BATCH_MAX_WAIT
+    while True:
+        results = poll_batch(handle)
+        if results is not None:
+            return results
+        if time.monotonic() + poll_interval > deadline:
+            log.warning("Batch %s is still running, leaving it for a later run.", handle['name'])
+            return None
+        time.sleep(poll_interval)
+
+
+def _batch_job_key(job):
+    """Identifies a batch job across runs: the response cache key of the same request."""
+    return _response_cache_key(
+        job['prompt_text'], job.get('response_schema'), None, job.get('expect_json'), job.get('document_path'))
+
+
+def run_batch(jobs, display_name="vototransparente"):
+    """
+    Runs jobs (as for submit_batch) through the Gemini batch endpoint and waits for them, for
+    at most BATCH_MAX_WAIT. Jobs answered before, online or in an earlier batch, come from the
+    response cache, and jobs still pending in a batch saved by an earlier run are taken from
+    that batch; neither is submitted again. Returns one (result, error) tuple per job, in order.
+    """
+    results = [None] * len(jobs)
+    job_keys = [_batch_job_key(job) for job in jobs]
+    indices_by_key = {}
+    for index, job_key in enumerate(job_keys):
+        if RESPONSE_CACHE:
+            cached_result = _response_cache().get(job_key)
+            if cached_result is not None:
+                results[index] = (cached_result, None)
+                continue
+        indices_by_key.setdefault(job_key, []).append(index)
+
+    # Batches of earlier runs that hold some of the jobs; the rest are submitted as a new batch
+    waits = []
+    for handle in _saved_batch_handles():
+        if any(job_key in indices_by_key for job_key in handle['job_keys']):
+            waits.append((handle, [indices_by_key.pop(job_key, []) for job_key in handle['job_keys']]))
+            log.info("Resuming Gemini batch %s submitted by an earlier run.", handle['name'])
+    if indices_by_key:
+        new_keys = list(indices_by_key)
+        handle, error = submit_batch([jobs[indices_by_key[job_key][0]] for job_key in new_keys], display_name, new_keys)
+        if error is None:
+            waits.append((handle, [indices_by_key[job_key] for job_key in new_keys]))
+        else:
+            for job_key in new_keys:
+                for index in indices_by_key[job_key]:
+                    results[index] = (None, error)
+
+    deadline = time.monotonic() + BATCH_MAX_WAIT
+    for handle, indices_per_request in waits:
+        batch_results = wait_for_batch(handle, deadline=deadline)
+        if batch_results is None:
+            for indices in indices_per_request:
+                for index in indices:
+                    results[index] = (None, f"Batch {handle['name']} did not finish within {BATCH_MAX_WAIT}s")
+            continue
+        for job_key, indices, (result, error) in zip(handle['job_keys'], indices_per_request, batch_results):
+            if error is None and RESPONSE_CACHE:
+                # Answers to jobs this run no longer has are kept for whichever run asks for them
+                _response_cache().set(job_key, result, ttl=RESPONSE_CACHE_TTL)
+            for index in indices:
+                results[index] = (result, error)
+        _forget_batch_handle(handle)
+    return results
 
 
 def validate_llm_proposals_response(extracted_data):
     """Validate the LLM response and return valid proposals."""
-    valid_proposals = []
     if not isinstance(extracted_data, list):
-        print(
-            f"Warning: LLM response was not a list, but {type(extracted_data)}. Data: {str(extracted_data)[:200]}")
+        log.warning("LLM response was not a list, but %s. Data: %s", type(extracted_data), str(extracted_data)[:200])
         return []
 
-    for item in extracted_data:
-        if isinstance(item, dict) and 'proposal_name' in item and item['proposal_name'] is not None:
-            valid_proposals.append(item)
-        else:
-            print(
-                f"Warning: LLM returned an invalid item structure or missing proposal_name: {item}")
+    valid_proposals = [item for item in extracted_data
+                       if isinstance(item, dict) and item.get('proposal_name') is not None]
+    invalid_count = len(extracted_data) - len(valid_proposals)
+    if invalid_count:
+        # One warning per response, showing the first offending item as an example
+        first_invalid = next(item for item in extracted_data
+                             if not (isinstance(item, dict) and item.get('proposal_name') is not None))
+        log.warning("LLM returned %d invalid items (invalid structure or missing proposal_name), e.g.: %s",
+                    invalid_count, str(first_invalid)[:200])
     return valid_proposals
@@ -1,26 +1,66 @@
 import os
 import re
+import json
+import bisect
+import operator
 import time
-import pypdf
-import tabula
+import shutil
 import hashlib
+import functools
+import mmap
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
 import pandas as pd
 import fitz  # PyMuPDF
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from urllib.parse import urlparse, parse_qs
 
 from config import (
     DOWNLOAD_TIMEOUT,
+    PDF_EXTRACT_PROCESSES,
+    TABLE_EXTRACTOR,
+    PDF_TEXT_CACHE,
+    PDF_TEXT_CACHE_DIR,
     SESSION_PDF_DIR,
     PROPOSAL_DOC_DIR,
     DATAFRAME_PATH,
     HTTP_RETRY_ATTEMPTS,
     HTTP_RETRY_BASE_DELAY,
     HTTP_RETRY_MAX_DELAY,
-    HTTP_RETRY_MAX_TOTAL_TIME
+    HTTP_RETRY_MAX_TOTAL_TIME,
+    HTTP_STATUS_RETRIES,
+    HTTP_POOL_MAXSIZE,
+    DOWNLOAD_CHUNK_SIZE,
+    RANGE_DOWNLOAD_MIN_SIZE,
+    RANGE_DOWNLOAD_PARTS,
+    RANGE_DOWNLOAD_MAX_ACTIVE
 )
 
 
+def _create_http_session():
+    """
+    Shared session for every request to the parliament site, so that connections (and their
+    TLS handshakes) are reused across pages and downloads. Its adapter only retries 429/5xx
+    responses; timeouts and connection errors are retried by http_request_with_retry.
+    """
+    session = requests.Session()
+    retry = Retry(total=HTTP_STATUS_RETRIES, connect=0, read=0, status=HTTP_STATUS_RETRIES,
+                  backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['GET'], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+_http_session = _create_http_session()
+# Each ranged download opens RANGE_DOWNLOAD_PARTS - 1 extra connections, so only a few run at once
+_range_download_slots = threading.BoundedSemaphore(RANGE_DOWNLOAD_MAX_ACTIVE)
+
+
 
 def http_request_with_retry(url, headers=None, timeout=DOWNLOAD_TIMEOUT, stream=False):
     """
@@ -40,7 +80,7 @@ def http_request_with_retry(url, headers=None, timeout=DOWNLOAD_TIMEOUT, stream=
     for attempt in range(HTTP_RETRY_ATTEMPTS):
         try:
             print(f"Attempting HTTP request to {url} (attempt {attempt + 1}/{HTTP_RETRY_ATTEMPTS})")
-            response = requests.get(url, headers=headers, timeout=timeout, stream=stream)
+            response = _http_session.get(url, headers=headers, timeout=timeout, stream=stream)
             response.raise_for_status()
             return response, None
             
@@ -77,6 +117,23 @@ def http_request_with_retry(url, headers=None, timeout=DOWNLOAD_TIMEOUT, stream=
     return None, f"Request failed after {HTTP_RETRY_ATTEMPTS} attempts"
 
 
+# Expected DataFrame columns, in order; get_dataframe_columns() hands out copies
+_DATAFRAME_COLUMNS = (
+    'session_pdf_url', 'session_year', 'session_date', 'session_pdf_text_path', 'session_pdf_download_status',
+    'proposal_name_from_session', 'proposal_gov_link', 'voting_details_json', 'session_parse_status',
+    'proposal_authors_json', 'proposal_document_url', 'proposal_document_type',
+    'proposal_document_local_path', 'proposal_doc_download_status', 'proposal_details_scrape_status',
+    'proposal_summary_general', 'proposal_summary_analysis', 'proposal_summary_fiscal_impact',
+    'proposal_summary_colloquial', 'proposal_category', 'proposal_summarize_status',
+    'proposal_approval_status', 'proposal_short_title', 'proposal_proposing_party',
+    'overall_status', 'last_error_message', 'last_processed_timestamp'
+)
+# Integer columns, stored as nullable Int64; in CSV files they are read as text and converted
+# afterwards, so files written while a column held floats ("2024.0", "1.0") still load
+_INTEGER_COLUMNS = ('session_year', 'proposal_approval_status')
+_CSV_DTYPES = {col: 'string' for col in _DATAFRAME_COLUMNS}
+
+
 def init_directories():
     """Creates necessary data directories if they don't exist."""
     os.makedirs(SESSION_PDF_DIR, exist_ok=True)
@@ -85,26 +142,35 @@ def init_directories():
 
 
 def load_or_initialize_dataframe(dataframe_path=None):
-    """Loads the DataFrame from CSV if it exists, otherwise initializes an empty one."""
-    df_path = dataframe_path if dataframe_path else DATAFRAME_PATH
+    """Loads the DataFrame from Parquet or CSV if it exists, otherwise initializes an empty one."""
+    df_path = get_dataframe_source_path(dataframe_path)
+    expected_columns = get_dataframe_columns()
+    if df_path != (dataframe_path if dataframe_path else DATAFRAME_PATH):
+        print(f"No Parquet checkpoint found, falling back to {df_path}")
     if os.path.exists(df_path):
         print(f"Loading existing DataFrame from {df_path}")
         try:
-            df = pd.read_csv(df_path)
+            if df_path.endswith('.parquet'):
+                # Copy so columns decoded zero-copy from Arrow (e.g. categoricals) are writable
+                df = pd.read_parquet(df_path, engine='pyarrow').copy()
+            else:
+                # Explicit dtypes skip type inference and keep missing text as pd.NA
+                df = pd.read_csv(df_path, dtype=_CSV_DTYPES, low_memory=False)
+            # Parquet files written while proposal_approval_status was a categorical are converted too
+            coerce_integer_columns(df)
         except pd.errors.EmptyDataError:
             print(
                 f"Warning: {DATAFRAME_PATH} is empty. Initializing a new DataFrame.")
-            df = pd.DataFrame(columns=get_dataframe_columns())
+            df = pd.DataFrame(columns=expected_columns)
         except Exception as e:
             print(
                 f"Error loading DataFrame: {e}. Initializing a new DataFrame.")
-            df = pd.DataFrame(columns=get_dataframe_columns())
+            df = pd.DataFrame(columns=expected_columns)
     else:
         print("Initializing new DataFrame.")
-        df = pd.DataFrame(columns=get_dataframe_columns())
+        df = pd.DataFrame(columns=expected_columns)
 
     # Ensure all columns are present, add if missing (for schema evolution)
-    expected_columns = get_dataframe_columns()
     for col in expected_columns:
         if col not in df.columns:
             df[col] = pd.NA  # Use pd.NA for missing values
@@ -115,28 +181,134 @@ def load_or_initialize_dataframe(dataframe_path=None):
     return df
 
 
+def coerce_integer_columns(df):
+    """Converts the integer columns present in df to Int64 in place; values that are not numbers become NA."""
+    for col in _INTEGER_COLUMNS:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype('Int64')
+    return df
+
+
+def get_dataframe_source_path(dataframe_path=None):
+    """
+    The file a DataFrame is loaded from: the given path, or for a Parquet path that does not
+    exist yet, an older CSV checkpoint with the same base name if there is one.
+    """
+    df_path = dataframe_path if dataframe_path else DATAFRAME_PATH
+    if df_path.endswith('.parquet') and not os.path.exists(df_path):
+        csv_path = os.path.splitext(df_path)[0] + '.csv'
+        if os.path.exists(csv_path):
+            return csv_path
+    return df_path
+
+
+def _dataframe_source_stamp(dataframe_path=None):
+    """Identifies the current version of the DataFrame's source file (None if there is none)."""
+    source_path = get_dataframe_source_path(dataframe_path)
+    try:
+        stat = os.stat(source_path)
+    except OSError:
+        return None
+    return f"{os.path.abspath(source_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
 def get_dataframe_columns():
     """Returns the list of expected DataFrame columns."""
-    return [
-        'session_pdf_url', 'session_year', 'session_date', 'session_pdf_text_path', 'session_pdf_download_status',
-        'proposal_name_from_session', 'proposal_gov_link', 'voting_details_json', 'session_parse_status',
-        'proposal_authors_json', 'proposal_document_url', 'proposal_document_type',
-        'proposal_document_local_path', 'proposal_doc_download_status', 'proposal_details_scrape_status',
-        'proposal_summary_general', 'proposal_summary_analysis', 'proposal_summary_fiscal_impact',
-        'proposal_summary_colloquial', 'proposal_category', 'proposal_summarize_status',
-        'proposal_approval_status', 'proposal_short_title', 'proposal_proposing_party',
-        'overall_status', 'last_error_message', 'last_processed_timestamp'
-    ]
+    return list(_DATAFRAME_COLUMNS)
 
 
 def save_dataframe(df, dataframe_path=None):
-    """Saves the DataFrame to CSV."""
+    """
+    Saves the DataFrame to Parquet, or to CSV when the path ends in .csv.
+    Writes to a temporary sibling file first and swaps it in with os.replace,
+    so an interrupted save never leaves a truncated checkpoint behind.
+    """
     try:
         df_path = dataframe_path if dataframe_path else DATAFRAME_PATH
-        df.to_csv(df_path, index=False)
+        tmp_path = f"{df_path}.tmp"
+        # Parquet columns need one type; the shallow copy keeps the caller's DataFrame as it is
+        df = coerce_integer_columns(df.copy(deep=False))
+        if df_path.endswith('.csv'):
+            df.to_csv(tmp_path, index=False)
+        else:
+            df.to_parquet(tmp_path, engine='pyarrow', compression='zstd', index=False)
+        os.replace(tmp_path, df_path)
         print(f"DataFrame saved to {df_path}")
+        return True
     except Exception as e:
         print(f"Error saving DataFrame: {e}")
+        return False
+
+
+def export_dataframe_csv(df, dataframe_path=None):
+    """Saves a CSV copy of a Parquet-checkpointed DataFrame next to it, for human inspection."""
+    df_path = dataframe_path if dataframe_path else DATAFRAME_PATH
+    if not df_path.endswith('.parquet'):
+        return False  # The checkpoint is already a CSV
+    return save_dataframe(df, os.path.splitext(df_path)[0] + '.csv')
+
+
+def get_update_log_path(dataframe_path=None):
+    """Returns the path of the append-only row change log kept next to the DataFrame file."""
+    df_path = dataframe_path if dataframe_path else DATAFRAME_PATH
+    return f"{df_path}.jsonl"
+
+
+def append_update_log(records, dataframe_path=None):
+    """
+    Appends row change records to the DataFrame's update log, one JSON object per line.
+    A new log starts with a header naming the version of the DataFrame file its row ids
+    refer to. Returns True on success, False if the log could not be written.
+    """
+    log_path = get_update_log_path(dataframe_path)
+    try:
+        with open(log_path, 'a', encoding='utf-8') as f:
+            if f.tell() == 0:
+                f.write(json.dumps({'_base': _dataframe_source_stamp(dataframe_path)}) + '\n')
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        return True
+    except OSError as e:
+        print(f"Error appending to update log {log_path}: {e}")
+        return False
+
+
+def read_update_log(dataframe_path=None):
+    """
+    Reads the row change records from the DataFrame's update log, skipping a torn final line.
+    A log written against a different version of the DataFrame file than the current one
+    (rewritten since, so its row ids no longer line up) is set aside as '<log>.stale' and
+    nothing is returned.
+    """
+    log_path = get_update_log_path(dataframe_path)
+    if not os.path.exists(log_path):
+        return []
+    records = []
+    with open(log_path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                print(f"Warning: Skipping unreadable line {line_number} in update log {log_path}")
+    if records and '_base' in records[0]:
+        header = records.pop(0)
+        if header['_base'] != _dataframe_source_stamp(dataframe_path):
+            print(f"Warning: Update log {log_path} refers to an older version of the DataFrame file; "
+                  f"not replaying it (kept as {log_path}.stale)")
+            os.replace(log_path, f"{log_path}.stale")
+            return []
+    return records
+
+
+def clear_update_log(dataframe_path=None):
+    """Removes the DataFrame's update log once its changes are part of the DataFrame file."""
+    log_path = get_update_log_path(dataframe_path)
+    if os.path.exists(log_path):
+        os.remove(log_path)
 
 
 def download_file(url, destination_path, is_pdf=True):
@@ -174,14 +346,72 @@ def download_file(url, destination_path, is_pdf=True):
         # Create directory if it doesn't exist
         os.makedirs(os.path.dirname(destination_path), exist_ok=True)
         
-        with open(destination_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
+        # Written under a temporary name so an interrupted download is never taken for a complete file
+        part_path = f"{destination_path}.part"
+        total_size = int(response.headers.get('Content-Length') or 0)
+        if (RANGE_DOWNLOAD_PARTS > 1 and total_size >= RANGE_DOWNLOAD_MIN_SIZE
+                and response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+                and not response.headers.get('Content-Encoding')
+                and _range_download_slots.acquire(blocking=False)):
+            try:
+                _download_in_ranges(url, response, part_path, headers, total_size)
+            finally:
+                _range_download_slots.release()
+        else:
+            # Copy the raw stream in large blocks; decode_content undoes any gzip/deflate transfer encoding
+            response.raw.decode_content = True
+            with open(part_path, 'wb') as f:
+                shutil.copyfileobj(response.raw, f, length=DOWNLOAD_CHUNK_SIZE)
+        os.replace(part_path, destination_path)
         print(f"Successfully downloaded {destination_path}")
         return True, destination_path
-    except IOError as e:
+    except (IOError, Urllib3HTTPError) as e:  # Reading response.raw raises urllib3's errors unwrapped
         print(f"Error saving file to {destination_path}: {e}")
         return False, str(e)
+    finally:
+        response.close()  # Hands the connection back to the shared session's pool
+
+
+def _download_in_ranges(url, response, file_path, headers, total_size):
+    """
+    Saves a large download as RANGE_DOWNLOAD_PARTS byte ranges fetched in parallel, each written
+    at its offset of a pre-sized file. The first range is read from the already open response,
+    the others with Range requests. Raises IOError if a range fails or comes back short.
+    """
+    part_size = -(-total_size // RANGE_DOWNLOAD_PARTS)
+    ranges = [(start, min(start + part_size, total_size) - 1) for start in range(0, total_size, part_size)]
+    print(f"Downloading {url} ({total_size} bytes) in {len(ranges)} parallel ranges")
+    with open(file_path, 'wb') as f:
+        f.truncate(total_size)
+
+    def write_range(start, end, source):
+        with open(file_path, 'r+b') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                chunk = source.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise IOError(f"Range {start}-{end} of {url} ended {remaining} bytes early")
+                f.write(chunk)
+                remaining -= len(chunk)
+
+    def fetch_range(start, end):
+        range_response, error = http_request_with_retry(
+            url, headers={**headers, 'Range': f'bytes={start}-{end}'}, timeout=DOWNLOAD_TIMEOUT, stream=True)
+        if error:
+            raise IOError(error)
+        try:
+            if range_response.status_code != 206:
+                raise IOError(f"Range request for {url} answered with status {range_response.status_code}")
+            write_range(start, end, range_response.raw)
+        finally:
+            range_response.close()
+
+    with ThreadPoolExecutor(max_workers=len(ranges) - 1) as executor:
+        futures = [executor.submit(fetch_range, start, end) for start, end in ranges[1:]]
+        write_range(ranges[0][0], ranges[0][1], response.raw)
+        for future in futures:
+            future.result()
 
 
 def _deduplicate_hyperlinks(hyperlinks):
@@ -250,23 +480,87 @@ def extract_text_from_pdf(pdf_path):
     if not os.path.exists(pdf_path):
         print(f"PDF file not found: {pdf_path}")
         return None, "PDF file not found"
+    cache_path = _pdf_text_cache_path(pdf_path) if PDF_TEXT_CACHE else None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            print(f"Using cached text for {pdf_path} (length: {len(text)})")
+            return text, None
+        except OSError as e:
+            print(f"Could not read cached text {cache_path}: {e}")
     try:
-        reader = pypdf.PdfReader(pdf_path)
-        text = ""
-        for page in reader.pages:
-            page_text = page.extract_text()
-            if page_text:
-                text += page_text + "\n"
+        # MuPDF parses in C; collect the page texts and join them once
+        with fitz.open(pdf_path) as doc:
+            page_texts = [page.get_text("text") for page in doc]
+        text = "".join(page_text + "\n" for page_text in page_texts if page_text)
         if not text.strip():
             return None, "No text extracted from PDF (possibly image-based or empty)"
         print(
             f"Successfully extracted text from {pdf_path} (length: {len(text)})")
+        if cache_path:
+            _store_pdf_text(cache_path, text)
         return text, None
     except Exception as e:
         print(f"Error extracting text from {pdf_path}: {e}")
         return None, str(e)
 
 
+def _pdf_text_cache_path(pdf_path):
+    """Cache file for the text of pdf_path, named after its content hash; None if it cannot be read."""
+    try:
+        stat = os.stat(pdf_path)
+        content_hash = _blake2b_file_version(os.path.abspath(pdf_path), stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return None
+    return os.path.join(PDF_TEXT_CACHE_DIR, f"{content_hash}.txt")
+
+
+@functools.lru_cache(maxsize=1024)
+def _blake2b_file_version(path, mtime_ns, size):
+    # Keyed by modification time and size so an unchanged file is only hashed once per process
+    with open(path, 'rb') as f:
+        if size == 0:
+            return hashlib.blake2b(digest_size=16).hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return hashlib.blake2b(mapped, digest_size=16).hexdigest()
+
+
+def _store_pdf_text(cache_path, text):
+    try:
+        os.makedirs(PDF_TEXT_CACHE_DIR, exist_ok=True)
+        temp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        print(f"Could not cache extracted text to {cache_path}: {e}")
+
+
+def extract_hyperlink_tables_many(pdf_paths, max_workers=PDF_EXTRACT_PROCESSES):
+    """
+    Runs extract_hyperlink_table_data over several PDFs in parallel worker processes.
+
+    Returns:
+        list: ((extracted_pairs, unpaired_hyperlinks), error) for each path, in order
+    """
+    if not pdf_paths:
+        return []
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(pdf_paths))) as executor:
+        return list(executor.map(_extract_hyperlink_tables_or_error, pdf_paths))
+
+
+def _extract_hyperlink_tables_or_error(pdf_path):
+    try:
+        return extract_hyperlink_table_data(pdf_path), None
+    except Exception as e:
+        return None, e
+
+
+# Lines that start with an approval keyword (case-insensitive) delimit the proposal blocks
+_APPROVAL_LINE_RE = re.compile(r'aprovad|rejeitad|prejudicad', re.IGNORECASE | re.ASCII)
+
+
 def extract_hyperlink_table_data(pdf_path, start_page=None, end_page=None):
     """
     Extracts groups of hyperlinks and their single associated table from a PDF,
@@ -316,7 +610,6 @@ def extract_hyperlink_table_data(pdf_path, start_page=None, end_page=None):
         current_page_1idx = page_num_0idx + 1
 
         # Extract approval lines - these are our primary delimiters
-        approval_keywords = ["aprovad", "rejeitad", "prejudicad"]
         page_text_dict = page_fitz.get_text("dict", sort=True)
         for block in page_text_dict.get("blocks", []):
             if block.get("type") == 0:  # text block
@@ -325,30 +618,31 @@ def extract_hyperlink_table_data(pdf_path, start_page=None, end_page=None):
                     full_line_text = "".join(line_text_parts).strip()
                     line_bbox = line["bbox"]  # (x0, y0, x1, y1)
 
-                    if any(keyword in full_line_text.lower() for keyword in approval_keywords) and full_line_text:
-                        # More restrictive approval text detection
-                        # Should be relatively short and primarily approval text
-                        if len(full_line_text) <= 50 and any(
-                            full_line_text.lower().strip().startswith(keyword) for keyword in approval_keywords
-                        ):
-                            all_elements.append({
-                                'type': 'approval',
-                                'text': full_line_text,
-                                'page_num': current_page_1idx,
-                                'y_position': line_bbox[1],  # Use top y-coordinate
-                                'y_bottom': line_bbox[3]
-                            })
+                    # Approval text should be relatively short and start with an approval keyword
+                    if len(full_line_text) <= 50 and _APPROVAL_LINE_RE.match(full_line_text):
+                        all_elements.append({
+                            'type': 'approval',
+                            'text': full_line_text,
+                            'page_num': current_page_1idx,
+                            'y_position': line_bbox[1],  # Use top y-coordinate
+                            'y_bottom': line_bbox[3]
+                        })
 
         # Extract hyperlinks
         links = page_fitz.get_links()
+        page_words = None
         for link in links:
             if link['kind'] == fitz.LINK_URI:
                 uri = link['uri']
                 if ".pdf" in uri.lower():  # Skip links to other PDFs
                     continue
                 rect = link['from']
-                link_text_raw = page_fitz.get_text("text", clip=rect)
-                link_text = ' '.join(link_text_raw.split()) if link_text_raw else "N/A"
+                if rect.is_empty:  # A zero-area link covers no text, so there is nothing to look up
+                    link_text = "N/A"
+                else:
+                    if page_words is None:
+                        page_words = _PageWords(page_fitz)  # One text extraction shared by every link on the page
+                    link_text = page_words.text_in(rect) or "N/A"
 
                 all_elements.append({
                     'type': 'hyperlink',
@@ -360,23 +654,21 @@ def extract_hyperlink_table_data(pdf_path, start_page=None, end_page=None):
                     'rect': (rect.x0, rect.y0, rect.x1, rect.y1)
                 })
 
-        # Extract tables
-        try:
-            tables_on_page_json = tabula.read_pdf(pdf_path,
-                                                  pages=str(current_page_1idx),
-                                                  output_format="json",
-                                                  multiple_tables=True,
-                                                  lattice=True,
-                                                  silent=True)
-            if not tables_on_page_json:
-                tables_on_page_json = tabula.read_pdf(pdf_path,
-                                                      pages=str(current_page_1idx),
-                                                      output_format="json",
-                                                      multiple_tables=True,
-                                                      stream=True,
-                                                      silent=True)
-        except Exception:
-            tables_on_page_json = []
+    # Tables are only paired with hyperlinks: without any in the range, table extraction
+    # would only produce tables that no proposal can be matched to
+    tables_json_by_page = {}
+    if not any(element['type'] == 'hyperlink' for element in all_elements):
+        print(f"No hyperlinks on pages {first_page_to_process_0idx + 1}-{last_page_to_process_0idx + 1}, skipping table extraction")
+    elif TABLE_EXTRACTOR == "pymupdf" or _tabula() is None:
+        tables_json_by_page = _find_tables_by_page(
+            doc_fitz, first_page_to_process_0idx + 1, last_page_to_process_0idx + 1)
+    else:
+        tables_json_by_page = _read_tables_by_page(
+            pdf_path, first_page_to_process_0idx + 1, last_page_to_process_0idx + 1)
+    doc_fitz.close()
+
+    for current_page_1idx in range(first_page_to_process_0idx + 1, last_page_to_process_0idx + 2):
+        tables_on_page_json = tables_json_by_page.get(current_page_1idx, [])
         
         for table_json_data in tables_on_page_json:
             table_rows_text = []
@@ -407,11 +699,18 @@ def extract_hyperlink_table_data(pdf_path, start_page=None, end_page=None):
                     'right': table_json_data['left'] + table_json_data['width']
                 }
             })
-
-    doc_fitz.close()
     
     # Sort all elements by page and y-position
-    all_elements.sort(key=lambda x: (x['page_num'], x['y_position']))
+    all_elements.sort(key=operator.itemgetter('page_num', 'y_position'))
+    
+    # The type of the first approval or hyperlink after each element (None if there is none),
+    # found in one backwards pass instead of scanning ahead from every table
+    next_link_or_approval = [None] * len(all_elements)
+    upcoming_type = None
+    for i in range(len(all_elements) - 1, -1, -1):
+        next_link_or_approval[i] = upcoming_type
+        if all_elements[i]['type'] in ('approval', 'hyperlink'):
+            upcoming_type = all_elements[i]['type']
     
     # Create blocks using approval text as primary delimiters and tables as secondary delimiters
     blocks = []
@@ -436,14 +735,7 @@ def extract_hyperlink_table_data(pdf_path, start_page=None, end_page=None):
         
         elif element['type'] == 'table':
             # Check if there are hyperlinks after this table but before the next approval text
-            has_hyperlinks_after_table = False
-            for j in range(i + 1, len(all_elements)):
-                next_elem = all_elements[j]
-                if next_elem['type'] == 'approval':
-                    break
-                elif next_elem['type'] == 'hyperlink':
-                    has_hyperlinks_after_table = True
-                    break
+            has_hyperlinks_after_table = next_link_or_approval[i] == 'hyperlink'
             
             # If we have hyperlinks after this table, the table serves as a delimiter
             if has_hyperlinks_after_table and current_block['hyperlinks']:
@@ -499,6 +791,139 @@ def extract_hyperlink_table_data(pdf_path, start_page=None, end_page=None):
     return extracted_pairs, unpaired_hyperlinks_all
 
 
+class _PageWords:
+    """
+    The words of a PDF page, extracted once and indexed by their vertical centre, so the text
+    under each hyperlink is looked up without running MuPDF's text extraction again per link.
+    A word belongs to a rectangle when its centre lies inside it.
+    """
+
+    def __init__(self, page_fitz):
+        words = page_fitz.get_text("words")  # (x0, y0, x1, y1, word, block_no, line_no, word_no)
+        self._words = sorted(
+            ((word[1] + word[3]) / 2, (word[0] + word[2]) / 2, order, word[4])
+            for order, word in enumerate(words))
+        self._y_centres = [word[0] for word in self._words]
+
+    def text_in(self, rect):
+        """Words whose centre lies in rect, in reading order, joined by single spaces."""
+        start = bisect.bisect_left(self._y_centres, rect.y0)
+        end = bisect.bisect_right(self._y_centres, rect.y1)
+        matches = sorted((order, text) for _, x_centre, order, text in self._words[start:end]
+                         if rect.x0 <= x_centre <= rect.x1)
+        return ' '.join(text for _, text in matches)
+
+
+@functools.cache
+def _tabula():
+    """
+    The tabula module, imported on first table extraction so that importing utils does not load
+    it; None if it is not installed (it needs Java, and is optional with TABLE_EXTRACTOR = "pymupdf").
+    """
+    try:
+        import tabula
+    except ImportError:
+        return None
+    return tabula
+
+
+def _find_tables_by_page(doc_fitz, first_page, last_page):
+    """
+    In-process alternative to _read_tables_by_page using PyMuPDF's table finder, returning the
+    same {page: [table json, ...]} shape so both feed the same pairing code. Ruling lines are
+    tried first (like tabula's lattice mode), then text alignment (like its stream mode).
+    """
+    tables_by_page = {}
+    for page in range(first_page, last_page + 1):
+        page_fitz = doc_fitz[page - 1]
+        tables = []
+        for strategy in ("lines", "text"):
+            try:
+                tables = page_fitz.find_tables(strategy=strategy).tables
+            except Exception as e:
+                # Without tables every hyperlink on the page ends up unpaired, so say why
+                print(f"Error finding tables on page {page} with strategy '{strategy}': {e}")
+                tables = []
+            if tables:
+                break
+        tables_by_page[page] = [_table_json_from_fitz(table) for table in tables]
+    return tables_by_page
+
+
+def _table_json_from_fitz(table):
+    """A PyMuPDF table in tabula's JSON layout: position, size and rows of {'text': ...} cells."""
+    x0, y0, x1, y1 = table.bbox
+    return {
+        'top': y0,
+        'left': x0,
+        'height': y1 - y0,
+        'width': x1 - x0,
+        'data': [[{'text': cell if cell is not None else ''} for cell in row] for row in table.extract()],
+    }
+
+
+def _read_tables_by_page(pdf_path, first_page, last_page):
+    """
+    Reads the tables of pages first_page..last_page (1-indexed) into {page: [table json, ...]}.
+    Every tabula call starts a JVM that parses the whole PDF, so each extraction mode is run
+    once over the range: lattice first, then stream for the pages where lattice found nothing.
+    If a range call fails, or tabula does not report page numbers, the pages are read one at a
+    time as before.
+    """
+    pages = list(range(first_page, last_page + 1))
+    tables_by_page = _read_tables_for_pages(pdf_path, pages, lattice=True)
+    if tables_by_page is None:
+        return {page: _read_tables_for_page(pdf_path, page) for page in pages}
+
+    pages_without_tables = [page for page in pages if not tables_by_page.get(page)]
+    if pages_without_tables:
+        stream_tables_by_page = _read_tables_for_pages(pdf_path, pages_without_tables, stream=True)
+        if stream_tables_by_page is None:
+            stream_tables_by_page = {page: _read_tables_for_page(pdf_path, page, lattice_first=False)
+                                     for page in pages_without_tables}
+        tables_by_page.update(stream_tables_by_page)
+    return tables_by_page
+
+
+def _read_tables_for_pages(pdf_path, pages, **mode):
+    """One tabula call for several pages, grouped by page; None if it fails or cannot be grouped."""
+    try:
+        tables_json = _tabula().read_pdf(pdf_path, pages=pages, output_format="json",
+                                         multiple_tables=True, silent=True, **mode)
+    except Exception:
+        return None
+    tables_by_page = {}
+    for table_json_data in tables_json or []:
+        page = table_json_data.get('page_number', table_json_data.get('page'))
+        if page is None:
+            return None
+        tables_by_page.setdefault(page, []).append(table_json_data)
+    return tables_by_page
+
+
+def _read_tables_for_page(pdf_path, page, lattice_first=True):
+    """The tables of a single page: lattice mode, falling back to stream mode if it finds none."""
+    try:
+        tables_on_page_json = []
+        if lattice_first:
+            tables_on_page_json = _tabula().read_pdf(pdf_path,
+                                                     pages=str(page),
+                                                     output_format="json",
+                                                     multiple_tables=True,
+                                                     lattice=True,
+                                                     silent=True)
+        if not tables_on_page_json:
+            tables_on_page_json = _tabula().read_pdf(pdf_path,
+                                                     pages=str(page),
+                                                     output_format="json",
+                                                     multiple_tables=True,
+                                                     stream=True,
+                                                     silent=True)
+    except Exception:
+        tables_on_page_json = []
+    return tables_on_page_json
+
+
 def _extract_proposal_number(text):
     """
     Extracts proposal number from text (e.g., "371/XVI" from various text formats).
@@ -610,6 +1035,11 @@ def _deduplicate_proposals_across_lists(extracted_pairs, unpaired_hyperlinks):
     
     return deduplicated_extracted_pairs, deduplicated_unpaired_hyperlinks
 
+_UNSAFE_FILENAME_CHARS_RE = re.compile(r'[^\w\-.]+')  # Each run becomes one underscore
+_DOT_RUN_RE = re.compile(r'\.{2,}')
+_UNDERSCORE_RUN_RE = re.compile(r'_{2,}')
+
+
 def generate_session_pdf_filename(session_pdf_url, session_year_param):
     """Generate a safe, descriptive filename for session PDFs."""
     try:
@@ -623,9 +1053,9 @@ def generate_session_pdf_filename(session_pdf_url, session_year_param):
             original_filename = query_params['Nomeficheiro'][0]
 
         if original_filename:
-            safe_filename_base = re.sub(r'[^\w\-_.]', '_', original_filename)
-            safe_filename_base = re.sub(r'\.+', '.', safe_filename_base)
-            safe_filename_base = re.sub(r'_+', '_', safe_filename_base)
+            safe_filename_base = _UNSAFE_FILENAME_CHARS_RE.sub('_', original_filename)
+            safe_filename_base = _DOT_RUN_RE.sub('.', safe_filename_base)
+            safe_filename_base = _UNDERSCORE_RUN_RE.sub('_', safe_filename_base)
             safe_filename_base = safe_filename_base.strip('._')
 
             if len(safe_filename_base) > 100:
@@ -636,7 +1066,7 @@ def generate_session_pdf_filename(session_pdf_url, session_year_param):
             else:
                 safe_filename = safe_filename_base
         else:
-            url_hash = hashlib.md5(session_pdf_url.encode()).hexdigest()[:10]
+            url_hash = hashlib.blake2b(session_pdf_url.encode(), digest_size=5).hexdigest()
             safe_filename = f"session_{session_year_param}_{url_hash}.pdf"
 
         if not safe_filename.lower().endswith(('.pdf', '.doc', '.docx')):
@@ -648,13 +1078,13 @@ def generate_session_pdf_filename(session_pdf_url, session_year_param):
         else:
             final_filename = safe_filename
 
-        final_filename = re.sub(r'_+', '_', final_filename)
+        final_filename = _UNDERSCORE_RUN_RE.sub('_', final_filename)
         return final_filename
 
     except Exception as e:
         print(
             f"Error generating session PDF filename for {session_pdf_url}: {e}. Using fallback.")
-        url_hash = hashlib.md5(session_pdf_url.encode()).hexdigest()[:10]
+        url_hash = hashlib.blake2b(session_pdf_url.encode(), digest_size=5).hexdigest()
         return f"session_{session_year_param}_{url_hash}_fallback.pdf"
 
 
@@ -689,14 +1119,18 @@ def validate_hyperlink_extraction():
     print(f"Found {len(pdf_files)} PDF files to validate")
     print("=" * 80)
     
-    for i, pdf_path in enumerate(pdf_files, 1):
+    extraction_results = extract_hyperlink_tables_many(pdf_files)
+    
+    for i, (pdf_path, (extraction, extraction_error)) in enumerate(zip(pdf_files, extraction_results), 1):
         pdf_filename = os.path.basename(pdf_path)
         print(f"\n[{i}/{len(pdf_files)}] Processing: {pdf_filename}")
         print("-" * 60)
         
         try:
-            # Extract hyperlinks and table data
-            extracted_pairs, unpaired_hyperlinks = extract_hyperlink_table_data(pdf_path)
+            # Hyperlinks and table data, extracted for all files above
+            if extraction_error:
+                raise extraction_error
+            extracted_pairs, unpaired_hyperlinks = extraction
             
             # Display results
             print(f"✓ Extraction successful")